@@ -0,0 +1,228 @@
+"""
+Adaptive quadtree sampling of a field.
+
+The domain is split into base × base cells. Each cell is tested by
+evaluating the field at its 4 edge midpoints and its center, and comparing
+them with the bilinear interpolation of its corners:
+
+    error = max |B - B_bilinear| / (|B| + atol)
+
+A cell whose error is above tol is split into 4 children, whose corners are
+the 9 points already evaluated, down to max_level. Smooth far-field cells
+stop after a level or two; only the cells along windings, end faces and
+near dipoles reach the finest level.
+
+All sample points lie on the lattice of the finest level, so points shared
+by neighbouring cells are evaluated once. A leaf interpolates its 9 points
+biquadratically (4 corners bilinearly at max_level), which is more accurate
+than the bilinear estimate the refinement is based on.
+"""
+
+import numpy as np
+
+
+
+def _lagrange(t):
+    """Quadratic Lagrange basis on the nodes 0, 1/2, 1."""
+    return 2 * (t - 0.5) * (t - 1), -4 * t * (t - 1), 2 * t * (t - 0.5)
+
+
+
+class AdaptiveField:
+    """
+    Adaptive samples of field(x, y) -> (Bx, By) over x_range × y_range.
+
+    tol: relative interpolation error above which a cell is refined
+    base: number of cells along each axis at level 0
+    max_level: maximum number of refinements of a base cell
+    atol: field magnitude below which errors are absolute rather than
+        relative (default: 1e-3 × the median |B| of the level 0 samples),
+        so that field zeros do not get refined down to max_level
+
+    Non-finite samples (points on a winding) always refine their cell.
+
+    n_evaluations: number of field evaluations, against (base 2^max_level + 1)²
+        for the uniform grid of the same finest spacing
+    levels: number of leaves per level
+
+    The samples themselves are returned by samples(), the leaf cells by
+    cells(); calling the object interpolates at arbitrary points.
+    """
+
+    def __init__(self, field, x_range, y_range, tol=1e-2, base=16, max_level=6, atol=None):
+        self.x_range = tuple(map(float, x_range))
+        self.y_range = tuple(map(float, y_range))
+        self.tol = tol
+        self.base = base
+        self.max_level = max_level
+
+        # Finest lattice: n × n intervals
+        self.n = base * 2**max_level
+        self.hx = (self.x_range[1] - self.x_range[0]) / self.n
+        self.hy = (self.y_range[1] - self.y_range[0]) / self.n
+
+        self._field = field
+        self._keys = np.empty(0, dtype=np.int64)
+        self._values = np.empty((0, 2))
+        self.n_evaluations = 0
+
+        step = 2**max_level
+        j, i = np.meshgrid(np.arange(base), np.arange(base), indexing='ij')
+        i, j = i.ravel() * step, j.ravel() * step
+        self._sample(np.concatenate([i, i + step, i, i + step]), np.concatenate([j, j, j + step, j + step]))
+
+        if atol is None:
+            B = np.hypot(*self._values.T)
+            B = B[np.isfinite(B)]
+            atol = 1e-3 * np.median(B) if B.size else 0.0
+        self.atol = atol
+
+        self._leaves = {}
+        self._refine(i, j)
+        del self._field
+
+
+    def _key(self, i, j):
+        return j.astype(np.int64) * (self.n + 1) + i
+
+
+    def _sample(self, i, j):
+        """Evaluate the field at the lattice points (i, j) not sampled yet."""
+        keys = np.unique(self._key(i, j))
+        keys = keys[~np.isin(keys, self._keys, assume_unique=True)]
+        if keys.size == 0:
+            return
+
+        ii, jj = keys % (self.n + 1), keys // (self.n + 1)
+        Bx, By = self._field(self.x_range[0] + ii * self.hx, self.y_range[0] + jj * self.hy)
+        self.n_evaluations += keys.size
+
+        keys = np.concatenate([self._keys, keys])
+        values = np.concatenate([self._values, np.column_stack([np.ravel(Bx), np.ravel(By)])])
+        order = np.argsort(keys, kind='stable')
+        self._keys, self._values = keys[order], values[order]
+
+
+    def _get(self, i, j):
+        """Sampled (Bx, By) at lattice points (i, j), shape (..., 2)."""
+        return self._values[np.searchsorted(self._keys, self._key(i, j))]
+
+
+    def _refine(self, i, j):
+        """Refine the level 0 cells with lower-left lattice corners (i, j)."""
+        for level in range(self.max_level + 1):
+            step = 2**(self.max_level - level)
+            if level == self.max_level or i.size == 0:
+                self._leaves[level] = (i, j)
+                break
+
+            h = step // 2
+            mid_i = np.stack([i + h, i, i + step, i + h, i + h])
+            mid_j = np.stack([j, j + h, j + h, j + step, j + h])
+            self._sample(mid_i.ravel(), mid_j.ravel())
+
+            c00, c10 = self._get(i, j), self._get(i + step, j)
+            c01, c11 = self._get(i, j + step), self._get(i + step, j + step)
+            predicted = np.stack([(c00 + c10) / 2, (c00 + c01) / 2, (c10 + c11) / 2,
+                                  (c01 + c11) / 2, (c00 + c10 + c01 + c11) / 4])
+            actual = self._get(mid_i, mid_j)
+
+            with np.errstate(invalid='ignore'):
+                error = (np.hypot(*np.moveaxis(actual - predicted, -1, 0))
+                         / (np.hypot(*np.moveaxis(actual, -1, 0)) + self.atol))
+            error = np.where(np.isfinite(error), error, np.inf).max(axis=0)
+
+            refine = error > self.tol
+            self._leaves[level] = (i[~refine], j[~refine])
+            i, j = i[refine], j[refine]
+            i = np.concatenate([i, i + h, i, i + h])
+            j = np.concatenate([j, j, j + h, j + h])
+
+        # Sorted keys of the leaves in units of their own level's cells, for lookups
+        self._leaf_keys = {}
+        for level in range(self.max_level + 1):
+            i, j = self._leaves.setdefault(level, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+            step = 2**(self.max_level - level)
+            self._leaf_keys[level] = np.sort(self._key(i // step, j // step))
+
+
+    @property
+    def levels(self):
+        return {level: leaf[0].size for level, leaf in self._leaves.items()}
+
+
+    def samples(self):
+        """Coordinates and field of the adaptive samples: x, y, Bx, By."""
+        i, j = self._keys % (self.n + 1), self._keys // (self.n + 1)
+        return (self.x_range[0] + i * self.hx, self.y_range[0] + j * self.hy,
+                self._values[:, 0].copy(), self._values[:, 1].copy())
+
+
+    def cells(self):
+        """Leaf cells as (x0, y0, width, height) rows, e.g. to draw the quadtree."""
+        rows = []
+        for level, (i, j) in self._leaves.items():
+            step = 2**(self.max_level - level)
+            rows.append(np.column_stack([self.x_range[0] + i * self.hx, self.y_range[0] + j * self.hy,
+                                         np.full(i.size, step * self.hx), np.full(i.size, step * self.hy)]))
+        return np.concatenate(rows)
+
+
+    def __call__(self, x, y):
+        """Interpolated (Bx, By) at points inside the domain."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        u = np.clip((np.broadcast_to(x, shape).ravel() - self.x_range[0]) / self.hx, 0, self.n)
+        v = np.clip((np.broadcast_to(y, shape).ravel() - self.y_range[0]) / self.hy, 0, self.n)
+
+        Bx = np.full(u.size, np.nan)
+        By = np.full(u.size, np.nan)
+        todo = np.arange(u.size)
+
+        for level in range(self.max_level + 1):
+            leaf_keys = self._leaf_keys[level]
+            if todo.size == 0:
+                break
+            if leaf_keys.size == 0:
+                continue
+            step = 2**(self.max_level - level)
+            cells = self.base * 2**level
+
+            # Cell of each remaining point at this level, looked up among the leaves
+            ci = np.minimum(u[todo] // step, cells - 1).astype(np.int64)
+            cj = np.minimum(v[todo] // step, cells - 1).astype(np.int64)
+            keys = self._key(ci, cj)
+            found = np.minimum(np.searchsorted(leaf_keys, keys), leaf_keys.size - 1)
+            hit = leaf_keys[found] == keys
+            if not np.any(hit):
+                continue
+
+            points = todo[hit]
+            i0, j0 = ci[hit] * step, cj[hit] * step
+            s = (u[points] - i0) / step
+            t = (v[points] - j0) / step
+
+            if level == self.max_level:
+                corners = [self._get(i0 + di * step, j0 + dj * step) for dj in (0, 1) for di in (0, 1)]
+                weights = [(1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t]
+                value = sum(w[:, None] * c for w, c in zip(weights, corners))
+            else:
+                h = step // 2
+                ls, lt = _lagrange(s), _lagrange(t)
+                value = sum((ls[a] * lt[b])[:, None] * self._get(i0 + a * h, j0 + b * h)
+                            for a in range(3) for b in range(3))
+
+            Bx[points], By[points] = value[:, 0], value[:, 1]
+            todo = todo[~hit]
+
+        return Bx.reshape(shape), By.reshape(shape)
+
+
+    def resample(self, resolution, x_range=None, y_range=None):
+        """Interpolate onto a uniform grid: X, Y, Bx, By as compute_field."""
+        x_range = self.x_range if x_range is None else x_range
+        y_range = self.y_range if y_range is None else y_range
+        X, Y = np.meshgrid(np.linspace(*x_range, resolution), np.linspace(*y_range, resolution))
+        Bx, By = self(X, Y)
+        return X, Y, Bx, By
@@ -0,0 +1,167 @@
+"""
+Compute backends of the batched field evaluation.
+
+MagneticFieldSimulation.field, Coil.field and Magnet.field evaluate the
+packed struct-of-arrays tables of their objects through a backend:
+
+    numpy: reference backend, the vectorised NumPy/scipy kernels of
+           functions.py over sources × points blocks
+    numba: fused per-point loops compiled with Numba (optional dependency,
+           pip install -r requirements-numba.txt; see numba_kernels.py):
+           the cel AGM iterations of both end faces and both field
+           components are computed in registers, summed over the sources
+           and parallelised over the points, with no intermediate array.
+           Only the forms the kernels reproduce are fused (magnets, 'cel'
+           coils without far_field_tol); the rest uses the reference.
+
+The backend is chosen per call (backend='numba'), per simulation
+(MagneticFieldSimulation(..., backend='numba')) or globally with
+set_backend(). The initial default is the FIELD_BACKEND environment
+variable, or 'numpy': running the test suite with FIELD_BACKEND=numba
+checks every test against the compiled backend.
+
+parity() compares a backend with the reference on a scene.
+"""
+
+import os
+import numpy as np
+
+
+
+class NumpyBackend:
+    """Reference backend: the classes' own batch_field, summed over the sources."""
+
+    name = 'numpy'
+
+    def bytes_per_pair(self, cls):
+        """Peak memory per (source, point) pair, for the chunking of MagneticFieldSimulation."""
+        return cls.bytes_per_pair
+
+    def batch_field(self, cls, table, x, y, **kwargs):
+        """Field (Bx, By) of shape (P,) of all the objects of a packed table, summed."""
+        Bx, By = cls.batch_field(table, x, y, **kwargs)
+        return Bx.sum(axis=0), By.sum(axis=0)
+
+
+
+class NumbaBackend(NumpyBackend):
+    """
+    Fused kernels compiled with Numba for Magnet tables and the Coil rows
+    they reproduce exactly: formulation='cel' without far_field_tol. Heuman
+    coils (a different formula, NaN on the end faces) and far-field coils
+    fall back to the reference backend, as do other classes. Compiled on
+    first use and cached on disk.
+    """
+
+    name = 'numba'
+
+    def __init__(self):
+        import numba_kernels
+        # Kernel, table columns and fused rows (None: all) per class
+        self.kernels = {'Coil': (numba_kernels.coil_field_sum, ('x', 'y', 'radius', 'length', 'n', 'current', 'mu'),
+                                 _fused_coils),
+                        'Magnet': (numba_kernels.magnet_field_sum, ('x', 'y', 'moment', 'mu'), None)}
+
+    def bytes_per_pair(self, cls):
+        # Nothing is allocated per pair by the kernels, but coils may fall back
+        return 1 if cls.__name__ == 'Magnet' else cls.bytes_per_pair
+
+    def batch_field(self, cls, table, x, y, **kwargs):
+        if cls.__name__ not in self.kernels:
+            return super().batch_field(cls, table, x, y, **kwargs)
+        kernel, columns, fused_rows = self.kernels[cls.__name__]
+        fused = np.ones(len(table[columns[0]]), dtype=bool) if fused_rows is None else fused_rows(table, **kwargs)
+
+        Bx = np.zeros(np.size(x))
+        By = np.zeros(np.size(y))
+        if not fused.all():
+            rest = {c: v[~fused] for c, v in table.items()}
+            Bx, By = super().batch_field(cls, rest, x, y, **kwargs)
+        if fused.any():
+            x = np.ascontiguousarray(x, dtype=float)
+            y = np.ascontiguousarray(y, dtype=float)
+            bx, by = kernel(*(np.ascontiguousarray(table[c][fused], dtype=float) for c in columns), x, y)
+            Bx, By = Bx + bx, By + by
+        return Bx, By
+
+
+
+def _fused_coils(table, formulation='heuman'):
+    """Coil rows the fused kernel computes exactly: 'cel' coils without far-field switch."""
+    return np.isnan(table['far_field_tol']) & (formulation == 'cel')
+
+
+
+BACKENDS = {
+    'numpy': NumpyBackend,
+    'numba': NumbaBackend,
+}
+
+_instances = {}
+_default = os.environ.get('FIELD_BACKEND', 'numpy')
+
+
+
+def get_backend(name=None):
+    """Backend instance by name (default: the current default backend), or a backend passed through."""
+    if name is None:
+        name = _default
+    if not isinstance(name, str):
+        return name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', expected one of {list(BACKENDS)}")
+    if name not in _instances:
+        try:
+            _instances[name] = BACKENDS[name]()
+        except ImportError as error:
+            raise ImportError(f"Backend '{name}' is not available: {error}") from error
+    return _instances[name]
+
+
+
+def set_backend(name):
+    """Set the default backend, returning the previous one."""
+    global _default
+    get_backend(name)
+    previous, _default = _default, name
+    return previous
+
+
+
+def register_backend(name, factory):
+    """Register a backend class (or factory) under name."""
+    BACKENDS[name] = factory
+    _instances.pop(name, None)
+
+
+
+def available_backends():
+    """Names of the backends that load in this environment."""
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+
+def parity(backend, objects, x, y, reference='numpy'):
+    """
+    Largest difference |B_backend - B_reference| at the points (x, y),
+    relative to the largest |B_reference|, for a list of objects. Points
+    where the reference is not finite (on windings) are compared by their
+    finiteness only: inf if the backend differs there.
+    """
+    from simulation import MagneticFieldSimulation
+
+    sim = MagneticFieldSimulation(objects)
+    Bx, By = sim.field(x, y, backend=backend)
+    Bx_ref, By_ref = sim.field(x, y, backend=reference)
+    finite = np.isfinite(Bx_ref) & np.isfinite(By_ref)
+    if np.any(finite != (np.isfinite(Bx) & np.isfinite(By))):
+        return float('inf')
+    scale = np.max(np.hypot(Bx_ref[finite], By_ref[finite]))
+    return float(np.max(np.hypot(Bx - Bx_ref, By - By_ref)[finite]) / scale)
@@ -0,0 +1,481 @@
+"""
+Accuracy and timing benchmarks for the field kernels.
+
+Usage:
+    python benchmark.py            # all printed benchmarks
+    python benchmark.py cel tiles   # selected benchmarks
+    python benchmark.py suite --json results.json
+    python benchmark.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import warnings
+import os
+import numpy as np
+from scipy import special, integrate
+from functions import coil_field, coil_field_cel, get_Br, get_Bz
+
+try:
+    import mpmath
+except ImportError:
+    mpmath = None
+from simulation import Coil, Magnet, ExtendedMagnet, MagneticFieldSimulation
+from rope import Rope
+
+
+
+# Reference geometry (same coil as simulation.py)
+A = 0.05
+LENGTH = 0.20
+MU = 4 * np.pi * 1e-7
+N = 100 / LENGTH
+I = 2.0
+
+
+
+def loop_field(a, mu, i, r, z):
+    """
+    Field (Br, Bz) of a single circular loop of radius a, without any
+    clamping of k². Used as the Biot-Savart integrand of the reference.
+    """
+    alpha_sq = (a - r)**2 + z**2
+    beta_sq = (a + r)**2 + z**2
+    k_sq = 4 * a * r / beta_sq
+    K = special.ellipk(k_sq)
+    E = special.ellipe(k_sq)
+    beta = np.sqrt(beta_sq)
+
+    Bz = mu * i / (2 * np.pi * beta) * (K + (a**2 - r**2 - z**2) / alpha_sq * E)
+    if r < 1e-12:
+        return 0.0, Bz
+    Br = mu * i * z / (2 * np.pi * r * beta) * (-K + (a**2 + r**2 + z**2) / alpha_sq * E)
+    return Br, Bz
+
+
+
+def reference_coil_field(a, mu, n, i, r, z, length):
+    """
+    High-precision (Br, Bz) of a finite solenoid by adaptive quadrature of
+    loop fields along the coil length. Same sign convention as coil_field.
+    """
+    r = np.atleast_1d(np.asarray(r, dtype=float))
+    z = np.atleast_1d(np.asarray(z, dtype=float))
+    Br = np.zeros(r.shape)
+    Bz = np.zeros(r.shape)
+
+    for j in range(r.size):
+        # The integrand is sharply peaked at z' = z when r ≈ a
+        points = [z[j]] if abs(z[j]) < length / 2 else None
+        opts = dict(points=points, limit=400, epsabs=0, epsrel=1e-13)
+        Br[j] = integrate.quad(lambda zp: loop_field(a, mu, 1.0, r[j], z[j] - zp)[0], -length / 2, length / 2, **opts)[0]
+        Bz[j] = integrate.quad(lambda zp: loop_field(a, mu, 1.0, r[j], z[j] - zp)[1], -length / 2, length / 2, **opts)[0]
+
+    return -n * i * Br, n * i * Bz
+
+
+
+def sample_regions(n_points=40, seed=0):
+    """Point sets (r, z) that stress the kernels, keyed by region name."""
+    rng = np.random.default_rng(seed)
+    b = LENGTH / 2
+    delta = np.logspace(-4, -1, n_points)
+    side = np.where(rng.random(n_points) < 0.5, -1, 1)
+
+    return {
+        'on axis (r = 0)': (np.zeros(n_points), rng.uniform(-2 * b, 2 * b, n_points)),
+        'near axis': (A * np.logspace(-8, -2, n_points), rng.uniform(-2 * b, 2 * b, n_points)),
+        'near winding r ≈ a': (A * (1 + side * delta), rng.uniform(-0.9 * b, 0.9 * b, n_points)),
+        'near end faces': (rng.uniform(0.05 * A, 2 * A, n_points), b * side * (1 + rng.choice([-1, 1], n_points) * delta)),
+        'interior': (rng.uniform(0.05 * A, 0.9 * A, n_points), rng.uniform(-0.9 * b, 0.9 * b, n_points)),
+        'far field': (rng.uniform(0, 10 * LENGTH, n_points), rng.uniform(2 * LENGTH, 10 * LENGTH, n_points) * side),
+    }
+
+
+
+def relative_error(value, reference, magnitude):
+    """
+    Max error of one field component relative to the local |B|, so that a
+    vanishing component (Br on axis) does not blow up the ratio. NaN is
+    counted as a failure.
+    """
+    err = np.abs(value - reference) / magnitude
+    err = np.where(np.isfinite(value), err, np.inf)
+    return np.max(err)
+
+
+
+def time_kernel(kernel, r, z, repeat=3):
+    """Best wall time (s) of kernel on the points (r, z)."""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        kernel(A, MU, N, I, r, z - LENGTH / 2, z + LENGTH / 2)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+
+def bench_cel(n_points=40, n_timing=10**6):
+    """Accuracy and timing tables of the 'cel' vs 'heuman' coil kernels."""
+
+    print(f"Coil a={A} m, L={LENGTH} m, n={N:.0f} /m, I={I} A")
+    print(f"Max error |ΔB_i| / |B| vs Biot-Savart quadrature ({n_points} points per region)\n")
+    print(f"{'region':<22} {'Br heuman':>12} {'Br cel':>12} {'Bz heuman':>12} {'Bz cel':>12}")
+
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', integrate.IntegrationWarning)
+
+        for name, (r, z) in sample_regions(n_points).items():
+            Br_ref, Bz_ref = reference_coil_field(A, MU, N, I, r, z, LENGTH)
+            B_ref = np.hypot(Br_ref, Bz_ref)
+            Br_h, Bz_h = coil_field(A, MU, N, I, r, z - LENGTH / 2, z + LENGTH / 2)
+            Br_c, Bz_c = coil_field_cel(A, MU, N, I, r, z - LENGTH / 2, z + LENGTH / 2)
+
+            errors = [relative_error(Br_h, Br_ref, B_ref),
+                      relative_error(Br_c, Br_ref, B_ref),
+                      relative_error(Bz_h, Bz_ref, B_ref),
+                      relative_error(Bz_c, Bz_ref, B_ref)]
+            print(f"{name:<22} " + " ".join(f"{e:>12.2e}" for e in errors))
+
+        rng = np.random.default_rng(1)
+        r = rng.uniform(0, 4 * A, n_timing)
+        z = rng.uniform(-LENGTH, LENGTH, n_timing)
+        t_heuman = time_kernel(coil_field, r, z)
+        t_cel = time_kernel(coil_field_cel, r, z)
+
+    print(f"\nTiming on {n_timing} points (best of 3)\n")
+    print(f"{'kernel':<22} {'time [ms]':>12} {'speedup':>12}")
+    print(f"{'heuman':<22} {t_heuman * 1e3:>12.1f} {1.0:>12.2f}")
+    print(f"{'cel':<22} {t_cel * 1e3:>12.1f} {t_heuman / t_cel:>12.2f}")
+
+
+
+def bench_tiles(resolution=1000, executor='thread', tiles_per_worker=4):
+    """Speedup of the tiled compute_field against the number of workers."""
+
+    objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.20, n_turns=100, current=2.0),
+               Magnet(x=0.1, y=0.2, moment=0.1)]
+    sim = MagneticFieldSimulation(objects)
+    domain = dict(x_range=(-0.20, 0.20), y_range=(-0.15, 0.35), resolution=resolution)
+
+    with np.errstate(all='ignore'):
+        t0 = time.perf_counter()
+        sim.compute_field(**domain)
+        t_serial = time.perf_counter() - t0
+        Bx, By = sim.Bx, sim.By
+
+        print(f"compute_field {resolution}x{resolution}, executor={executor}, {os.cpu_count()} cores\n")
+        print(f"{'workers':<10} {'tiles':>10} {'time [s]':>12} {'speedup':>10} {'identical':>10}")
+        print(f"{'serial':<10} {'-':>10} {t_serial:>12.2f} {1.0:>10.2f} {'-':>10}")
+
+        workers = 1
+        while workers <= os.cpu_count():
+            tiles = (workers * tiles_per_worker, 1)
+            t0 = time.perf_counter()
+            sim.compute_field(**domain, tiles=tiles, workers=workers, executor=executor)
+            elapsed = time.perf_counter() - t0
+            identical = np.array_equal(sim.Bx, Bx, equal_nan=True) and np.array_equal(sim.By, By, equal_nan=True)
+            print(f"{workers:<10} {str(tiles):>10} {elapsed:>12.2f} {t_serial / elapsed:>10.2f} {str(identical):>10}")
+            workers *= 2
+
+
+
+def bench_treecode(n_dipoles=(10**4, 10**5, 10**6), n_points=10**4, n_reference=500, thetas=(0.2, 0.5, 0.8)):
+    """
+    Error and speedup of the Barnes-Hut tree code against the direct sum
+    for extended magnets of increasing dipole count. The direct sum is
+    timed on a subsample of n_reference points and scaled to n_points.
+    """
+    rng = np.random.default_rng(2)
+    x = rng.uniform(-0.2, 0.2, n_points)
+    y = rng.uniform(-0.2, 0.2, n_points)
+    sub = rng.choice(n_points, n_reference, replace=False)
+
+    print(f"Extended magnet 0.02 x 0.06 m, {n_points} points in a 0.4 x 0.4 m box")
+    print(f"Error |ΔB| / |B| and speedup vs direct sum (direct timed on {n_reference} points)\n")
+    print(f"{'dipoles':>10} {'theta':>6} {'nodes':>8} {'build [s]':>10} {'time [s]':>10} "
+          f"{'direct [s]':>11} {'speedup':>9} {'max err':>10} {'median err':>11}")
+
+    with np.errstate(all='ignore'):
+        for n in n_dipoles:
+            n_x = int(np.sqrt(n / 2))
+            magnet = ExtendedMagnet(x=0.0, y=0.0, radius=0.01, length=0.06, n_x=n_x, n_y=n // n_x)
+
+            t0 = time.perf_counter()
+            Bx_ref, By_ref = magnet.direct_field(x[sub], y[sub])
+            t_direct = (time.perf_counter() - t0) * n_points / n_reference
+            B_ref = np.hypot(Bx_ref, By_ref)
+
+            t0 = time.perf_counter()
+            tree = magnet.tree()
+            t_build = time.perf_counter() - t0
+
+            for theta in thetas:
+                t0 = time.perf_counter()
+                Bx, By = tree.field(x, y, theta)
+                elapsed = time.perf_counter() - t0
+                err = np.hypot(Bx[sub] - Bx_ref, By[sub] - By_ref) / B_ref
+                err = err[np.isfinite(err)]
+                print(f"{magnet.n_x * magnet.n_y:>10} {theta:>6.2f} {tree.n_nodes:>8} {t_build:>10.2f} {elapsed:>10.2f} "
+                      f"{t_direct:>11.2f} {t_direct / elapsed:>9.1f} {np.max(err):>10.2e} {np.median(err):>11.2e}")
+
+
+
+def bench_rope(duration=1.0, dts=(2e-2, 5e-3, 1e-3), force_every=(1, 10)):
+    """Wall time of the implicit rope integrator per simulated second."""
+
+    rope = Rope(y=0.0)
+    sim = MagneticFieldSimulation([rope, Magnet(x=0.0, y=0.03, moment=0.1)])
+    c = np.sqrt(rope.tension / rope.line_mass_density)
+    substeps = np.ceil(0.02 / (0.5 * rope.dx / c))
+
+    print(f"Rope of {rope.n} dipoles, {duration} s simulated; "
+          f"the explicit frontend scheme needs {substeps:.0f} substeps per 20 ms frame\n")
+    print(f"{'dt [s]':>10} {'force every':>12} {'steps':>8} {'time [s]':>10} {'per step [ms]':>14}")
+
+    for dt in dts:
+        for every in force_every:
+            rope.reset_mechanics()
+            t0 = time.perf_counter()
+            rope.run(sim, duration, dt, record_every=10**9, force_every=every)
+            elapsed = time.perf_counter() - t0
+            steps = int(round(duration / dt))
+            print(f"{dt:>10.0e} {every:>12} {steps:>8} {elapsed:>10.2f} {elapsed / steps * 1e3:>14.3f}")
+
+
+
+def reference_dipole_field(moment, mu, dx, dy):
+    """
+    Field of a y-oriented point dipole in extended precision (mpmath if
+    installed, otherwise np.longdouble), as the reference of Magnet.field.
+    """
+    if mpmath is not None:
+        with mpmath.workdps(30):
+            Bx, By = [], []
+            for x, y in zip(dx, dy):
+                x, y = mpmath.mpf(float(x)), mpmath.mpf(float(y))
+                c = mpmath.mpf(mu) * moment / (4 * mpmath.pi) / mpmath.sqrt(x**2 + y**2)**5
+                Bx.append(float(c * 3 * x * y))
+                By.append(float(c * (2 * y**2 - x**2)))
+        return np.array(Bx), np.array(By)
+
+    x = np.asarray(dx, dtype=np.longdouble)
+    y = np.asarray(dy, dtype=np.longdouble)
+    c = np.longdouble(mu) * moment / (4 * np.pi) / np.sqrt(x**2 + y**2)**5
+    return (c * 3 * x * y).astype(float), (c * (2 * y**2 - x**2)).astype(float)
+
+
+
+def best_time(function, repeat=3):
+    """Best wall time (s) of function() over repeat calls."""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+
+def _finite(value):
+    """Float for JSON, None for NaN and infinities."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': sys.modules['scipy'].__version__, 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'reference': 'biot-savart quadrature, ' + ('mpmath' if mpmath else 'longdouble')}
+
+
+
+def _random_objects(n_sources, seed=3):
+    rng = np.random.default_rng(seed)
+    objects = []
+    for j in range(n_sources):
+        if j % 2 == 0:
+            objects.append(Coil(x=rng.uniform(-0.2, 0.2), y=rng.uniform(-0.2, 0.2), radius=rng.uniform(0.01, 0.05),
+                                length=rng.uniform(0.02, 0.2), n_turns=100, current=rng.uniform(-2, 2)))
+        else:
+            objects.append(Magnet(x=rng.uniform(-0.2, 0.2), y=rng.uniform(-0.2, 0.2), moment=rng.uniform(-0.1, 0.1)))
+    return objects
+
+
+
+def bench_suite(resolutions=(50, 200, 1000, 4000), n_sources=(1, 10, 100, 500), n_points=40,
+                n_timing=10**5, source_resolution=200, repeat=3, json_path=None):
+    """
+    Accuracy and timing of the public entry points, optionally saved as JSON.
+
+    accuracy: max |ΔB_i| / |B| of get_Br/get_Bz, the 'heuman' and 'cel' coil
+        kernels and Magnet.field per region of sample_regions()
+    timing: the kernels per region (n_timing points), Coil.field,
+        Magnet.field and compute_field per grid resolution, and field() per
+        number of sources (half coils, half magnets) on a
+        source_resolution² grid
+
+    Returns the results dict (see compare()).
+    """
+    results = {'environment': _environment(), 'accuracy': [], 'timing': []}
+    kernels = {
+        'get_Br/get_Bz': lambda *args: (get_Br(*args), get_Bz(*args)),
+        'coil_field': coil_field,
+        'coil_field_cel': coil_field_cel,
+    }
+
+    def record(name, case, seconds, points):
+        results['timing'].append({'name': name, 'case': case, 'seconds': seconds, 'points': int(points),
+                                  'points_per_second': points / seconds})
+        print(f"{name:<22} {str(case):<22} {points:>10} {seconds * 1e3:>12.2f} {points / seconds:>14.3e}")
+
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        print(f"Max error |ΔB_i| / |B| vs high-precision reference ({n_points} points per region)\n")
+        print(f"{'kernel':<22} {'region':<22} {'Br':>10} {'Bz':>10}")
+        regions = sample_regions(n_points)
+        for region, (r, z) in regions.items():
+            Br_ref, Bz_ref = reference_coil_field(A, MU, N, I, r, z, LENGTH)
+            B_ref = np.hypot(Br_ref, Bz_ref)
+            for name, kernel in kernels.items():
+                Br, Bz = kernel(A, MU, N, I, r, z - LENGTH / 2, z + LENGTH / 2)
+                errors = relative_error(Br, Br_ref, B_ref), relative_error(Bz, Bz_ref, B_ref)
+                results['accuracy'].append({'name': name, 'region': region,
+                                            'Br': _finite(errors[0]), 'Bz': _finite(errors[1])})
+                print(f"{name:<22} {region:<22} {errors[0]:>10.2e} {errors[1]:>10.2e}")
+
+        magnet = Magnet(x=0.0, y=0.0)
+        rng = np.random.default_rng(4)
+        for region, distance in (('near (1 mm - 1 cm)', (1e-3, 1e-2)), ('far (0.1 - 10 m)', (0.1, 10))):
+            radius = np.exp(rng.uniform(*np.log(distance), n_points))
+            angle = rng.uniform(0, 2 * np.pi, n_points)
+            dx, dy = radius * np.cos(angle), radius * np.sin(angle)
+            Bx_ref, By_ref = reference_dipole_field(magnet.moment, magnet.mu, dx, dy)
+            Bx, By = magnet.field(dx, dy)
+            B_ref = np.hypot(Bx_ref, By_ref)
+            errors = relative_error(Bx, Bx_ref, B_ref), relative_error(By, By_ref, B_ref)
+            results['accuracy'].append({'name': 'Magnet.field', 'region': region,
+                                        'Br': _finite(errors[0]), 'Bz': _finite(errors[1])})
+            print(f"{'Magnet.field':<22} {region:<22} {errors[0]:>10.2e} {errors[1]:>10.2e}")
+
+        print(f"\nTiming (best of {repeat})\n")
+        print(f"{'entry point':<22} {'case':<22} {'points':>10} {'time [ms]':>12} {'points/s':>14}")
+        for region, (r, z) in regions.items():
+            r, z = np.resize(r, n_timing), np.resize(z, n_timing)
+            for name, kernel in kernels.items():
+                seconds = best_time(lambda: kernel(A, MU, N, I, r, z - LENGTH / 2, z + LENGTH / 2), repeat)
+                record(name, region, seconds, n_timing)
+
+        coil = Coil(x=-0.05, y=0.0, radius=A, length=LENGTH, n_turns=100, current=I)
+        sim = MagneticFieldSimulation([coil, Magnet(x=0.1, y=0.2, moment=0.1)])
+        for resolution in resolutions:
+            X, Y = np.meshgrid(np.linspace(-0.2, 0.2, resolution), np.linspace(-0.15, 0.35, resolution))
+            runs = 1 if resolution > 1000 else repeat
+            record('Coil.field', resolution, best_time(lambda: coil.field(X, Y), runs), X.size)
+            record('Magnet.field', resolution, best_time(lambda: magnet.field(X, Y), runs), X.size)
+            del X, Y
+            record('compute_field', resolution,
+                   best_time(lambda: sim.compute_field((-0.2, 0.2), (-0.15, 0.35), resolution), runs), resolution**2)
+
+        X, Y = np.meshgrid(np.linspace(-0.25, 0.25, source_resolution), np.linspace(-0.25, 0.25, source_resolution))
+        for n in n_sources:
+            sources = MagneticFieldSimulation(_random_objects(n))
+            record('field (sources)', n, best_time(lambda: sources.field(X, Y), repeat), X.size)
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults written to {json_path}")
+    return results
+
+
+
+def compare(before, after, tolerance=1.2, accuracy_tolerance=10.0):
+    """
+    Regressions between two bench_suite results (dicts or JSON paths).
+
+    A timing regresses when it is more than tolerance times slower, an
+    accuracy when the error grows by more than accuracy_tolerance (and
+    above 1e-12) or becomes non-finite. Returns the list of regressions.
+    """
+    results = []
+    for result in (before, after):
+        if isinstance(result, str):
+            with open(result) as f:
+                result = json.load(f)
+        results.append(result)
+    before, after = results
+    regressions = []
+
+    old = {(t['name'], str(t['case'])): t['seconds'] for t in before['timing']}
+    print(f"{'entry point':<22} {'case':<22} {'before [ms]':>12} {'after [ms]':>12} {'ratio':>8}")
+    for t in after['timing']:
+        key = (t['name'], str(t['case']))
+        if key not in old:
+            continue
+        ratio = t['seconds'] / old[key]
+        flag = ratio > tolerance
+        print(f"{key[0]:<22} {key[1]:<22} {old[key] * 1e3:>12.2f} {t['seconds'] * 1e3:>12.2f} {ratio:>8.2f}"
+              + ('  SLOWER' if flag else ''))
+        if flag:
+            regressions.append(('timing', *key, ratio))
+
+    old = {(a['name'], a['region']): a for a in before['accuracy']}
+    for a in after['accuracy']:
+        key = (a['name'], a['region'])
+        if key not in old:
+            continue
+        for component in ('Br', 'Bz'):
+            e0, e1 = old[key][component], a[component]
+            if e1 is None and e0 is not None or (
+                    e0 is not None and e1 is not None and e1 > 1e-12 and e1 > accuracy_tolerance * e0):
+                print(f"accuracy regression: {key[0]} {key[1]} {component} {e0} -> {e1}")
+                regressions.append(('accuracy', *key, component))
+
+    print(f"\n{len(regressions)} regression(s)")
+    return regressions
+
+
+BENCHMARKS = {
+    'cel': bench_cel,
+    'tiles': bench_tiles,
+    'treecode': bench_treecode,
+    'rope': bench_rope,
+    'suite': bench_suite,
+}
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Accuracy and timing benchmarks for the field kernels.')
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run among {list(BENCHMARKS)} (default: all but suite)")
+    parser.add_argument('--json', help='write the suite results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two suite JSON files, exit status 1 on regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    names = args.names or [name for name in BENCHMARKS if name != 'suite']
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}', expected one of {list(BENCHMARKS)}")
+    for name in names:
+        if name == 'suite':
+            bench_suite(json_path=args.json)
+        else:
+            BENCHMARKS[name]()
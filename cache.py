@@ -0,0 +1,85 @@
+"""
+LRU cache of per-object field contributions.
+"""
+
+from collections import OrderedDict
+
+
+
+class FieldCache:
+    """
+    Least-recently-used cache of (Bx, By) contributions under a byte budget.
+
+    Keys are built by MagneticFieldSimulation from each object's defining
+    parameters and the grid definition. hits/misses/evictions are counted
+    so that the efficiency of a session can be inspected with stats().
+    """
+
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+
+    def get(self, key):
+        """Cached (Bx, By) for key, or None. Counts a hit or a miss."""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+
+    def peek(self, key):
+        """Cached (Bx, By) for key, or None, without touching LRU order or stats."""
+        return self._entries.get(key)
+
+
+    def put(self, key, value):
+        """Store (Bx, By) for key, evicting least recently used entries if needed."""
+        size = sum(array.nbytes for array in value)
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self.nbytes -= sum(array.nbytes for array in self._entries.pop(key))
+
+        while self._entries and self.nbytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in evicted)
+            self.evictions += 1
+
+        self._entries[key] = value
+        self.nbytes += size
+
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def stats(self):
+        """Hit/miss statistics and memory use."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -1,15 +1,85 @@
 """
 Plot comparison of magnetic fields from Coil and Magnet classes
-Reads data from field_comparison_data.json generated by compare_fields.js
+Reads data from compare_data.json generated by compare_fields.js, or from a
+binary snapshot (fieldfile.py format) generated by the Python classes:
+
+    python3 compare_plots.py                         # compare_data.json
+    python3 compare_plots.py --python                # compute compare_data.emf, then plot
+    python3 compare_plots.py compare_data.emf      # plot an existing snapshot
 """
 
+import argparse
 import json
 import matplotlib.pyplot as plt
 import numpy as np
 
-# Read data from JSON file
-with open('compare_data.json', 'r') as f:
-    data = json.load(f)
+MU_0 = 4 * np.pi * 1e-7
+N_POINTS = 100
+
+
+
+def generate_snapshot(path, n=N_POINTS):
+    """
+    Same cuts as compare_fields.js with the Python Coil and ExtendedMagnet,
+    each object's cuts evaluated in a single line_profile call, written as
+    one snapshot with coil/... and magnet/... arrays.
+    """
+    from fieldfile import write_arrays
+    from simulation import Coil, ExtendedMagnet, MagneticFieldSimulation
+
+    coil_params = {'x': 0.0, 'y': 0.0, 'radius': 0.03, 'length': 0.05, 'nTurns': 100, 'current': 2.0, 'mu': MU_0}
+    surface = np.pi * coil_params['radius']**2
+    moment = coil_params['nTurns'] * coil_params['current'] * surface
+    magnet_params = {'x': 0.0, 'y': 0.0, 'radius': coil_params['radius'], 'length': coil_params['length'],
+                     'n_x': 100, 'n_y': 200, 'moment': moment, 'angle': 90, 'mu': MU_0}
+
+    coil = Coil(0.0, 0.0, coil_params['radius'], coil_params['length'], coil_params['nTurns'],
+                coil_params['current'], MU_0)
+    magnet = ExtendedMagnet(0.0, 0.0, magnet_params['radius'], magnet_params['length'], magnet_params['n_x'],
+                            magnet_params['n_y'], moment, magnet_params['angle'], MU_0)
+
+    cuts = {'vs_x': ((-0.1, 0.0), (0.1, 0.0)), 'vs_y': ((0.0, -0.1), (0.0, 0.1))}
+    arrays, meta = {}, {'params': {'coil': coil_params, 'magnet': magnet_params, 'moment': moment,
+                                   'surface': surface}}
+    # The coil B_y vs y cut is taken slightly off axis, as in compare_fields.js
+    for name, obj, profiles in (('coil', coil, dict(cuts, By_vs_y=((0.001, -0.1), (0.001, 0.1)))),
+                                ('magnet', magnet, cuts)):
+        obj_arrays, obj_meta = MagneticFieldSimulation([obj]).snapshot(profiles, n)
+        arrays.update({f'{name}/{key}': value for key, value in obj_arrays.items()})
+        meta[name] = obj_meta
+    return write_arrays(path, arrays, meta)
+
+
+
+def load_data(path):
+    """Plot data (the compare_data.json layout) from a JSON file or a snapshot."""
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    from fieldfile import FieldFile
+    snapshot = FieldFile(path)
+    data = {'params': snapshot.meta['params'], 'xValues': snapshot['coil/vs_x/x'],
+            'yValues': snapshot['coil/vs_y/y']}
+    for name in ('coil', 'magnet'):
+        data[name] = {'Bx_vs_x': snapshot[f'{name}/vs_x/Bx'], 'By_vs_x': snapshot[f'{name}/vs_x/By'],
+                      'Bx_vs_y': snapshot[f'{name}/vs_y/Bx'], 'By_vs_y': snapshot[f'{name}/vs_y/By']}
+        if f'{name}/By_vs_y/By' in snapshot:
+            data[name]['By_vs_y'] = snapshot[f'{name}/By_vs_y/By']
+    return data
+
+
+
+parser = argparse.ArgumentParser(description='Plot the Coil vs Magnet field comparison.')
+parser.add_argument('path', nargs='?', default=None,
+                    help='compare_data.json (default) or a snapshot file')
+parser.add_argument('--python', action='store_true',
+                    help='compute the data with the Python classes into a snapshot (compare_data.emf)')
+args = parser.parse_args()
+
+if args.python:
+    generate_snapshot(args.path or 'compare_data.emf')
+data = load_data(args.path or ('compare_data.emf' if args.python else 'compare_data.json'))
 
 # Extract data
 xValues = np.array(data['xValues'])
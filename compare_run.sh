@@ -22,4 +22,5 @@ else
     exit 1
 fi
 
-# bash compare_run.sh
\ No newline at end of file
+# bash compare_run.sh
+# python3 compare_plots.py --python    (same plots from the Python classes, no node needed)
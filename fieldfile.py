@@ -0,0 +1,145 @@
+"""
+Self-describing on-disk field files backed by memory-mapped arrays.
+
+Layout:
+    8 bytes   magic b'EMFIELD1'
+    8 bytes   header length (little-endian uint64)
+    header    UTF-8 JSON: metadata and, for each array, dtype, shape, offset
+    data      raw C-ordered arrays, each aligned on 64 bytes
+
+The arrays are opened with np.memmap, so a file can be reopened without
+recomputing and a subregion can be sliced without reading the whole grid.
+write_arrays() stores any set of in-memory arrays the same way, e.g. the
+grids and line profiles of MagneticFieldSimulation.save_snapshot().
+"""
+
+import json
+import struct
+import numpy as np
+
+
+
+MAGIC = b'EMFIELD1'
+ALIGN = 64
+
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+
+class FieldFile:
+    """
+    Field file opened through memory maps.
+
+    meta: metadata dict (x_range, y_range, resolution, dtype, scene_hash, ...)
+    arrays: dict name -> np.memmap
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a field file (bad magic {magic!r})")
+            (header_length,) = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        self.meta = header['meta']
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if np.prod(shape) == 0:
+                self.arrays[name] = np.empty(shape, dtype=spec['dtype'])
+                continue
+            self.arrays[name] = np.memmap(path, dtype=spec['dtype'], mode=mode,
+                                          offset=spec['offset'], shape=shape)
+
+
+    @classmethod
+    def create(cls, path, arrays, meta):
+        """
+        Create a field file and return it opened in 'r+' mode.
+
+        arrays: dict name -> (shape, dtype), contents are zero-initialised
+        meta: JSON-serialisable metadata
+        """
+        specs = {name: {'dtype': np.dtype(dtype).str, 'shape': [int(n) for n in shape]}
+                 for name, (shape, dtype) in arrays.items()}
+
+        # The offsets depend on the header length, which depends on the offsets
+        header_length = 0
+        while True:
+            offset = _aligned(len(MAGIC) + 8 + header_length)
+            for spec in specs.values():
+                spec['offset'] = offset
+                offset = _aligned(offset + int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize)
+            header = json.dumps({'meta': meta, 'arrays': specs}).encode('utf-8')
+            if len(header) <= header_length:
+                break
+            header_length = len(header) + 64
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', header_length))
+            f.write(header.ljust(header_length))
+            f.truncate(offset)
+
+        return cls(path, mode='r+')
+
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+
+    @property
+    def x(self):
+        return self.arrays['x']
+
+
+    @property
+    def y(self):
+        return self.arrays['y']
+
+
+    def region(self, x_range, y_range, names=('Bx', 'By')):
+        """
+        Slice a subregion of the grid without loading the rest of it.
+
+        Returns x, y coordinate vectors of the region and a dict of views
+        of the requested grid arrays.
+        """
+        x = np.asarray(self.x)
+        y = np.asarray(self.y)
+        cols = slice(np.searchsorted(x, x_range[0], side='left'), np.searchsorted(x, x_range[1], side='right'))
+        rows = slice(np.searchsorted(y, y_range[0], side='left'), np.searchsorted(y, y_range[1], side='right'))
+        return x[cols], y[rows], {name: self.arrays[name][rows, cols] for name in names}
+
+
+    def flush(self):
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+
+
+def write_arrays(path, arrays, meta):
+    """
+    Field file holding in-memory arrays (dict name -> array) and JSON
+    metadata, returned reopened read-only (memory-mapped).
+    """
+    arrays = {name: np.asarray(array) for name, array in arrays.items()}
+    file = FieldFile.create(path, {name: (array.shape, array.dtype) for name, array in arrays.items()}, meta)
+    for name, array in arrays.items():
+        if array.size:
+            file[name][...] = array
+    file.flush()
+    del file
+    return FieldFile(path)
@@ -0,0 +1,127 @@
+/**
+ * Client of the local Python field server (server.py): the scene is sent as
+ * JSON, the Bx/By/Az grids come back as binary float32 frames.
+ *
+ * Frame layout (little endian): magic 'MFLD', format u8, nFields u8,
+ * reserved u16, version u32, ny u32, nx u32, xMin xMax yMin yMax f64,
+ * nFields 4-byte names, then each field as ny × nx float32, row-major.
+ */
+
+const MAGIC = 'MFLD';
+const HEADER_SIZE = 52;
+
+export function decodeFrame(buffer) {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== MAGIC) {
+    throw new Error(`Not a field frame (magic ${magic})`);
+  }
+  const nFields = view.getUint8(5);
+  const version = view.getUint32(8, true);
+  const ny = view.getUint32(12, true);
+  const nx = view.getUint32(16, true);
+  const xRange = [view.getFloat64(20, true), view.getFloat64(28, true)];
+  const yRange = [view.getFloat64(36, true), view.getFloat64(44, true)];
+
+  const fields = {};
+  let offset = HEADER_SIZE + 4 * nFields;
+  for (let k = 0; k < nFields; k++) {
+    const name = String.fromCharCode(...new Uint8Array(buffer, HEADER_SIZE + 4 * k, 4)).trim();
+    fields[name] = new Float32Array(buffer, offset, nx * ny);
+    offset += 4 * nx * ny;
+  }
+  return { version, nx, ny, xRange, yRange, fields };
+}
+
+function frameSize(bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, HEADER_SIZE);
+  const nFields = view.getUint8(5);
+  return HEADER_SIZE + 4 * nFields + 4 * nFields * view.getUint32(12, true) * view.getUint32(16, true);
+}
+
+// Frontend objects as the parameter dicts of the Python objects (to_dict format)
+export function toScene(objects) {
+  return objects.map((obj) => {
+    switch (obj.type) {
+      case 'coil':
+        return { type: 'coil', x: obj.x, y: obj.y, radius: obj.radius, length: obj.length,
+                 n_turns: obj.nTurns, current: obj.current, mu: obj.mu };
+      case 'magnet':
+        return { type: 'extended_magnet', x: obj.x, y: obj.y, radius: obj.radius, length: obj.length,
+                 n_x: obj.n_x, n_y: obj.n_y, moment: obj.moment, angle: obj.angle, mu: obj.mu };
+      case 'dipole':
+        // The Python point magnet is aligned with y
+        if (Math.abs(Math.cos(obj.angle * Math.PI / 180)) > 1e-12) {
+          throw new Error('Only dipoles along y can be sent to the field server');
+        }
+        return { type: 'magnet', x: obj.x, y: obj.y, moment: obj.moment * Math.sin(obj.angle * Math.PI / 180),
+                 mu: obj.mu };
+      case 'measurementCoil':
+        return { type: 'measurement_coil', x: obj.x, y: obj.y, radius: obj.radius, length: obj.length,
+                 n_turns: obj.nTurns, resistance: obj.resistance };
+      case 'rope':
+        return { type: 'rope', y: obj.y, length: obj.length, density: obj.density,
+                 dipole_moment: obj.dipoleMoment, mu: obj.mu, tension: obj.tension,
+                 line_mass_density: obj.lineMassDensity, damping: obj.damping,
+                 angle: obj.dipoles.map((d) => d.angle),
+                 displacement: obj.displacement ? Array.from(obj.displacement) : undefined };
+      default:
+        throw new Error(`Unknown object type ${obj.type}`);
+    }
+  });
+}
+
+// Send a new scene; older scenes still computing are cancelled by the server
+export async function postScene(url, objects, xRange, yRange, resolution, fields = ['Bx', 'By']) {
+  const response = await fetch(`${url}/scene`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ objects: toScene(objects), x_range: xRange, y_range: yRange, resolution, fields }),
+  });
+  if (!response.ok) {
+    throw new Error(`Field server: ${(await response.json()).error}`);
+  }
+  return (await response.json()).version;
+}
+
+// Decoded frames of the server stream, as they are computed
+export async function* streamFrames(url, signal) {
+  const response = await fetch(`${url}/stream`, { signal });
+  const reader = response.body.getReader();
+  let pending = new Uint8Array(0);
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) return;
+    const joined = new Uint8Array(pending.length + value.length);
+    joined.set(pending);
+    joined.set(value, pending.length);
+    pending = joined;
+
+    while (pending.length >= HEADER_SIZE && pending.length >= frameSize(pending)) {
+      const size = frameSize(pending);
+      yield decodeFrame(pending.slice(0, size).buffer);
+      pending = pending.slice(size);
+    }
+  }
+}
+
+// Frame as the nested [{x, y, Bx, By}] rows of MagneticFieldSimulation.computeField
+export function toFieldGrid(frame) {
+  const { nx, ny, xRange, yRange, fields } = frame;
+  const xStep = (xRange[1] - xRange[0]) / (nx - 1);
+  const yStep = (yRange[1] - yRange[0]) / (ny - 1);
+  const grid = [];
+  for (let i = 0; i < ny; i++) {
+    const row = [];
+    for (let j = 0; j < nx; j++) {
+      const point = { x: xRange[0] + j * xStep, y: yRange[0] + i * yStep };
+      for (const name in fields) {
+        point[name] = fields[name][i * nx + j];
+      }
+      row.push(point);
+    }
+    grid.push(row);
+  }
+  return grid;
+}
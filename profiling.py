@@ -0,0 +1,217 @@
+"""
+Optional instrumentation of the field computations.
+
+The kernels and MagneticFieldSimulation mark their phases with phase() and
+their work with count(). Both check a single module-level variable: without
+an active Profile, phase() returns a shared no-op context manager and
+count() returns at once, so the instrumentation costs well under a
+microsecond per kernel call (kernels are called once per object group and
+chunk, never per point).
+
+Usage:
+    with Profile() as profile:
+        sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 500)
+    print(profile.report())
+    profile.to_json('profile.json')
+
+Phases nest: their names are paths such as 'compute_field/field/Coil/coil_field/special'.
+For each phase the profile records the number of calls, the wall time, the
+number of points evaluated and, with memory=True, the peak bytes allocated
+by numpy temporaries above the memory in use when the phase started
+(through tracemalloc, which slows allocations while the profile is active).
+
+Work done in process pool workers is not recorded. With thread workers,
+phases are attributed per thread but memory peaks are process-wide.
+"""
+
+import functools
+import inspect
+import json
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+import numpy as np
+
+
+
+# Active Profile, or None when profiling is disabled
+_active = None
+
+
+
+class _NullPhase:
+    """No-op context manager returned by phase() when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+
+_NULL_PHASE = _NullPhase()
+
+
+
+def phase(name, points=0):
+    """Context manager timing a phase of the active profile (no-op without one)."""
+    if _active is None:
+        return _NULL_PHASE
+    return _Phase(_active, name, points)
+
+
+
+def count(name, n=1):
+    """Add n to a counter of the active profile (no-op without one)."""
+    if _active is not None:
+        _active.add(name, n)
+
+
+
+def profiled(name, points=None):
+    """
+    Decorator running a function inside phase(name). points: name of the
+    argument whose size is the number of points evaluated.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            n = 0
+            if points is not None:
+                arguments = signature.bind(*args, **kwargs).arguments
+                n = _size(arguments.get(points))
+            with _Phase(_active, name, n):
+                return function(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+
+def _size(value):
+    return 0 if value is None else int(np.size(value))
+
+
+
+class _Phase:
+    __slots__ = ('profile', 'name', 'points', 'path', 'start', 'memory', 'peak')
+
+    def __init__(self, profile, name, points):
+        self.profile = profile
+        self.name = name
+        self.points = points
+
+    def __enter__(self):
+        stack = self.profile._stack()
+        self.path = f"{stack[-1].path}/{self.name}" if stack else self.name
+        if self.profile.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.memory = current
+            self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.profile._stack()
+        stack.pop()
+        allocated = 0
+        if self.profile.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            allocated = self.peak - self.memory
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+            tracemalloc.reset_peak()
+        self.profile.record(self.path, elapsed, self.points, allocated)
+        return False
+
+
+
+class Profile:
+    """
+    Profile of the field computations run inside its context.
+
+    memory: also record the peak temporary bytes of every phase
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'points': 0, 'peak_bytes': 0})
+        self.counters = defaultdict(int)
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._previous = None
+        self._started_tracing = False
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record(self, path, seconds, points=0, peak_bytes=0):
+        with self._lock:
+            entry = self.phases[path]
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['points'] += points
+            entry['peak_bytes'] = max(entry['peak_bytes'], peak_bytes)
+
+    def add(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def __enter__(self):
+        global _active
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._previous = _active
+        _active = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self.seconds += time.perf_counter() - self._start
+        _active = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def stats(self):
+        """Structured report: total wall time, phases (by path) and counters."""
+        return {
+            'seconds': self.seconds,
+            'phases': {path: dict(entry) for path, entry in sorted(self.phases.items())},
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=1)
+
+    def report(self):
+        """Text table of the phases and counters."""
+        lines = [f"{'phase':<60} {'calls':>7} {'time [ms]':>11} {'points':>12} {'peak [MiB]':>11}"]
+        for path, entry in sorted(self.phases.items()):
+            lines.append(f"{path:<60} {entry['calls']:>7} {entry['seconds'] * 1e3:>11.2f} "
+                         f"{entry['points']:>12} {entry['peak_bytes'] / 2**20:>11.2f}")
+        lines.append(f"\n{'counter':<60} {'count':>12}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<60} {value:>12}")
+        lines.append(f"\ntotal {self.seconds * 1e3:.2f} ms")
+        return '\n'.join(lines)
@@ -0,0 +1,255 @@
+"""
+Headless batch rendering of field animations.
+
+The figure, quiver, colorbar and object patches are created once on the
+Agg canvas (no pyplot, no display). Every frame only updates the quiver
+with set_UVC (and the background image with set_data) and redraws, which
+is much cheaper than building a new figure per frame.
+
+Frames go to a writer:
+    PNGSequence: numbered PNG files, written by the workers themselves
+    EncoderPipe: raw RGBA frames piped in order to an encoder process
+                 (e.g. ffmpeg_command(...))
+
+Usage:
+    sim.compute_basis(x_range, y_range, resolution)
+    frames = sim.stream_frames(currents)
+    with PNGSequence('frames') as writer:
+        render_frames(frames, sim.X, sim.Y, writer, objects=sim.objects, workers=4)
+"""
+
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.image import imsave
+from matplotlib.patches import Rectangle
+from profiling import phase
+
+
+
+def draw_objects(ax, objects, color='#58a6ff', center_color='#f78166'):
+    """
+    Outline of the objects with a size (coils, magnets) and a mark at their
+    center. Ropes, which have no center, are drawn as the line of their dipoles.
+    """
+    for obj in objects:
+        if not hasattr(obj, 'x'):
+            px, py, _, _ = obj.dipoles()
+            ax.plot(px, py, '-', color=center_color, linewidth=2)
+            continue
+        if hasattr(obj, 'radius') and hasattr(obj, 'length'):
+            ax.add_patch(Rectangle((obj.x - obj.radius, obj.y - obj.length / 2), 2 * obj.radius, obj.length,
+                                   fill=False, edgecolor=color, linewidth=2, linestyle='--'))
+        ax.plot(obj.x, obj.y, 'o', color=center_color, markersize=8)
+
+
+
+class FieldRenderer:
+    """
+    Reusable figure drawing (Bx, By) frames on the grid X, Y, in the style
+    of MagneticFieldSimulation.plot_arrows.
+
+    objects: objects outlined on the figure (drawn once)
+    step: draw one arrow every step grid points
+    background: also show log10|B| as an image behind the arrows
+    clim: (min, max) of log10|B| for the colours, fixed for all frames so
+        that they are comparable (default: rescaled on every frame)
+    """
+
+    def __init__(self, X, Y, objects=(), figsize=(12, 8), dpi=100, step=1, background=False, clim=None,
+                 title='Magnetic Field Simulation'):
+        self.step = step
+        self.clim = clim
+        X = np.asarray(X)[::step, ::step]
+        Y = np.asarray(Y)[::step, ::step]
+        zeros = np.zeros(X.shape)
+
+        self.figure = Figure(figsize=figsize, dpi=dpi, facecolor='#0d1117')
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        ax.set_facecolor('#0d1117')
+
+        self.image = None
+        if background:
+            self.image = ax.imshow(zeros, origin='lower', cmap='plasma', alpha=0.35, aspect='auto',
+                                   extent=(X.min(), X.max(), Y.min(), Y.max()))
+
+        self.quiver = ax.quiver(X, Y, zeros, zeros, zeros, cmap='plasma', scale=25, width=0.004,
+                                headwidth=4, headlength=5, alpha=0.9)
+        if clim is not None:
+            self.quiver.set_clim(*clim)
+
+        cbar = self.figure.colorbar(self.quiver, ax=ax, shrink=0.8, pad=0.02)
+        cbar.set_label('log₁₀(|B|) [T]', color='white', fontsize=11)
+        cbar.ax.yaxis.set_tick_params(color='white', labelcolor='white')
+
+        draw_objects(ax, objects)
+
+        ax.set_xlabel('x [m]', color='white', fontsize=12)
+        ax.set_ylabel('y [m]', color='white', fontsize=12)
+        ax.set_title(title, color='white', fontsize=14, pad=15)
+        ax.tick_params(colors='white')
+        ax.set_aspect('equal')
+        for spine in ax.spines.values():
+            spine.set_color('#30363d')
+        ax.grid(True, alpha=0.2, color='#30363d')
+        self.figure.tight_layout()
+
+    @property
+    def size(self):
+        """(width, height) of the frames in pixels."""
+        return self.canvas.get_width_height()
+
+    def update(self, Bx, By):
+        """Set the arrows and colours of a new frame, without drawing."""
+        Bx = np.asarray(Bx)[::self.step, ::self.step]
+        By = np.asarray(By)[::self.step, ::self.step]
+        B_mag = np.maximum(np.sqrt(Bx**2 + By**2), 1e-20)
+        magnitude_log = np.log10(B_mag)
+
+        self.quiver.set_UVC(Bx / B_mag, By / B_mag, magnitude_log)
+        if self.clim is None:
+            self.quiver.set_clim(magnitude_log.min(), magnitude_log.max())
+        if self.image is not None:
+            self.image.set_data(magnitude_log)
+            self.image.set_clim(*self.quiver.get_clim())
+
+    def render(self, Bx, By):
+        """Draw a frame and return its pixels, (height, width, 4) uint8 RGBA."""
+        with phase('render'):
+            self.update(Bx, By)
+            self.canvas.draw()
+            return np.asarray(self.canvas.buffer_rgba())
+
+    def save(self, path, Bx, By):
+        """Draw a frame to a PNG file."""
+        imsave(path, self.render(Bx, By))
+
+
+
+class PNGSequence:
+    """Numbered PNG files in directory. Picklable, so workers write their own frames."""
+
+    parallel = True
+
+    def __init__(self, directory, pattern='frame_{:05d}.png'):
+        self.directory = directory
+        self.pattern = pattern
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, index):
+        return os.path.join(self.directory, self.pattern.format(index))
+
+    def write(self, index, rgba):
+        imsave(self.path(index), rgba)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class EncoderPipe:
+    """
+    Raw RGBA frames written in order to the standard input of an encoder
+    process, e.g. EncoderPipe(ffmpeg_command('out.mp4', *renderer.size)).
+    """
+
+    parallel = False
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, index, rgba):
+        self.process.stdin.write(np.ascontiguousarray(rgba).tobytes())
+
+    def close(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"encoder {self.command[0]} exited with status {self.process.returncode}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def ffmpeg_command(path, width, height, fps=30, codec='libx264'):
+    """ffmpeg command encoding raw RGBA frames of width × height from stdin to path."""
+    return ['ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', codec, '-pix_fmt', 'yuv420p', path]
+
+
+
+# Renderer of a worker process, built once by _init_worker
+_worker_renderer = None
+
+
+
+def _init_worker(X, Y, objects, options):
+    global _worker_renderer
+    _worker_renderer = FieldRenderer(X, Y, objects, **options)
+
+
+
+def _render_frame(task):
+    index, (Bx, By), writer = task
+    rgba = _worker_renderer.render(Bx, By)
+    if writer is not None:
+        writer.write(index, rgba)
+        return None
+    return rgba.copy()
+
+
+
+def render_frames(frames, X, Y, writer, objects=(), workers=None, **options):
+    """
+    Render an iterable of (Bx, By) frames (e.g. stream_frames) to writer.
+
+    workers: number of worker processes, each with its own FieldRenderer
+        (default: render in this process). Frames are dispatched in
+        batches, so a long generator is never held in memory.
+        PNGSequence frames are written by the workers; frames for an
+        EncoderPipe are sent back and written in order.
+    options: FieldRenderer options (figsize, dpi, step, background, clim, title)
+
+    Returns the number of frames rendered.
+    """
+    frames = iter(frames)
+    count = 0
+
+    if not workers or workers <= 1:
+        renderer = FieldRenderer(X, Y, objects, **options)
+        for index, (Bx, By) in enumerate(frames):
+            writer.write(index, renderer.render(Bx, By))
+            count += 1
+        return count
+
+    in_worker = writer if writer.parallel else None
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(X, Y, list(objects), options)) as pool:
+        while True:
+            batch = list(islice(frames, 4 * workers))
+            if not batch:
+                break
+            tasks = [(count + j, (np.asarray(Bx), np.asarray(By)), in_worker) for j, (Bx, By) in enumerate(batch)]
+            for index, rgba in zip(range(count, count + len(batch)), pool.map(_render_frame, tasks)):
+                if rgba is not None:
+                    writer.write(index, rgba)
+            count += len(batch)
+
+    return count
@@ -0,0 +1,249 @@
+"""
+Rope of magnetic dipoles with string dynamics, as the frontend Rope
+(frontend/src/physics/objects.js), integrated implicitly.
+
+The transverse displacement u(x, t) solves the damped wave equation
+
+    ρ ∂²u/∂t² = T ∂²u/∂x² - γ ∂u/∂t + f(x, t),    u(0, t) = u(L, t) = 0
+
+with the magnetic force per unit length f = density · ∂(m·B)/∂y.
+
+The frontend integrates it explicitly, with substeps bounded by the CFL
+condition dt < dx / c (thousands per frame for the default rope). Here it
+is discretised with the θ-method on (u, v = ∂u/∂t). Eliminating v, every
+step is one symmetric tridiagonal system
+
+    [a I - θ dt T D] u' = a u + (ρ/θ) v + (1-θ) dt T D u + dt f,   a = (ρ + θ dt γ) / (θ dt)
+    v' = (u' - u) / (θ dt) - (1-θ)/θ v
+
+D being the second difference matrix. θ = 1/2 is Crank-Nicolson: second
+order, and conserving the discrete energy when γ = 0. θ = 1 is backward
+Euler: first order, but it damps the modes that dt does not resolve, which
+Crank-Nicolson leaves ringing. Both are unconditionally stable, so a step
+costs O(n) for any dt. The force is evaluated explicitly at the start of
+each step.
+"""
+
+import numpy as np
+from scipy.linalg import solve_banded
+from functions import dipole_sum, dipole_gradient, dipole_potential, dipole_field_3d
+from simulation import MagneticFieldSimulation
+
+
+
+class Rope:
+    """
+    Horizontal rope centered on x = 0 at height y, modelled as density
+    dipoles per meter of moment dipole_moment.
+
+    tension: rope tension (N)
+    line_mass_density: mass per unit length (kg/m)
+    damping: damping coefficient (kg/(m·s))
+
+    As in the frontend, the dipoles sit at the centers of n = length ·
+    density cells, the two end dipoles are clamped and the dipoles align
+    with the external field in update_alignment().
+    """
+
+    def __init__(self, y, length=0.3, density=500, dipole_moment=1e-6, mu=4*np.pi*1e-7,
+                 tension=70, line_mass_density=3.5e-3, damping=0.5, memory_budget=64 * 2**20):
+        self.y = y
+        self.length = length
+        self.density = density
+        self.dipole_moment = dipole_moment
+        self.mu = mu
+        self.tension = tension
+        self.line_mass_density = line_mass_density
+        self.damping = damping
+        self.memory_budget = memory_budget
+        self._matrix = None
+
+        n = max(1, round(length * density))
+        self.px = -length / 2 + (np.arange(n) + 0.5) * length / n
+        self.angle = np.zeros(n)            # dipole angles (degrees)
+        self.reset_mechanics()
+
+    @property
+    def n(self):
+        return self.px.size
+
+    @property
+    def dx(self):
+        return self.length / self.n
+
+    def reset_mechanics(self):
+        self.displacement = np.zeros(self.n)
+        self.velocity = np.zeros(self.n)
+        self.time = 0.0
+
+    def dipoles(self):
+        """Positions and moments (px, py, mx, my) of the dipoles."""
+        angle = np.deg2rad(self.angle)
+        return (self.px, self.y + self.displacement,
+                self.dipole_moment * np.cos(angle), self.dipole_moment * np.sin(angle))
+
+    def field(self, x, y):
+        """Calculate magnetic field (Bx, By) at given points, summed over the dipoles."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        Bx, By = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget)
+        return Bx.reshape(shape), By.reshape(shape)
+
+    def field_gradient(self, x, y):
+        """Calculate the field derivatives (∂Bx/∂x, ∂Bx/∂y, ∂By/∂x, ∂By/∂y) at given points."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        gradient = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget, kernel=dipole_gradient)
+        return tuple(g.reshape(shape) for g in gradient)
+
+    def potential(self, x, y):
+        """Calculate the vector potential Az at given points, summed over the dipoles."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        (Az,) = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget,
+                           kernel=lambda *args: (dipole_potential(*args),))
+        return Az.reshape(shape)
+
+    def field_y(self, x, y, z):
+        """Field By at 3D points, z being the distance to the simulation plane."""
+        x, y, z = (np.asarray(v, dtype=float) for v in np.broadcast_arrays(x, y, z))
+        _, By, _ = dipole_sum(*self.dipoles(), self.mu, x.ravel(), y.ravel(), self.memory_budget,
+                              kernel=dipole_field_3d, z=z.ravel())
+        return By.reshape(x.shape)
+
+    def distance(self, x, y):
+        """Distance from the points to the rope."""
+        y_rope = self.y + np.interp(x, self.px, self.displacement)
+        return np.hypot(np.maximum(np.abs(x) - self.length / 2, 0), y - y_rope)
+
+    def to_dict(self):
+        """Defining parameters and mechanical state of the rope (JSON-serialisable)."""
+        return {'type': 'rope', 'y': self.y, 'length': self.length, 'density': self.density,
+                'dipole_moment': self.dipole_moment, 'mu': self.mu, 'tension': self.tension,
+                'line_mass_density': self.line_mass_density, 'damping': self.damping,
+                'angle': self.angle.tolist(), 'displacement': self.displacement.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rope from the parameters and state of to_dict()."""
+        data = dict(data)
+        angle, displacement = data.pop('angle', None), data.pop('displacement', None)
+        rope = cls(**{name: value for name, value in data.items() if name != 'type'})
+        if angle is not None:
+            rope.angle = np.array(angle, dtype=float)
+        if displacement is not None:
+            rope.displacement = np.array(displacement, dtype=float)
+        return rope
+
+
+    def _sources(self, sim):
+        """Simulation of every object of sim but the rope itself."""
+        return MagneticFieldSimulation([obj for obj in sim.objects if obj is not self], sim.memory_budget,
+                                       backend=sim.backend)
+
+    def update_alignment(self, sim):
+        """Align every dipole with the field of the other objects of sim."""
+        _, py, _, _ = self.dipoles()
+        Bx, By = self._sources(sim).field(self.px, py)
+        aligned = np.hypot(Bx, By) > 1e-15
+        self.angle = np.where(aligned, np.rad2deg(np.arctan2(By, Bx)), self.angle)
+
+    def magnetic_force(self, sim):
+        """
+        Force per unit length density · ∂(m·B)/∂y on every dipole, from the
+        analytic field gradient of the other objects. Zero at the clamped ends.
+        """
+        _, py, mx, my = self.dipoles()
+        _, dBx_dy, _, dBy_dy = self._sources(sim).gradient(self.px, py)
+
+        force = (mx * dBx_dy + my * dBy_dy) * self.density
+        force[[0, -1]] = 0.0
+        return force
+
+
+    def _banded_matrix(self, dt, theta):
+        """Banded form of the θ-method matrix on interior nodes, cached per (dt, θ)."""
+        key = (dt, theta, self.n, self.dx, self.tension, self.line_mass_density, self.damping)
+        if self._matrix is None or self._matrix[0] != key:
+            m = self.n - 2
+            diag = (self.line_mass_density + theta * dt * self.damping) / (theta * dt)
+            off = theta * dt * self.tension / self.dx**2
+            ab = np.empty((3, m))
+            ab[0] = -off
+            ab[1] = diag + 2 * off
+            ab[2] = -off
+            self._matrix = (key, ab)
+        return self._matrix[1]
+
+    def step(self, sim, dt, force=None, theta=0.5):
+        """
+        Advance the rope by dt with one θ-method step.
+
+        force: force per unit length (default: magnetic_force(sim))
+        theta: 0.5 for Crank-Nicolson, 1 for backward Euler
+        """
+        if self.n < 3 or dt <= 0:
+            return
+        if not 0.5 <= theta <= 1:
+            raise ValueError(f"theta must be in [0.5, 1] for stability, got {theta}")
+        if force is None:
+            force = self.magnetic_force(sim)
+
+        u, v = self.displacement, self.velocity
+        rho, gamma = self.line_mass_density, self.damping
+        Du = np.zeros(self.n)
+        Du[1:-1] = (u[2:] - 2 * u[1:-1] + u[:-2]) / self.dx**2
+
+        inner = slice(1, -1)
+        rhs = ((rho + theta * dt * gamma) / (theta * dt) * u[inner] + rho / theta * v[inner]
+               + (1 - theta) * dt * self.tension * Du[inner] + dt * force[inner])
+
+        u_new = np.zeros(self.n)
+        u_new[inner] = solve_banded((1, 1), self._banded_matrix(dt, theta), rhs,
+                                    overwrite_b=True, check_finite=False)
+        self.velocity = (u_new - u) / (theta * dt) - (1 - theta) / theta * v
+        self.velocity[[0, -1]] = 0.0
+        self.displacement = u_new
+        self.time += dt
+
+    def run(self, sim, duration, dt, record_every=1, force_every=1, align=True, theta=0.5):
+        """
+        Integrate the rope over duration (s) with time step dt.
+
+        record_every: keep the displacement every record_every steps
+        force_every: re-evaluate the magnetic force (and alignment) every
+            force_every steps, the field evaluation being the costly part
+        align: update the dipole alignment before each force evaluation
+        theta: time scheme of step()
+
+        Returns times (T,) and displacements (T, n), starting with the
+        initial state.
+        """
+        n_steps = int(round(duration / dt))
+        times = [self.time]
+        displacements = [self.displacement.copy()]
+        force = None
+
+        for step in range(n_steps):
+            if step % force_every == 0:
+                if align:
+                    self.update_alignment(sim)
+                force = self.magnetic_force(sim)
+            self.step(sim, dt, force, theta)
+            if (step + 1) % record_every == 0:
+                times.append(self.time)
+                displacements.append(self.displacement.copy())
+
+        return np.array(times), np.array(displacements)
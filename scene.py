@@ -0,0 +1,150 @@
+"""
+Scene files and a headless command line for simulations.
+
+A scene file (JSON or TOML) holds the objects in their to_dict() format,
+the domain and the resolution, the same fields as a request of server.py:
+
+    x_range = [-0.20, 0.20]
+    y_range = [-0.15, 0.35]
+    resolution = 50
+    fields = ["Bx", "By"]            # optional, add "Az" for the potential
+
+    [[objects]]
+    type = "coil"
+    x = -0.05
+    ...
+
+Plotting is only imported when an image is requested, and rendered on the
+Agg canvas unless --show is given, so batch jobs neither load matplotlib
+nor need a display.
+
+Usage:
+    python scene.py scenes/example.toml --out field.emf       # field file (fieldfile.py)
+    python scene.py scenes/example.toml --out field.npz       # numpy archive
+    python scene.py scenes/example.toml --plot lines --image images/lines.png
+    python scene.py scenes/example.toml --plot arrows --show
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+from simulation import MagneticFieldSimulation, object_from_dict
+
+
+
+FIELDS = ('Bx', 'By', 'Az')
+
+
+
+def parse_scene(data):
+    """Validated scene from a dict (ValueError if malformed); objects stay dicts."""
+    try:
+        scene = {'objects': list(data['objects']),
+                 'x_range': tuple(float(v) for v in data['x_range']),
+                 'y_range': tuple(float(v) for v in data['y_range']),
+                 'resolution': int(data.get('resolution', 100)),
+                 'fields': list(data.get('fields', ['Bx', 'By']))}
+        for obj in scene['objects']:
+            object_from_dict(obj)
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid scene: {error}") from error
+    if len(scene['x_range']) != 2 or len(scene['y_range']) != 2:
+        raise ValueError("x_range and y_range must be [min, max]")
+    if scene['resolution'] < 2:
+        raise ValueError("resolution must be at least 2")
+    if not scene['fields'] or any(name not in FIELDS for name in scene['fields']):
+        raise ValueError(f"fields must be a non-empty subset of {list(FIELDS)}")
+    return scene
+
+
+
+def load_scene(path):
+    """Scene of a .json or .toml file."""
+    path = os.fspath(path)
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return parse_scene(tomllib.load(f))
+    with open(path, 'r') as f:
+        return parse_scene(json.load(f))
+
+
+
+def save_scene(path, objects, x_range, y_range, resolution=100, fields=('Bx', 'By')):
+    """Write objects (instances or to_dict() dicts) and the grid as a JSON scene file."""
+    scene = {'objects': [obj if isinstance(obj, dict) else obj.to_dict() for obj in objects],
+             'x_range': list(x_range), 'y_range': list(y_range), 'resolution': resolution,
+             'fields': list(fields)}
+    parse_scene(scene)
+    with open(path, 'w') as f:
+        json.dump(scene, f, indent=2)
+
+
+
+def run_scene(scene, **kwargs):
+    """
+    Simulation of a scene with its requested fields computed on the grid.
+    kwargs: MagneticFieldSimulation.compute_field options (workers, tiles, ...)
+    """
+    sim = MagneticFieldSimulation([object_from_dict(obj) for obj in scene['objects']],
+                                  backend=kwargs.pop('backend', None))
+    grid = (scene['x_range'], scene['y_range'], scene['resolution'])
+    if 'Bx' in scene['fields'] or 'By' in scene['fields']:
+        sim.compute_field(*grid, **kwargs)
+    if 'Az' in scene['fields']:
+        sim.compute_potential(*grid)
+    return sim
+
+
+
+def write_output(sim, scene, path):
+    """Computed grids to a .npz archive, or to a field file (snapshot) for any other extension."""
+    if os.fspath(path).endswith('.npz'):
+        arrays, _ = sim.snapshot()
+        np.savez(path, **{name: arrays[name] for name in ('x', 'y', *scene['fields'])})
+    else:
+        sim.save_snapshot(path, meta={'x_range': scene['x_range'], 'y_range': scene['y_range'],
+                                      'resolution': scene['resolution']})
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the field of a scene file (JSON or TOML).')
+    parser.add_argument('scene', help='scene file, .json or .toml')
+    parser.add_argument('--out', '-o', help='write the grids to a .npz archive or a field file')
+    parser.add_argument('--plot', choices=('lines', 'arrows'), help='render an image of the field')
+    parser.add_argument('--image', help='image path (default images/magnetic_field_<plot>.png)')
+    parser.add_argument('--show', action='store_true', help='open the figure in a window')
+    parser.add_argument('--resolution', type=int, help='override the resolution of the scene')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default=None)
+    args = parser.parse_args(argv)
+
+    scene = load_scene(args.scene)
+    if args.resolution is not None:
+        scene['resolution'] = args.resolution
+    if args.plot and not {'Bx', 'By'} & set(scene['fields']):
+        scene['fields'] = ['Bx', 'By'] + scene['fields']
+    sim = run_scene(scene, workers=args.workers, backend=args.backend)
+
+    if args.out:
+        write_output(sim, scene, args.out)
+    if args.plot:
+        if not args.show:
+            import matplotlib
+            matplotlib.use('Agg')
+        image = args.image or f'images/magnetic_field_{args.plot}.png'
+        if os.path.dirname(image):
+            os.makedirs(os.path.dirname(image), exist_ok=True)
+        getattr(sim, f'plot_{args.plot}')(save_path=image, show=args.show)
+    return sim
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Local field server for the frontend: scenes in, binary float32 grids out.
+
+Plain HTTP/1.1 on asyncio (standard library only), bound to localhost:
+
+    POST /scene    scene request (JSON, below) -> 202 {"version": v}. It
+                   replaces the current scene; the computation of any
+                   older scene still in flight is cancelled.
+    POST /compute  same, but waits for the frame of that scene
+                   (application/octet-stream), or 409 if a newer scene
+                   superseded it first.
+    GET  /stream   chunked application/octet-stream: one frame per
+                   computed scene. A slow reader only gets the latest one.
+    GET  /stats    JSON counters (scenes, frames, cancelled).
+
+Scene request:
+    {"objects": [obj.to_dict(), ...], "x_range": [x0, x1], "y_range": [y0, y1],
+     "resolution": 200, "fields": ["Bx", "By", "Az"]}
+
+The grid is split in row bands computed on a worker pool (processes by
+default), so a big scene uses every core; a newer scene cancels the bands
+of the older one that have not started yet and discards the others.
+
+Frame (little endian), see encode_frame / decode_frame:
+    magic b'MFLD', version u8 (=1), n_fields u8, reserved u16,
+    scene version u32, ny u32, nx u32, x0 x1 y0 y1 f64,
+    n_fields field names (4 bytes ASCII, space padded),
+    then each field as ny × nx float32, row-major (row i at y = y0 + i dy).
+
+Usage:
+    python server.py --port 8765 --workers 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import scene as scene_file
+from simulation import MagneticFieldSimulation, object_from_dict
+
+
+
+MAGIC = b'MFLD'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBBHIII4d')
+MAX_RESOLUTION = 4096
+MAX_BODY = 16 * 2**20
+
+
+
+def encode_frame(version, x_range, y_range, fields):
+    """Binary frame of the grids fields (dict name -> (ny, nx) array) of a scene version."""
+    names = list(fields)
+    ny, nx = np.shape(fields[names[0]])
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(names), 0, version, ny, nx, *x_range, *y_range)
+    labels = b''.join(name.encode('ascii').ljust(4) for name in names)
+    return header + labels + b''.join(np.asarray(fields[name], dtype='<f4').tobytes() for name in names)
+
+
+
+def decode_frame(data):
+    """(version, x_range, y_range, fields) of a binary frame."""
+    magic, format_version, n_fields, _, version, ny, nx, x0, x1, y0, y1 = HEADER.unpack_from(data)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f"Not a field frame (magic {magic!r}, format {format_version})")
+    offset = HEADER.size
+    names = [data[offset + 4 * k:offset + 4 * k + 4].decode('ascii').strip() for k in range(n_fields)]
+    offset += 4 * n_fields
+    fields = {}
+    for name in names:
+        fields[name] = np.frombuffer(data, dtype='<f4', count=ny * nx, offset=offset).reshape(ny, nx)
+        offset += 4 * ny * nx
+    return version, (x0, x1), (y0, y1), fields
+
+
+
+def frame_size(data):
+    """Total size in bytes of the frame starting with header data."""
+    _, _, n_fields, _, _, ny, nx, *_ = HEADER.unpack_from(data)
+    return HEADER.size + 4 * n_fields + 4 * n_fields * ny * nx
+
+
+
+def parse_scene(body):
+    """Validated scene request from a JSON body (ValueError if malformed), see scene.parse_scene."""
+    try:
+        request = json.loads(body)
+    except ValueError as error:
+        raise ValueError(f"Invalid scene: {error}") from error
+    if not isinstance(request, dict):
+        raise ValueError("Invalid scene: expected a JSON object")
+    scene = scene_file.parse_scene(request)
+    if not 2 <= scene['resolution'] <= MAX_RESOLUTION:
+        raise ValueError(f"resolution must be in [2, {MAX_RESOLUTION}]")
+    return scene
+
+
+
+def _compute_band(objects, x, y, fields):
+    """Requested fields on the rows y of the grid, as float32 (run in the pool workers)."""
+    sim = MagneticFieldSimulation([object_from_dict(d) for d in objects])
+    X, Y = np.meshgrid(x, y)
+    result = {}
+    if 'Bx' in fields or 'By' in fields:
+        result['Bx'], result['By'] = sim.field(X, Y)
+    if 'Az' in fields:
+        result['Az'] = sim.potential(X, Y)
+    return {name: result[name].astype(np.float32) for name in fields}
+
+
+
+class Superseded(Exception):
+    """The scene was replaced by a newer one before its frame was computed."""
+
+
+
+class FieldServer:
+    """
+    Scene state, worker pool and frame broadcasting of the server.
+
+    workers: pool size (default: number of cores)
+    executor: 'process' or 'thread', as compute_field
+    bands: number of row bands per scene (default: 4 per worker)
+    """
+
+    def __init__(self, workers=None, executor='process', bands=None):
+        workers = workers or os.cpu_count()
+        if executor == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        elif executor == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"Unknown executor '{executor}', expected 'thread' or 'process'")
+        self.bands = bands or 4 * workers
+        self.version = 0
+        self.stats = {'scenes': 0, 'frames': 0, 'cancelled': 0}
+        self._task = None
+        self._subscribers = set()
+        self._connections = set()
+
+    def submit(self, scene):
+        """Make scene the current one, cancelling the older one. Returns its task."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            self.stats['cancelled'] += 1
+        self.version += 1
+        self.stats['scenes'] += 1
+        self._task = asyncio.get_running_loop().create_task(self._compute(self.version, scene))
+        # Superseded scenes nobody waits for
+        self._task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._task
+
+    async def _compute(self, version, scene):
+        x = np.linspace(*scene['x_range'], scene['resolution'])
+        y = np.linspace(*scene['y_range'], scene['resolution'])
+        rows = np.array_split(np.arange(len(y)), min(self.bands, len(y)))
+        futures = [asyncio.wrap_future(self.pool.submit(_compute_band, scene['objects'], x, y[band],
+                                                         scene['fields']))
+                   for band in rows]
+        try:
+            results = await asyncio.gather(*futures)
+        except asyncio.CancelledError:
+            # Bands not started yet are dropped from the pool queue
+            for future in futures:
+                future.cancel()
+            raise Superseded(version) from None
+
+        fields = {name: np.concatenate([band[name] for band in results]) for name in scene['fields']}
+        frame = encode_frame(version, scene['x_range'], scene['y_range'], fields)
+        self.stats['frames'] += 1
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(frame)
+        return frame
+
+    def subscribe(self):
+        """Queue receiving the latest frame (older unread frames are dropped)."""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    async def close(self):
+        """Close the open connections (streams) and the pool."""
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        """One HTTP connection: a single request, then close (the stream stays open)."""
+        self._connections.add(asyncio.current_task())
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1].split('?')[0]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                return await _respond(writer, 400, {'error': 'invalid Content-Length'})
+            if length > MAX_BODY:
+                return await _respond(writer, 413, {'error': 'request too large'})
+            body = await reader.readexactly(length) if length else b''
+
+            if method == 'OPTIONS':
+                return await _respond(writer, 204, None)
+            if method == 'POST' and path in ('/scene', '/compute'):
+                try:
+                    scene = parse_scene(body)
+                except ValueError as error:
+                    return await _respond(writer, 400, {'error': str(error)})
+                task = self.submit(scene)
+                if path == '/scene':
+                    return await _respond(writer, 202, {'version': self.version})
+                try:
+                    frame = await asyncio.shield(task)
+                except Superseded:
+                    return await _respond(writer, 409, {'error': 'superseded', 'version': self.version})
+                except asyncio.CancelledError:
+                    # A newer scene cancelled the task before it started (so it
+                    # never raised Superseded), unless this handler is being closed
+                    current = asyncio.current_task()
+                    if not task.cancelled() or getattr(current, 'cancelling', lambda: 0)():
+                        raise
+                    return await _respond(writer, 409, {'error': 'superseded', 'version': self.version})
+                except Exception as error:
+                    return await _respond(writer, 500, {'error': f'{type(error).__name__}: {error}'})
+                return await _respond(writer, 200, frame)
+            if method == 'GET' and path == '/stream':
+                return await self._stream(writer)
+            if method == 'GET' and path == '/stats':
+                return await _respond(writer, 200, dict(self.stats, version=self.version))
+            return await _respond(writer, 404, {'error': f'no route {method} {path}'})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Closed by close(); not re-raised, the handler task ends here
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _stream(self, writer):
+        writer.write(_head(200, 'application/octet-stream', chunked=True))
+        queue = self.subscribe()
+        try:
+            while True:
+                frame = await queue.get()
+                writer.write(f'{len(frame):x}\r\n'.encode('ascii') + frame + b'\r\n')
+                await writer.drain()
+        finally:
+            self.unsubscribe(queue)
+
+
+
+def _head(status, content_type, length=None, chunked=False):
+    reasons = {200: 'OK', 202: 'Accepted', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+               409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+    lines = [f'HTTP/1.1 {status} {reasons[status]}', f'Content-Type: {content_type}',
+             'Access-Control-Allow-Origin: *', 'Access-Control-Allow-Methods: GET, POST, OPTIONS',
+             'Access-Control-Allow-Headers: Content-Type', 'Cache-Control: no-store']
+    lines.append('Transfer-Encoding: chunked' if chunked else f'Content-Length: {length or 0}')
+    lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+
+async def _respond(writer, status, payload):
+    if isinstance(payload, bytes):
+        body, content_type = payload, 'application/octet-stream'
+    else:
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        content_type = 'application/json'
+    writer.write(_head(status, content_type, len(body)) + body)
+    await writer.drain()
+
+
+
+async def serve(host='127.0.0.1', port=8765, workers=None, executor='process', ready=None):
+    """
+    Run the server until cancelled. ready: optional callback ready(server,
+    port) once listening (port 0 picks a free port).
+    """
+    field_server = FieldServer(workers, executor)
+    server = await asyncio.start_server(field_server.handle, host, port)
+    try:
+        if ready is not None:
+            ready(field_server, server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+    finally:
+        await field_server.close()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local field server for the frontend.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--executor', choices=('process', 'thread'), default='process')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, args.executor,
+                          ready=lambda _, port: print(f"Serving fields on http://{args.host}:{port}")))
+    except KeyboardInterrupt:
+        pass
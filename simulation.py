@@ -1,7 +1,18 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from functions import get_Br, get_Bz
+from functions import (COIL_KERNELS, Workspace, coil_field, coil_field_far, far_field_radius_scalar, coil_gradient, coil_potential, dipole_sum, dipole_gradient,
+                       dipole_potential, dipole_field_3d)
+from treecode import DipoleTree
+from fieldfile import FieldFile, write_arrays
+from cache import FieldCache
+from profiling import phase, profiled
+from adaptive import AdaptiveField
+from backends import get_backend
+import copy
+import hashlib
+import json
+from collections import Counter
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 
 class Coil:
@@ -10,9 +21,28 @@ class Coil:
     
     The coil axis is aligned with the y-direction.
     Position (x, y) represents the center of the coil.
+
+    formulation selects the field kernel:
+        'heuman': Heuman Lambda formulation (reference)
+        'cel': Bulirsch's cel only, accurate near the windings and on axis
+
+    far_field_tol: relative error bound of the far-field switch. Points
+        farther than far_field_radius from the center are evaluated with
+        the dipole + octupole expansion (functions.coil_field_multipole)
+        instead of the elliptic kernel, within that relative error at any
+        angle. The bound is per coil: the error of a scene's total field
+        is at most tol × the sum of the coils' |B|, which can exceed tol ×
+        |B| where fields cancel. None (default) evaluates every point
+        exactly. Bounds below
+        ~1e-8 are finer than the kernels' own accuracy far from the coil.
+        Applies to field() and the batched evaluation, not to the in-place
+        mode, gradients or potentials.
     """
     
-    def __init__(self, x, y, radius, length, n_turns, current, mu=4*np.pi*1e-7):
+    def __init__(self, x, y, radius, length, n_turns, current, mu=4*np.pi*1e-7, formulation='heuman',
+                 far_field_tol=None):
+        if formulation not in COIL_KERNELS:
+            raise ValueError(f"Unknown formulation '{formulation}', expected one of {list(COIL_KERNELS)}")
         self.x = x
         self.y = y
         self.radius = radius
@@ -20,15 +50,44 @@ class Coil:
         self.n_turns = n_turns
         self.current = current
         self.mu = mu
-        self.n = n_turns / length  # turns per unit length
+        self.formulation = formulation
+        self.far_field_tol = far_field_tol
+
+    @property
+    def n(self):
+        """Turns per unit length."""
+        return self.n_turns / self.length
+
+    @property
+    def far_field_radius(self):
+        """Distance beyond which the multipole expansion is used (inf without far_field_tol)."""
+        tol = None if self.far_field_tol is None else float(self.far_field_tol)
+        return far_field_radius_scalar(float(self.radius), float(self.length), tol)
     
-    def field(self, x, y):
+    def field(self, x, y, out=None, workspace=None, dtype=None, backend=None):
         """
         Calculate magnetic field (Bx, By) on grid.
         
         The coil axis is along y-direction.
         Returns Bx (radial) and By (axial) components.
+
+        backend: compute backend (see backends.py, default: the current
+            default backend); the numpy reference is the code below
+
+        out: (Bx, By) arrays to write into
+        workspace: functions.Workspace reused across calls, so that repeated
+            calls at the same size allocate nothing (without out, the
+            results are workspace buffers, overwritten by the next call)
+        dtype: np.float32 evaluates in single precision
+        The 'cel' kernel honours out and dtype but allocates its temporaries.
+        The in-place mode always uses the numpy kernels.
         """
+        if out is not None or workspace is not None or dtype is not None:
+            return self._field_inplace(x, y, out, workspace, dtype)
+        backend = get_backend(backend)
+        if backend.name != 'numpy':
+            return _backend_field(backend, Coil, [self], x, y, formulation=self.formulation)
+
         x = np.asarray(x, dtype=float)
         y = np.asarray(y, dtype=float)
         
@@ -41,8 +100,12 @@ class Coil:
         ksi_high = z + self.length / 2
         
         # Get cylindrical field components
-        Br = get_Br(self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high)
-        Bz = get_Bz(self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high)
+        kernel = COIL_KERNELS[self.formulation]
+        if self.far_field_tol is None:
+            Br, Bz = kernel(self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high)
+        else:
+            Br, Bz = coil_field_far(kernel, self.far_field_radius, self.radius, self.mu, self.n, self.current,
+                                    r, ksi_low, ksi_high)
 
         # Convert to Cartesian: Br points radially outward
         # For x > coil.x: radial is +x direction
@@ -55,6 +118,144 @@ class Coil:
         
         return -Bx, By
 
+    def _field_inplace(self, x, y, out, workspace, dtype):
+        """field() with every array taken from out and workspace."""
+        workspace = Workspace() if workspace is None else workspace
+        shape, dtype = _inplace_layout(x, y, dtype)
+
+        def buffer(name, kind=dtype):
+            return workspace.buffer('coil.' + name, shape, kind)
+
+        Bx, By = (buffer('Bx'), buffer('By')) if out is None else out
+        dx, r, ksi_low, ksi_high = buffer('dx'), buffer('r'), buffer('ksi_low'), buffer('ksi_high')
+        np.subtract(x, self.x, out=dx)
+        np.abs(dx, out=r)
+        np.subtract(y, self.y, out=ksi_low)
+        np.add(ksi_low, self.length / 2, out=ksi_high)
+        np.subtract(ksi_low, self.length / 2, out=ksi_low)
+
+        if self.formulation == 'heuman':
+            coil_field(self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high,
+                       out=(Bx, By), workspace=workspace)
+        else:
+            Br, Bz = COIL_KERNELS[self.formulation](self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high)
+            np.copyto(Bx, Br, casting='same_kind')
+            np.copyto(By, Bz, casting='same_kind')
+
+        # Bx = -Br sign(x - x0), with sign 1 on the axis
+        on_axis = buffer('on_axis', bool)
+        np.sign(dx, out=dx)
+        np.equal(dx, 0, out=on_axis)
+        np.copyto(dx, 1, where=on_axis)
+        np.multiply(Bx, dx, out=Bx)
+        np.negative(Bx, out=Bx)
+        return Bx, By
+
+    def field_gradient(self, x, y):
+        """
+        Calculate the field derivatives (∂Bx/∂x, ∂Bx/∂y, ∂By/∂x, ∂By/∂y) at
+        given points, in closed form from the loop fields of the two end
+        faces (see coil_gradient). ∂Bx/∂y = ∂By/∂x outside the windings.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        r = np.abs(x - self.x)
+        z = y - self.y
+        ksi_low = z - self.length / 2
+        ksi_high = z + self.length / 2
+
+        kernel = COIL_KERNELS[self.formulation]
+        Br, _ = kernel(self.radius, self.mu, self.n, self.current, r, ksi_low, ksi_high)
+        dBr_dr, dBr_dz, dBz_dz = coil_gradient(self.radius, self.mu, self.n, self.current,
+                                               r, ksi_low, ksi_high, -Br)
+
+        sign_x = np.sign(x - self.x)
+        sign_x = np.where(sign_x == 0, 1, sign_x)
+        return dBr_dr, sign_x * dBr_dz, sign_x * dBr_dz, dBz_dz
+
+    def potential(self, x, y):
+        """
+        Calculate the vector potential Az at given points, from the closed
+        form A_φ of the finite solenoid (see coil_potential), with the sign
+        convention of the frontend: Az = -sign(x - x0) A_φ.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = y - self.y
+
+        A_phi = coil_potential(self.radius, self.mu, self.n, self.current, np.abs(x - self.x),
+                               z - self.length / 2, z + self.length / 2)
+        return -np.where(x - self.x >= 0, 1, -1) * A_phi
+
+    def field_y(self, x, y, z):
+        """
+        Axial field By at 3D points, z being the distance to the simulation
+        plane. The coil is axisymmetric, so it is its Bz at the distance
+        sqrt((x - x0)² + z²) from its axis.
+        """
+        r = np.hypot(np.asarray(x, dtype=float) - self.x, z)
+        ksi = np.asarray(y, dtype=float) - self.y
+        _, Bz = COIL_KERNELS[self.formulation](self.radius, self.mu, self.n, self.current, r,
+                                               ksi - self.length / 2, ksi + self.length / 2)
+        return Bz
+
+    def distance(self, x, y):
+        """Distance from the points to the winding edges, where the field is singular."""
+        return np.hypot(np.abs(x - self.x) - self.radius, np.abs(y - self.y) - self.length / 2)
+
+    def to_dict(self):
+        """Defining parameters of the coil (JSON-serialisable)."""
+        return {'type': 'coil', 'x': self.x, 'y': self.y, 'radius': self.radius, 'length': self.length,
+                'n_turns': self.n_turns, 'current': self.current, 'mu': self.mu,
+                'formulation': self.formulation, 'far_field_tol': self.far_field_tol}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Coil from the parameters of to_dict()."""
+        return cls(**{name: value for name, value in data.items() if name != 'type'})
+
+    # Columns of the struct-of-arrays table used for batched evaluation
+    columns = ('x', 'y', 'radius', 'length', 'n', 'current', 'mu', 'far_field_tol', 'far_field_radius')
+
+    # Rough peak memory per (source, point) pair of batch_field, in bytes
+    bytes_per_pair = 400
+
+    @staticmethod
+    def pack(coils):
+        """
+        Pack coil parameters into a struct-of-arrays table (dict of columns,
+        far_field_tol NaN and far_field_radius inf if None). The far-field
+        radius is packed once, so the chunks of a batch reuse it.
+        """
+        return {c: np.array([getattr(coil, c) for coil in coils], dtype=float) for c in Coil.columns}
+
+    @staticmethod
+    def batch_field(table, x, y, formulation='heuman'):
+        """
+        Field of every coil of a packed table at points (x, y).
+
+        table: columns of shape (S,), x, y: arrays of shape (P,)
+        Returns Bx, By of shape (S, P), one row per coil.
+        """
+        col = {c: v[:, None] for c, v in table.items()}
+        dx = np.asarray(x, dtype=float)[None, :] - col['x']
+
+        r = np.abs(dx)
+        z = np.asarray(y, dtype=float)[None, :] - col['y']
+        ksi_low = z - col['length'] / 2
+        ksi_high = z + col['length'] / 2
+
+        kernel = COIL_KERNELS[formulation]
+        if np.all(np.isnan(table.get('far_field_tol', np.nan))):
+            Br, Bz = kernel(col['radius'], col['mu'], col['n'], col['current'], r, ksi_low, ksi_high)
+        else:
+            Br, Bz = coil_field_far(kernel, col['far_field_radius'], col['radius'], col['mu'], col['n'], col['current'],
+                                    r, ksi_low, ksi_high)
+
+        sign_x = np.sign(dx)
+        sign_x = np.where(sign_x == 0, 1, sign_x)
+
+        return -Br * sign_x, Bz
+
 
 
 class Magnet:
@@ -88,13 +289,21 @@ class Magnet:
         self.moment = moment
         self.mu = mu
     
-    def field(self, x, y):
+    def field(self, x, y, out=None, workspace=None, dtype=None, backend=None):
         """
         Calculate magnetic field (Bx, By) at given points.
         
         Uses the magnetic dipole field equations.
         Returns Bx (radial) and By (axial) components.
+
+        out, workspace, dtype, backend: as Coil.field
         """
+        if out is not None or workspace is not None or dtype is not None:
+            return self._field_inplace(x, y, out, workspace, dtype)
+        backend = get_backend(backend)
+        if backend.name != 'numpy':
+            return _backend_field(backend, Magnet, [self], x, y)
+
         x = np.asarray(x, dtype=float)
         y = np.asarray(y, dtype=float)
         
@@ -119,48 +328,1194 @@ class Magnet:
         
         return Bx, By
 
+    def _field_inplace(self, x, y, out, workspace, dtype):
+        """field() with every array taken from out and workspace."""
+        workspace = Workspace() if workspace is None else workspace
+        shape, dtype = _inplace_layout(x, y, dtype)
+
+        def buffer(name, kind=dtype):
+            return workspace.buffer('magnet.' + name, shape, kind)
+
+        Bx, By = (buffer('Bx'), buffer('By')) if out is None else out
+        dx, dy, r, t = buffer('dx'), buffer('dy'), buffer('r'), buffer('t')
+        np.subtract(x, self.x, out=dx)
+        np.subtract(y, self.y, out=dy)
+        np.square(dx, out=r)
+        np.square(dy, out=t)
+        np.add(r, t, out=r)
+        np.sqrt(r, out=r)
+        np.maximum(r, 1e-10, out=r)
+        at_center = buffer('at_center', bool)
+        np.less(r, 1e-10, out=at_center)
+        np.power(r, 5, out=r)
+
+        c = self.mu * self.moment / (4*np.pi)
+        np.multiply(3, dx, out=Bx)
+        np.multiply(Bx, dy, out=Bx)
+        np.multiply(c, Bx, out=Bx)
+        np.divide(Bx, r, out=Bx)
+
+        np.square(dy, out=By)
+        np.multiply(2, By, out=By)
+        np.square(dx, out=t)
+        np.subtract(By, t, out=By)
+        np.multiply(c, By, out=By)
+        np.divide(By, r, out=By)
+
+        np.copyto(Bx, 0.0, where=at_center)
+        np.copyto(By, 0.0, where=at_center)
+        return Bx, By
+
+    def field_gradient(self, x, y):
+        """
+        Calculate the field derivatives (∂Bx/∂x, ∂Bx/∂y, ∂By/∂x, ∂By/∂y) at
+        given points, zero at the dipole location.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        return dipole_gradient(0.0, self.moment, self.mu, x - self.x, y - self.y)
+
+    def potential(self, x, y):
+        """Calculate the vector potential Az at given points, zero at the dipole location."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        return dipole_potential(0.0, self.moment, self.mu, x - self.x, y - self.y)
+
+    def field_y(self, x, y, z):
+        """
+        Field By at 3D points, z being the distance to the simulation plane.
+        The dipole is along y, so By only depends on the distance to its
+        axis and is read in the plane at that distance.
+        """
+        r = np.hypot(np.asarray(x, dtype=float) - self.x, z)
+        return self.field(self.x + r, y)[1]
+
+    def distance(self, x, y):
+        """Distance from the points to the dipole."""
+        return np.hypot(x - self.x, y - self.y)
+
+    def to_dict(self):
+        """Defining parameters of the magnet (JSON-serialisable)."""
+        return {'type': 'magnet', 'x': self.x, 'y': self.y, 'moment': self.moment, 'mu': self.mu}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Magnet from the parameters of to_dict()."""
+        return cls(**{name: value for name, value in data.items() if name != 'type'})
+
+    columns = ('x', 'y', 'moment', 'mu')
+
+    bytes_per_pair = 120
+
+    @staticmethod
+    def pack(magnets):
+        """Pack magnet parameters into a struct-of-arrays table (dict of columns)."""
+        return {c: np.array([getattr(magnet, c) for magnet in magnets], dtype=float) for c in Magnet.columns}
+
+    @staticmethod
+    def batch_field(table, x, y):
+        """
+        Field of every magnet of a packed table at points (x, y).
+
+        table: columns of shape (S,), x, y: arrays of shape (P,)
+        Returns Bx, By of shape (S, P), one row per magnet.
+        """
+        col = {c: v[:, None] for c, v in table.items()}
+        dx = np.asarray(x, dtype=float)[None, :] - col['x']
+        dy = np.asarray(y, dtype=float)[None, :] - col['y']
+
+        r = np.maximum(np.sqrt(dx**2 + dy**2), 1e-10)
+
+        Bx = col['mu'] * col['moment'] / (4*np.pi) * (3 * dx * dy) / r**5
+        By = col['mu'] * col['moment'] / (4*np.pi) * (2 * dy**2 - dx**2) / r**5
+
+        at_center = r < 1e-10
+        Bx = np.where(at_center, 0.0, Bx)
+        By = np.where(at_center, 0.0, By)
+
+        return Bx, By
+
+
+
+
+class ExtendedMagnet:
+    """
+    Permanent magnet modelled as an n_x × n_y grid of point dipoles, as the
+    frontend Magnet (frontend/src/physics/objects.js).
+
+    The dipoles fill a radius × length rectangle centered on (x, y), its
+    length axis at `angle` degrees from the x axis (90 = along y), every
+    dipole carrying moment / (n_x n_y) along that axis.
+
+    theta: None for the direct sum over all dipoles, or the opening angle of
+        the Barnes-Hut tree code (see treecode.py), e.g. 0.5
+    """
+
+    def __init__(self, x, y, radius=0.01, length=0.06, n_x=10, n_y=20, moment=0.1, angle=90,
+                 mu=4*np.pi*1e-7, theta=None, leaf_size=64, memory_budget=64 * 2**20):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.length = length
+        self.n_x = n_x
+        self.n_y = n_y
+        self.moment = moment
+        self.angle = angle
+        self.mu = mu
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.memory_budget = memory_budget
+        self._dipoles = None
+        self._tree = None
+
+    def dipoles(self):
+        """Positions and moments (px, py, mx, my) of the dipoles, rebuilt when parameters change."""
+        key = (self.x, self.y, self.radius, self.length, self.n_x, self.n_y, self.moment, self.angle)
+        if self._dipoles is None or self._dipoles[0] != key:
+            angle = np.deg2rad(self.angle)
+            axis = np.array([np.cos(angle), np.sin(angle)])
+            perp = np.array([-np.sin(angle), np.cos(angle)])
+
+            t = (np.linspace(0, 1, self.n_y) - 0.5) * self.length if self.n_y > 1 else np.zeros(1)
+            s = (np.linspace(0, 1, self.n_x) - 0.5) * 2 * self.radius if self.n_x > 1 else np.zeros(1)
+            T, S = np.meshgrid(t, s, indexing='ij')
+
+            px = (self.x + T * axis[0] + S * perp[0]).ravel()
+            py = (self.y + T * axis[1] + S * perp[1]).ravel()
+            m = self.moment / (self.n_x * self.n_y)
+            mx = np.full(px.size, m * np.cos(angle))
+            my = np.full(px.size, m * np.sin(angle))
+
+            self._dipoles = (key, (px, py, mx, my))
+            self._tree = None
+        return self._dipoles[1]
+
+    def tree(self):
+        """Barnes-Hut tree of the dipoles, rebuilt when parameters change."""
+        px, py, mx, my = self.dipoles()
+        if self._tree is None or self._tree.mu != self.mu or self._tree.leaf_size != self.leaf_size:
+            self._tree = DipoleTree(px, py, mx, my, self.mu, self.leaf_size, self.memory_budget)
+        self._tree.memory_budget = self.memory_budget
+        return self._tree
+
+    def field(self, x, y):
+        """
+        Calculate magnetic field (Bx, By) at given points, by direct sum
+        (theta=None) or with the tree code.
+        """
+        if self.theta is not None:
+            return self.tree().field(x, y, self.theta)
+        return self.direct_field(x, y)
+
+    def direct_field(self, x, y):
+        """Direct sum over all dipoles, chunked to stay within memory_budget."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        Bx, By = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget)
+        return Bx.reshape(shape), By.reshape(shape)
+
+    def field_gradient(self, x, y):
+        """
+        Calculate the field derivatives (∂Bx/∂x, ∂Bx/∂y, ∂By/∂x, ∂By/∂y) at
+        given points by direct sum over the dipoles.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        gradient = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget, kernel=dipole_gradient)
+        return tuple(g.reshape(shape) for g in gradient)
+
+    def potential(self, x, y):
+        """Calculate the vector potential Az at given points by direct sum over the dipoles."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        (Az,) = dipole_sum(*self.dipoles(), self.mu, x, y, self.memory_budget,
+                           kernel=lambda *args: (dipole_potential(*args),))
+        return Az.reshape(shape)
+
+    def field_y(self, x, y, z):
+        """Field By at 3D points, z being the distance to the simulation plane."""
+        x, y, z = (np.asarray(v, dtype=float) for v in np.broadcast_arrays(x, y, z))
+        _, By, _ = dipole_sum(*self.dipoles(), self.mu, x.ravel(), y.ravel(), self.memory_budget,
+                              kernel=dipole_field_3d, z=z.ravel())
+        return By.reshape(x.shape)
+
+    def distance(self, x, y):
+        """Distance from the points to the magnet rectangle (zero inside)."""
+        angle = np.deg2rad(self.angle)
+        t = (x - self.x) * np.cos(angle) + (y - self.y) * np.sin(angle)
+        s = -(x - self.x) * np.sin(angle) + (y - self.y) * np.cos(angle)
+        return np.hypot(np.maximum(np.abs(t) - self.length / 2, 0), np.maximum(np.abs(s) - self.radius, 0))
+
+    def to_dict(self):
+        """Defining parameters of the magnet (JSON-serialisable)."""
+        return {'type': 'extended_magnet', 'x': self.x, 'y': self.y, 'radius': self.radius,
+                'length': self.length, 'n_x': self.n_x, 'n_y': self.n_y, 'moment': self.moment,
+                'angle': self.angle, 'mu': self.mu, 'theta': self.theta}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Magnet from the parameters of to_dict()."""
+        return cls(**{name: value for name, value in data.items() if name != 'type'})
+
+
+
+
+class MeasurementCoil:
+    """
+    Pickup coil measuring the flux of the other objects, as the frontend
+    MeasurementCoil. It does not generate any field.
+
+    The flux N ∫ By dS is integrated over the circular cross-section (in
+    3D, perpendicular to y) with n_radial Gauss-Legendre nodes in radius and
+    n_angular equally spaced angles, averaged over n_axial Gauss-Legendre
+    positions along the length. n_radial = n_angular = n_axial = 1 is the
+    frontend approximation N By(x0, y0) π R².
+    """
+
+    def __init__(self, x, y, radius=0.03, length=0.05, n_turns=200, resistance=10,
+                 n_radial=4, n_angular=8, n_axial=1):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.length = length
+        self.n_turns = n_turns
+        self.resistance = resistance
+        self.n_radial = n_radial
+        self.n_angular = n_angular
+        self.n_axial = n_axial
+        self.induced_current = 0.0
+        self.previous_flux = None
+
+    def field(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return np.zeros(x.shape), np.zeros(y.shape)
+
+    def field_gradient(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return tuple(np.zeros(x.shape) for _ in range(4))
+
+    def potential(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return np.zeros(x.shape)
+
+    def field_y(self, x, y, z):
+        return np.zeros(np.broadcast_shapes(np.shape(x), np.shape(y), np.shape(z)))
+
+    def quadrature(self):
+        """
+        Points (x, y, z) and weights w of the flux quadrature, such that the
+        flux is Σ w By(x, y, z). The weights include the number of turns.
+        """
+        # ∫_0^R ρ dρ with Gauss-Legendre, ∫_0^2π dφ with the (spectral) trapezoidal rule
+        t, w_r = np.polynomial.legendre.leggauss(self.n_radial)
+        rho = self.radius * (t + 1) / 2
+        w_r = w_r * self.radius / 2 * rho
+        if self.n_radial == 1:
+            rho, w_r = np.zeros(1), np.array([self.radius**2 / 2])
+        phi = 2 * np.pi * np.arange(self.n_angular) / self.n_angular
+        w_phi = np.full(self.n_angular, 2 * np.pi / self.n_angular)
+
+        t, w_y = np.polynomial.legendre.leggauss(self.n_axial)
+        y = self.y + t * self.length / 2
+        w_y = w_y / 2
+
+        Y, R, PHI = np.meshgrid(y, rho, phi, indexing='ij')
+        W = w_y[:, None, None] * w_r[None, :, None] * w_phi[None, None, :]
+        return ((self.x + R * np.cos(PHI)).ravel(), Y.ravel(), (R * np.sin(PHI)).ravel(),
+                self.n_turns * W.ravel())
+
+    def flux(self, sim):
+        """Flux through the coil of the other objects of sim."""
+        return sim.flux([self])[0]
+
+    def update_induced_current(self, sim, dt):
+        """Frame by frame induced current e / R, e = -dΦ/dt, as in the frontend."""
+        flux = self.flux(sim)
+        if self.previous_flux is not None and dt > 0:
+            self.induced_current = -(flux - self.previous_flux) / dt / self.resistance
+        self.previous_flux = flux
+        return self.induced_current
+
+    def to_dict(self):
+        """Defining parameters of the coil (JSON-serialisable)."""
+        return {'type': 'measurement_coil', 'x': self.x, 'y': self.y, 'radius': self.radius,
+                'length': self.length, 'n_turns': self.n_turns, 'resistance': self.resistance,
+                'n_radial': self.n_radial, 'n_angular': self.n_angular, 'n_axial': self.n_axial}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Coil from the parameters of to_dict()."""
+        return cls(**{name: value for name, value in data.items() if name != 'type'})
+
+
+
+
+OBJECT_TYPES = {'coil': Coil, 'magnet': Magnet, 'extended_magnet': ExtendedMagnet,
+                'measurement_coil': MeasurementCoil}
+
+
+
+def object_from_dict(data):
+    """Object rebuilt from its to_dict() parameters, dispatched on data['type']."""
+    if data['type'] == 'rope':
+        from rope import Rope  # rope.py imports this module
+        return Rope.from_dict(data)
+    if data['type'] not in OBJECT_TYPES:
+        raise ValueError(f"Unknown object type '{data['type']}', expected one of {list(OBJECT_TYPES) + ['rope']}")
+    return OBJECT_TYPES[data['type']].from_dict(data)
 
 
 
 class MagneticFieldSimulation:
-    """Simulates the combined magnetic field from multiple objects."""
+    """
+    Simulates the combined magnetic field from multiple objects.
+
+    Coils and magnets are packed into struct-of-arrays tables and evaluated
+    together over a sources × points block. memory_budget (bytes) bounds the
+    size of that block: evaluation is chunked so that peak memory stays
+    below it whatever the number of sources and points.
+
+    cache: optional FieldCache of per-object contributions. compute_field
+    then only evaluates objects whose parameters changed since the last
+    call on the same grid, and updates the total by subtracting their stale
+    contribution and adding the new one.
+
+    backend: compute backend of field() and compute_field() (see
+    backends.py; default: the current default backend)
+    """
+
+    # Minimum number of points per chunk when splitting sources
+    min_chunk_points = 4096
     
-    def __init__(self, objects: List[Coil|Magnet]):
+    def __init__(self, objects: List[Coil|Magnet], memory_budget=64 * 2**20, cache: FieldCache = None,
+                 backend=None):
         self.objects = objects
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.backend = backend
+        self._total = None
+    
+    
+    @profiled('field', points='x')
+    def field(self, x, y, out=None, workspace=None, dtype=None, backend=None):
+        """
+        Total magnetic field (Bx, By) at arbitrary points.
+
+        Objects with a batched API (pack/batch_field) are evaluated together
+        per type, the others one by one through their field() method.
+
+        out, workspace, dtype: as Coil.field. The objects are then evaluated
+        one by one into the workspace buffers and summed in place; objects
+        without an in-place field() (ropes, trees) fall back to their
+        allocating one.
+
+        backend: overrides the simulation's backend for this call. Tables are
+        evaluated by backend.batch_field; the in-place mode always uses the
+        numpy kernels.
+        """
+        if out is not None or workspace is not None or dtype is not None:
+            return self._field_inplace(x, y, out, workspace, dtype)
+        backend = get_backend(self.backend if backend is None else backend)
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        Bx = np.zeros(x.shape)
+        By = np.zeros(y.shape)
+
+        for (cls, formulation), objs in self._groups().items():
+            if not hasattr(cls, 'batch_field'):
+                for obj in objs:
+                    with phase(cls.__name__, x.size):
+                        bx, by = obj.field(x, y)
+                        Bx += bx
+                        By += by
+                continue
+
+            table = cls.pack(objs)
+            kwargs = {} if formulation is None else {'formulation': formulation}
+            with phase(cls.__name__, len(objs) * x.size):
+                for sources, points in self._chunks(len(objs), x.size, backend.bytes_per_pair(cls)):
+                    chunk = {c: v[sources] for c, v in table.items()}
+                    bx, by = backend.batch_field(cls, chunk, x[points], y[points], **kwargs)
+                    Bx[points] += bx
+                    By[points] += by
+
+        return Bx.reshape(shape), By.reshape(shape)
+
+
+    def _field_inplace(self, x, y, out, workspace, dtype):
+        """field() summed into out (or workspace buffers) object by object."""
+        workspace = Workspace() if workspace is None else workspace
+        shape, dtype = _inplace_layout(x, y, dtype)
+        Bx, By = ((workspace.buffer('sim.Bx', shape, dtype), workspace.buffer('sim.By', shape, dtype))
+                  if out is None else out)
+        Bx.fill(0.0)
+        By.fill(0.0)
+
+        for obj in self.objects:
+            with phase(type(obj).__name__, int(np.prod(shape))):
+                if hasattr(obj, '_field_inplace'):
+                    bx, by = obj._field_inplace(x, y, None, workspace, dtype)
+                else:
+                    bx, by = obj.field(x, y)
+                np.add(Bx, bx, out=Bx, casting='same_kind')
+                np.add(By, by, out=By, casting='same_kind')
+
+        return Bx, By
+
+
+    @profiled('gradient', points='x')
+    def gradient(self, x, y):
+        """
+        Total field derivatives (∂Bx/∂x, ∂Bx/∂y, ∂By/∂x, ∂By/∂y) at
+        arbitrary points, summed over the objects' field_gradient().
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        total = [np.zeros(x.shape) for _ in range(4)]
+        for obj in self.objects:
+            for t, g in zip(total, obj.field_gradient(x, y)):
+                t += g
+        return tuple(t.reshape(shape) for t in total)
+
+
+    @profiled('potential', points='x')
+    def potential(self, x, y):
+        """Total vector potential Az at arbitrary points, summed over the objects."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        Az = np.zeros(x.shape)
+        for obj in self.objects:
+            Az += obj.potential(x, y)
+        return Az.reshape(shape)
+
+
+    def _measurement_coils(self, coils):
+        return [obj for obj in self.objects if isinstance(obj, MeasurementCoil)] if coils is None else list(coils)
+
+
+    def _quadrature(self, coils):
+        """Concatenated flux quadrature of the coils, and the start of each coil."""
+        rules = [coil.quadrature() for coil in coils]
+        starts = np.cumsum([0] + [len(rule[3]) for rule in rules[:-1]])
+        return tuple(np.concatenate(v) for v in zip(*rules)), starts
+
+
+    def flux(self, coils=None):
+        """
+        Flux through measurement coils (default: the MeasurementCoil objects
+        of the scene). The quadrature points of all the coils are evaluated
+        in one vectorized call per source.
+        """
+        coils = self._measurement_coils(coils)
+        (x, y, z, w), starts = self._quadrature(coils)
+
+        By = np.zeros(x.shape)
+        for obj in self.objects:
+            if not isinstance(obj, MeasurementCoil):
+                By += obj.field_y(x, y, z)
+        return np.add.reduceat(w * By, starts)
+
+
+    def measure(self, times, currents=None, coils=None, states=None):
+        """
+        Flux, EMF and induced current of measurement coils over a whole time
+        series, in one batch.
+
+        times: (T,) sample times
+        currents: (T, n_coils) currents of the Coil objects over time, in
+            scene order (as stream_frames), or None for a static scene
+        states: per-step parameters of moving sources, as a dict
+            {object or its index in objects: {name: (T,) array}}, with
+            names among x, y, current for a Coil and x, y, moment for a
+            Magnet. Other objects and parameters keep their scene values;
+            any other name or object type raises ValueError rather than
+            being ignored.
+
+        The flux is linear in the coil currents, so the unit-current flux of
+        every (source coil, measurement coil) pair is computed once and the
+        time series is one matrix product. Moving sources are evaluated at
+        every step in one vectorized call over steps × quadrature points,
+        chunked over steps within memory_budget. The EMF e = -dΦ/dt is taken
+        with second order differences (np.gradient, uneven times allowed).
+
+        Returns a dict of (T, n_measurement_coils) arrays 'flux', 'emf' and
+        'current' (e / R).
+        """
+        times = np.asarray(times, dtype=float)
+        coils = self._measurement_coils(coils)
+        states = self._states(states, len(times))
+        sources = [obj for obj in self.objects if isinstance(obj, Coil)]
+        if currents is not None:
+            currents = np.atleast_2d(np.asarray(currents, dtype=float))
+            if currents.shape != (len(times), len(sources)):
+                raise ValueError(f"currents has shape {currents.shape}, expected {(len(times), len(sources))}")
+            for j, source in enumerate(sources):
+                if id(source) in states:
+                    states[id(source)][1].setdefault('current', currents[:, j])
+
+        fixed = [obj for obj in self.objects if id(obj) not in states and not isinstance(obj, MeasurementCoil)]
+        fixed_coils = [j for j, source in enumerate(sources) if id(source) not in states]
+        others = [obj for obj in fixed if not isinstance(obj, Coil)]
+
+        if currents is None:
+            static = MagneticFieldSimulation(fixed, self.memory_budget, backend=self.backend).flux(coils)
+            flux = np.tile(static, (len(times), 1))
+        else:
+            flux = np.tile(MagneticFieldSimulation(others, self.memory_budget, backend=self.backend).flux(coils),
+                           (len(times), 1))
+            units = []
+            for j in fixed_coils:
+                unit = copy.copy(sources[j])
+                unit.current = 1.0
+                units.append(MagneticFieldSimulation([unit], self.memory_budget, backend=self.backend).flux(coils))
+            if units:
+                flux += currents[:, fixed_coils] @ np.reshape(units, (len(fixed_coils), len(coils)))
+
+        for obj, params in states.values():
+            flux += self._moving_flux(obj, params, coils, len(times))
+
+        emf = -np.gradient(flux, times, axis=0) if len(times) > 1 else np.zeros_like(flux)
+        resistance = np.array([coil.resistance for coil in coils])
+        return {'flux': flux, 'emf': emf, 'current': emf / resistance}
+
+
+    # Parameters of the sources that measure() can vary over time
+    _state_parameters = {'Coil': ('x', 'y', 'current'), 'Magnet': ('x', 'y', 'moment')}
+
+
+    def _states(self, states, n_times):
+        """Validated measure() states as {id(obj): (obj, {name: (T,) array})}."""
+        validated = {}
+        for key, params in (states or {}).items():
+            obj = self.objects[key] if isinstance(key, (int, np.integer)) else key
+            if not any(obj is other for other in self.objects):
+                raise ValueError(f"states: {obj!r} is not an object of the simulation")
+            allowed = self._state_parameters.get(type(obj).__name__)
+            if allowed is None:
+                raise ValueError(f"states: {type(obj).__name__} objects cannot vary over time, "
+                                 f"only {list(self._state_parameters)}")
+            values = {}
+            for name, value in params.items():
+                if name not in allowed:
+                    raise ValueError(f"states: '{name}' of a {type(obj).__name__} cannot vary over time, "
+                                     f"expected one of {list(allowed)}")
+                value = np.asarray(value, dtype=float)
+                if value.shape != (n_times,):
+                    raise ValueError(f"states: '{name}' has shape {value.shape}, expected {(n_times,)}")
+                values[name] = value
+            validated[id(obj)] = (obj, values)
+        return validated
+
+
+    def _moving_flux(self, obj, params, coils, n_times):
+        """(T, n_coils) flux of a Coil or Magnet whose parameters params vary over the T steps."""
+        (x, y, z, w), starts = self._quadrature(coils)
+        flux = np.empty((n_times, len(coils)))
+        step = max(1, self.memory_budget // (type(obj).bytes_per_pair * x.size))
+        for t0 in range(0, n_times, step):
+            steps = slice(t0, t0 + step)
+            value = {name: getattr(obj, name) for name in self._state_parameters[type(obj).__name__]}
+            value.update({name: v[steps, None] for name, v in params.items()})
+            if isinstance(obj, Coil):
+                source = copy.copy(obj)
+                for name, v in value.items():
+                    setattr(source, name, v)
+                By = source.field_y(x, y, z)
+            else:
+                _, By, _ = dipole_field_3d(0.0, value['moment'], obj.mu, x - value['x'], y - value['y'], z)
+            flux[steps] = np.add.reduceat(w * By, starts, axis=1)
+        return flux
+
+
+    def _groups(self):
+        """Objects grouped by type (and coil formulation), in first-seen order."""
+        groups = {}
+        for obj in self.objects:
+            key = (type(obj), getattr(obj, 'formulation', None))
+            groups.setdefault(key, []).append(obj)
+        return groups
+
+
+    def _chunks(self, n_sources, n_points, bytes_per_pair):
+        """
+        Yield (sources, points) slices covering the sources × points block
+        within the memory budget. The source split does not depend on the
+        number of points, so the summation order of each point is the same
+        however the points are chunked.
+        """
+        max_pairs = max(1, self.memory_budget // bytes_per_pair)
+        source_step = max(1, min(n_sources, max_pairs // self.min_chunk_points))
+        point_step = max(1, max_pairs // source_step)
+
+        for s0 in range(0, n_sources, source_step):
+            for p0 in range(0, n_points, point_step):
+                yield slice(s0, s0 + source_step), slice(p0, p0 + point_step)
+    
     
+    def scene_hash(self):
+        """SHA-256 of the defining parameters of all objects, in order."""
+        scene = json.dumps([obj.to_dict() for obj in self.objects], sort_keys=True)
+        return hashlib.sha256(scene.encode('utf-8')).hexdigest()
     
-    def compute_field(self, x_range, y_range, resolution=30):
+    
+    @profiled('compute_field')
+    def compute_field(self, x_range, y_range, resolution=30, tiles=None, workers=None, executor='thread',
+                      out=None, dtype=None, store_grid=False, workspace=None):
         """
         Compute total magnetic field at grid points.
         
         X, Y: 2D meshgrid arrays
         Returns: Bx, By arrays of same shape
+
+        tiles: (ty, tx) splits the grid into ty × tx tiles evaluated one by
+            one, which bounds peak memory by the tile size.
+        workers: number of pool workers evaluating the tiles in parallel
+            (default tiles: one row band per worker).
+        executor: 'thread' or 'process'. The special functions release the
+            GIL, so threads usually scale; processes avoid it entirely.
+
+        The tiled result is bit-identical to the serial one.
+
+        out: path of a field file (see fieldfile.py). Bx and By are computed
+            tile by tile straight into memory-mapped arrays of that file,
+            so the grid does not need to fit in memory. The file stores the
+            x, y coordinate vectors, and the full X, Y meshgrids only if
+            store_grid is set; otherwise X, Y are broadcast views.
+        dtype: dtype of Bx, By (default float64), e.g. np.float32
+        workspace: functions.Workspace holding X, Y, Bx, By and every
+            temporary, for repeated computations on the same grid (e.g. one
+            per frame) that allocate nothing. X, Y, Bx, By are then
+            workspace buffers, overwritten by the next call, and the field
+            is evaluated in dtype. Not combined with tiles, workers, out or
+            a cache.
+        """
+
+        x = np.linspace(x_range[0], x_range[1], resolution)
+        y = np.linspace(y_range[0], y_range[1], resolution)
+        dtype = np.dtype(float if dtype is None else dtype)
+
+        if workspace is not None:
+            if out is not None or tiles is not None or (workers or 1) > 1 or self.cache is not None:
+                raise ValueError("workspace is not supported with out, tiles, workers or a cache")
+            shape = (len(y), len(x))
+            with phase('meshgrid', len(x) * len(y)):
+                self.X = workspace.buffer('grid.X', shape, dtype)
+                self.Y = workspace.buffer('grid.Y', shape, dtype)
+                self.X[...] = x
+                self.Y[...] = y[:, None]
+            self.Bx, self.By = self.field(self.X, self.Y, workspace=workspace, dtype=dtype,
+                                          out=(workspace.buffer('grid.Bx', shape, dtype),
+                                               workspace.buffer('grid.By', shape, dtype)))
+            return
+
+        if out is None:
+            with phase('meshgrid', len(x) * len(y)):
+                self.X, self.Y = np.meshgrid(x, y)
+            if tiles is None and (workers is None or workers <= 1):
+                if self.cache is not None:
+                    grid = (tuple(map(float, x_range)), tuple(map(float, y_range)), int(resolution))
+                    Bx, By = self._compute_cached(grid)
+                else:
+                    Bx, By = self.field(self.X, self.Y)
+                self.Bx, self.By = Bx.astype(dtype, copy=False), By.astype(dtype, copy=False)
+                return
+            self.Bx = np.empty(self.X.shape, dtype=dtype)
+            self.By = np.empty(self.Y.shape, dtype=dtype)
+        else:
+            shape = (len(y), len(x))
+            arrays = {'x': (x.shape, float), 'y': (y.shape, float), 'Bx': (shape, dtype), 'By': (shape, dtype)}
+            if store_grid:
+                arrays.update(X=(shape, float), Y=(shape, float))
+            meta = {'x_range': list(map(float, x_range)), 'y_range': list(map(float, y_range)),
+                    'resolution': int(resolution), 'dtype': dtype.str,
+                    'scene_hash': self.scene_hash(), 'scene': [obj.to_dict() for obj in self.objects]}
+
+            self.file = FieldFile.create(out, arrays, meta)
+            self.file['x'][:] = x
+            self.file['y'][:] = y
+            self.Bx, self.By = self.file['Bx'], self.file['By']
+            self._set_grid(x, y)
+
+            # Row bands of a few budgets' worth of points (field() itself
+            # stays within the budget whatever the band size)
+            if tiles is None:
+                rows_per_band = max(1, self.memory_budget // (len(x) * 64))
+                tiles = (max(workers or 1, -(-len(y) // rows_per_band)), 1)
+
+        if tiles is None:
+            tiles = (workers, 1)
+
+        blocks = [(rows, cols)
+                  for rows in _split(len(y), tiles[0])
+                  for cols in _split(len(x), tiles[1])]
+
+        if workers is None or workers <= 1:
+            for rows, cols in blocks:
+                self.Bx[rows, cols], self.By[rows, cols] = self._compute_tile(x[cols], y[rows])
+                if store_grid and out is not None:
+                    self.file['X'][rows, cols], self.file['Y'][rows, cols] = np.meshgrid(x[cols], y[rows])
+        else:
+            if executor == 'thread':
+                pool = ThreadPoolExecutor(max_workers=workers)
+                task = self._compute_tile
+            elif executor == 'process':
+                pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(self.objects, self.memory_budget, get_backend(self.backend).name))
+                task = _compute_tile
+            else:
+                raise ValueError(f"Unknown executor '{executor}', expected 'thread' or 'process'")
+
+            with pool:
+                futures = {pool.submit(task, x[cols], y[rows]): (rows, cols) for rows, cols in blocks}
+                for future in as_completed(futures):
+                    rows, cols = futures[future]
+                    self.Bx[rows, cols], self.By[rows, cols] = future.result()
+                    if store_grid and out is not None:
+                        self.file['X'][rows, cols], self.file['Y'][rows, cols] = np.meshgrid(x[cols], y[rows])
+
+        if out is not None:
+            self.file.flush()
+
+
+    @profiled('compute_adaptive')
+    def compute_adaptive(self, x_range, y_range, resolution=None, tol=1e-2, base=16, max_level=6, atol=None):
+        """
+        Sample the field adaptively on a quadtree (see adaptive.py) instead
+        of a uniform grid: cells are refined where the interpolation error
+        is above tol, i.e. along windings, end faces and near dipoles.
+
+        Returns the AdaptiveField, also kept as self.adaptive. With
+        resolution, X, Y, Bx, By are also set by interpolation onto the
+        uniform resolution × resolution grid, as compute_field would.
+        """
+        self.adaptive = AdaptiveField(self.field, x_range, y_range, tol, base, max_level, atol)
+        if resolution is not None:
+            self.X, self.Y, self.Bx, self.By = self.adaptive.resample(resolution)
+        return self.adaptive
+
+
+    def _compute_cached(self, grid):
+        """
+        Total field on self.X, self.Y from cached per-object contributions.
+
+        On the same grid as the previous call, only the objects that changed
+        are looked at: their stale contribution is subtracted from the
+        previous total and the new one added. Otherwise (or if a stale
+        contribution was evicted, or is not finite, e.g. on a winding, so
+        that subtracting it would leave NaN in the total) the total is
+        summed again from the cache.
+        """
+        objects = {(self._object_key(obj), grid): obj for obj in self.objects}
+        keys = [(self._object_key(obj), grid) for obj in self.objects]
+        previous = self._total
+
+        if previous is not None and previous[0] == grid:
+            old_keys, new_keys = Counter(previous[1]), Counter(keys)
+            removed = old_keys - new_keys
+            added = new_keys - old_keys
+            stale = [self.cache.peek(key) for key in removed.elements()]
+
+            if all(value is not None and np.isfinite(value[0]).all() and np.isfinite(value[1]).all()
+                   for value in stale):
+                Bx, By = previous[2].copy(), previous[3].copy()
+                for bx, by in stale:
+                    Bx -= bx
+                    By -= by
+                for key in (old_keys & new_keys):
+                    self.cache.get(key)  # refresh LRU order of the unchanged objects
+                for key in added.elements():
+                    bx, by = self._contribution(key, objects[key])
+                    Bx += bx
+                    By += by
+                self._total = (grid, keys, Bx.copy(), By.copy())
+                return Bx, By
+
+        Bx = np.zeros_like(self.X)
+        By = np.zeros_like(self.Y)
+        for key in keys:
+            bx, by = self._contribution(key, objects[key])
+            Bx += bx
+            By += by
+        self._total = (grid, keys, Bx.copy(), By.copy())
+        return Bx, By
+
+
+    def _contribution(self, key, obj):
+        """Field of one object on self.X, self.Y, from the cache or computed."""
+        value = self.cache.get(key)
+        if value is None:
+            if isinstance(obj, (Coil, Magnet)):
+                value = obj.field(self.X, self.Y, backend=self.backend)
+            else:
+                value = obj.field(self.X, self.Y)
+            self.cache.put(key, value)
+        return value
+
+
+    @staticmethod
+    def _object_key(obj):
+        """Hashable key of the defining parameters of an object."""
+        return tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                            for name, value in obj.to_dict().items()))
+
+
+    def compute_gradient(self, x_range, y_range, resolution=30):
+        """
+        Compute the field derivatives at grid points, stored in dBx_dx,
+        dBx_dy, dBy_dx and dBy_dy (same grid as compute_field).
         """
+        x = np.linspace(x_range[0], x_range[1], resolution)
+        y = np.linspace(y_range[0], y_range[1], resolution)
+        self.X, self.Y = np.meshgrid(x, y)
+        self.dBx_dx, self.dBx_dy, self.dBy_dx, self.dBy_dy = self.gradient(self.X, self.Y)
+
 
+    def compute_potential(self, x_range, y_range, resolution=30):
+        """
+        Compute the vector potential at grid points, stored in Az (same
+        grid as compute_field), e.g. to draw field lines as its contours.
+        """
         x = np.linspace(x_range[0], x_range[1], resolution)
         y = np.linspace(y_range[0], y_range[1], resolution)
         self.X, self.Y = np.meshgrid(x, y)
+        self.Az = self.potential(self.X, self.Y)
 
-        self.Bx = np.zeros_like(self.X)
-        self.By = np.zeros_like(self.Y)
-        
-        X_flat = self.X.flatten()
-        Y_flat = self.Y.flatten()
-        
-        for obj in self.objects:
-            bx, by = obj.field(X_flat, Y_flat)
-            self.Bx += bx.reshape(self.X.shape)
-            self.By += by.reshape(self.Y.shape)
+
+    def trace_lines(self, seeds, x_range, y_range, direction='both', tol=None, max_steps=2000,
+                    max_length=None, margin=None, close_tol=None):
+        """
+        Trace field lines through seed points on the exact field.
+
+        The lines solve dr/ds = ±B/|B| (s the arc length) with the embedded
+        Dormand-Prince 5(4) Runge-Kutta method and adaptive steps. All the
+        lines advance together: every stage is one vectorized call to
+        field() over the lines still running.
+
+        A line stops when it
+            - leaves the domain x_range × y_range (clipped on the boundary),
+            - closes on itself (comes back within close_tol of its seed),
+            - comes within margin of a source (see the objects' distance()),
+            - reaches a null of the field, max_length or max_steps.
+
+        seeds: (N, 2) array of seed points
+        direction: 'forward' (along B), 'backward' or 'both'
+        tol: local error tolerance on positions (default 1e-6 × domain diagonal)
+        margin: stopping distance to the sources (default 1e-3 × domain
+            diagonal). Steps are also limited to half the distance to the
+            nearest source, so that a line cannot jump over one.
+        close_tol: loop closure distance (default 1e-3 × domain diagonal)
+
+        Returns a list of N polylines, (n_i, 2) arrays ordered along B.
+        """
+        seeds = np.atleast_2d(np.asarray(seeds, dtype=float))
+        diagonal = np.hypot(x_range[1] - x_range[0], y_range[1] - y_range[0])
+        tol = 1e-6 * diagonal if tol is None else tol
+        margin = 1e-3 * diagonal if margin is None else margin
+        close_tol = 1e-3 * diagonal if close_tol is None else close_tol
+        max_length = 20 * diagonal if max_length is None else max_length
+        h_max = diagonal / 20
+        sources = [obj for obj in self.objects if hasattr(obj, 'distance')]
+
+        signs = {'forward': [1.0], 'backward': [-1.0], 'both': [1.0, -1.0]}[direction]
+        line = np.tile(np.arange(len(seeds)), len(signs))
+        sign = np.repeat(signs, len(seeds))
+        start = seeds[line]
+        pos = start.copy()
+
+        def tangent(points, s):
+            Bx, By = self.field(points[:, 0], points[:, 1])
+            norm = np.hypot(Bx, By)
+            norm = np.where(norm > 0, norm, np.nan)
+            return np.stack([Bx, By], axis=1) * (s / norm)[:, None]
+
+        def stopped(points):
+            outside = ((points[:, 0] < x_range[0]) | (points[:, 0] > x_range[1])
+                       | (points[:, 1] < y_range[0]) | (points[:, 1] > y_range[1]))
+            distance = np.full(len(points), np.inf)
+            for obj in sources:
+                distance = np.minimum(distance, obj.distance(points[:, 0], points[:, 1]))
+            return outside, distance
+
+        k1 = tangent(pos, sign)
+        h = np.full(len(pos), diagonal / 100)
+        length = np.zeros(len(pos))
+        closed = np.zeros(len(pos), dtype=bool)
+        outside, distance = stopped(pos)
+        active = ~outside & (distance >= margin) & np.all(np.isfinite(k1), axis=1)
+
+        # Accepted points of every trajectory, with their step number
+        history = [(np.arange(len(pos)), np.zeros(len(pos), dtype=int), pos.copy())]
+
+        for step in range(1, max_steps + 1):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            h[idx] = np.minimum(h[idx], 0.5 * distance[idx])
+            p, hh, s = pos[idx], h[idx, None], sign[idx]
+
+            k = [k1[idx]]
+            for row in _DOPRI_A[1:]:
+                k.append(tangent(p + hh * sum(a * kj for a, kj in zip(row, k)), s))
+            y5 = p + hh * sum(b * kj for b, kj in zip(_DOPRI_B5, k))
+            y4 = p + hh * sum(b * kj for b, kj in zip(_DOPRI_B4, k))
+
+            # Steps turning by more than ~25° are also rejected: they can jump
+            # over a singular point without the error estimate noticing
+            err = np.linalg.norm(y5 - y4, axis=1) / tol
+            err = np.where(np.einsum('ij,ij->i', k[0], k[-1]) < 0.9, np.maximum(err, 10.0), err)
+            err = np.where(np.all(np.isfinite(k[-1]), axis=1), err, np.inf)
+            accept = err <= 1
+            factor = np.clip(0.9 * np.where(err > 0, err, 1e-10)**-0.2, 0.2, 5.0)
+            h[idx] = np.minimum(h[idx] * np.where(np.isfinite(err), factor, 0.2), h_max)
+
+            acc = idx[accept]
+            p0, p1 = pos[acc], y5[accept]
+            pos[acc] = p1
+            k1[acc] = k[-1][accept]
+            length[acc] += hh[accept, 0]
+
+            # Stops: domain exit (clipped on the boundary), source, closure
+            outside, distance[acc] = stopped(p1)
+            inside = distance[acc] < margin
+            if np.any(outside):
+                d = p1[outside] - p0[outside]
+                t = np.ones(len(d))
+                for axis, (lo, hi) in enumerate((x_range, y_range)):
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        t = np.minimum(t, np.where(p1[outside, axis] < lo, (lo - p0[outside, axis]) / d[:, axis], 1))
+                        t = np.minimum(t, np.where(p1[outside, axis] > hi, (hi - p0[outside, axis]) / d[:, axis], 1))
+                pos[acc[outside]] = p0[outside] + t[:, None] * d
+
+            seed = start[acc]
+            d = p1 - p0
+            u = np.clip(np.einsum('ij,ij->i', seed - p0, d) / np.maximum(np.einsum('ij,ij->i', d, d), 1e-300), 0, 1)
+            travelled = length[acc] - hh[accept, 0]
+            closes = (travelled > 4 * close_tol) & (np.linalg.norm(p0 + u[:, None] * d - seed, axis=1) < close_tol)
+            closes &= ~outside
+            pos[acc[closes]] = seed[closes]
+            closed[acc[closes]] = True
+
+            active[acc[outside | inside | closes | (length[acc] >= max_length)]] = False
+            active[idx[~np.isfinite(err) & (h[idx] < 1e-9 * diagonal)]] = False
+            history.append((acc, np.full(acc.size, step), pos[acc].copy()))
+
+        # Assemble the polylines: backward part reversed, then forward part
+        traj = np.concatenate([entry[0] for entry in history])
+        steps = np.concatenate([entry[1] for entry in history])
+        points = np.concatenate([entry[2] for entry in history])
+        order = np.lexsort((steps, traj))
+        counts = np.bincount(traj, minlength=len(pos))
+        parts = np.split(points[order], np.cumsum(counts)[:-1])
+
+        lines = []
+        for n in range(len(seeds)):
+            if direction == 'backward':
+                lines.append(parts[n][::-1])
+            elif direction == 'forward' or closed[n]:
+                lines.append(parts[n])
+            else:
+                lines.append(np.concatenate([parts[n + len(seeds)][:0:-1], parts[n]]))
+        return lines
+
+
+    def compute_basis(self, x_range, y_range, resolution=30):
+        """
+        Compute the unit-current field of every Coil on the grid, once.
+
+        The field of a coil is linear in its current, so the field of the
+        scene for any set of coil currents is a linear combination of these
+        basis fields plus the static field of the other objects (magnets).
+
+        Sets X, Y, basis_coils (coils in the column order of the current
+        matrix of stream_frames), basis (n_coils, 2, n_points) and
+        static_Bx, static_By.
+        """
+        x = np.linspace(x_range[0], x_range[1], resolution)
+        y = np.linspace(y_range[0], y_range[1], resolution)
+        self.X, self.Y = np.meshgrid(x, y)
+        X_flat = self.X.ravel()
+        Y_flat = self.Y.ravel()
+
+        coils = [obj for obj in self.objects if isinstance(obj, Coil)]
+        others = [obj for obj in self.objects if not isinstance(obj, Coil)]
+
+        self.basis_coils = coils
+        self.basis = np.empty((len(coils), 2, X_flat.size))
+
+        for formulation in dict.fromkeys(coil.formulation for coil in coils):
+            index = np.array([j for j, coil in enumerate(coils) if coil.formulation == formulation])
+            table = Coil.pack([coils[j] for j in index])
+            table['current'] = np.ones(len(index))
+
+            for sources, points in self._chunks(len(index), X_flat.size, Coil.bytes_per_pair):
+                chunk = {c: v[sources] for c, v in table.items()}
+                bx, by = Coil.batch_field(chunk, X_flat[points], Y_flat[points], formulation)
+                self.basis[index[sources], 0, points] = bx
+                self.basis[index[sources], 1, points] = by
+
+        static = MagneticFieldSimulation(others, self.memory_budget, backend=self.backend)
+        self.static_Bx, self.static_By = static.field(self.X, self.Y)
+
+
+    def stream_frames(self, currents, frames_per_batch=None):
+        """
+        Yield (Bx, By) for each frame of a coil current matrix.
+
+        currents: (n_frames, n_coils) array, columns in basis_coils order
+            (e.g. sampled sine or PWM drive waveforms)
+        frames_per_batch: frames computed per matrix product (default: as
+            many as fit in memory_budget)
+
+        Frames are produced batch by batch with one matrix product each, so
+        long runs never hold every frame in memory. Requires compute_basis.
+        """
+        currents = np.atleast_2d(np.asarray(currents, dtype=float))
+        n_coils, _, n_points = self.basis.shape
+        if currents.shape[1] != n_coils:
+            raise ValueError(f"currents has {currents.shape[1]} columns, expected one per coil ({n_coils})")
+
+        if frames_per_batch is None:
+            frames_per_batch = max(1, self.memory_budget // (2 * n_points * 8))
+
+        basis = self.basis.reshape(n_coils, 2 * n_points)
+        static = np.concatenate([self.static_Bx.ravel(), self.static_By.ravel()])
+        shape = self.X.shape
+
+        for f0 in range(0, len(currents), frames_per_batch):
+            block = currents[f0:f0 + frames_per_batch] @ basis
+            block += static
+            for frame in block:
+                yield frame[:n_points].reshape(shape), frame[n_points:].reshape(shape)
+
+
+    def line_profile(self, start, end, n=100):
+        """
+        Field along straight line cuts, all evaluated in one call.
+
+        start, end: (x, y) end points of a cut, or arrays of shape (..., 2)
+            for several cuts
+        n: number of points per cut, end points included
+
+        Returns x, y, Bx, By of shape (..., n).
+        """
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        t = np.linspace(0.0, 1.0, n)
+        points = start[..., None, :] + (end - start)[..., None, :] * t[:, None]
+        x, y = points[..., 0], points[..., 1]
+        Bx, By = self.field(x, y)
+        return x, y, Bx, By
+
+
+    def snapshot(self, profiles=None, n=100):
+        """
+        Arrays and metadata of a snapshot, for fieldfile.write_arrays: the
+        computed grids (x, y vectors and Bx, By, Az) and line profiles.
+
+        profiles: dict name -> (start, end), evaluated together with
+            line_profile and stored as name/x, name/y, name/Bx, name/By
+
+        Prefix the array names to store several simulations in one file.
+        """
+        arrays = {}
+        if getattr(self, 'X', None) is not None:
+            arrays['x'], arrays['y'] = np.asarray(self.X)[0], np.asarray(self.Y)[:, 0]
+            for name in ('Bx', 'By', 'Az'):
+                if getattr(self, name, None) is not None and np.shape(getattr(self, name)) == np.shape(self.X):
+                    arrays[name] = getattr(self, name)
+
+        profiles = profiles or {}
+        if profiles:
+            names = list(profiles)
+            cuts = np.array([[profiles[name][0], profiles[name][1]] for name in names], dtype=float)
+            values = self.line_profile(cuts[:, 0], cuts[:, 1], n)
+            for k, name in enumerate(names):
+                for label, value in zip(('x', 'y', 'Bx', 'By'), values):
+                    arrays[f'{name}/{label}'] = value[k]
+
+        meta = {'scene_hash': self.scene_hash(), 'scene': [obj.to_dict() for obj in self.objects],
+                'grids': [name for name in ('Bx', 'By', 'Az') if name in arrays],
+                'profiles': {name: [list(map(float, start)), list(map(float, end))]
+                             for name, (start, end) in profiles.items()}}
+        return arrays, meta
+
+
+    def save_snapshot(self, path, profiles=None, n=100, meta=None):
+        """
+        Write snapshot() to a field file (see fieldfile.py), whose arrays
+        reopen memory-mapped with FieldFile(path). meta: extra metadata.
+        """
+        arrays, snapshot_meta = self.snapshot(profiles, n)
+        return write_arrays(path, arrays, {**snapshot_meta, **(meta or {})})
+
+
+    def load_field(self, path, check_scene=True):
+        """
+        Reopen a field file written by compute_field(out=...) without
+        recomputing. Bx, By (and X, Y if stored) stay memory-mapped.
+
+        check_scene: raise if the file was computed for another scene.
+        """
+        self.file = FieldFile(path)
+        if check_scene and self.file.meta['scene_hash'] != self.scene_hash():
+            raise ValueError(f"{path} was computed for another scene")
+
+        self.Bx, self.By = self.file['Bx'], self.file['By']
+        if 'X' in self.file:
+            self.X, self.Y = self.file['X'], self.file['Y']
+        else:
+            self._set_grid(self.file.x, self.file.y)
+
+
+    def _set_grid(self, x, y):
+        """X, Y as read-only broadcast views of the coordinate vectors (no memory)."""
+        shape = (len(y), len(x))
+        self.X = np.broadcast_to(np.asarray(x)[None, :], shape)
+        self.Y = np.broadcast_to(np.asarray(y)[:, None], shape)
+
+
+    def _compute_tile(self, x, y):
+        """Field on the tile spanned by the coordinate vectors x, y."""
+        return self.field(*np.meshgrid(x, y))
     
     
-    def plot_arrows(self):
+    @profiled('plot_arrows')
+    def plot_arrows(self, save_path='images/magnetic_field_arrows.png', show=True):
         """
         Plot the magnetic field as a vector field.
         
-        x_range: tuple (x_min, x_max)
-        y_range: tuple (y_min, y_max)
-        resolution: number of points along each axis
+        save_path: PNG file to write, or None
+        show: open the figure window (otherwise the figure is closed)
+        
+        For animations, renderer.FieldRenderer reuses one figure across frames.
         """
+        import matplotlib.pyplot as plt
+        from renderer import draw_objects
         
         # Compute field magnitude for coloring
         B_mag = np.sqrt(self.Bx**2 + self.By**2)
@@ -194,23 +1549,8 @@ class MagneticFieldSimulation:
         cbar.ax.yaxis.set_tick_params(color='white')
         plt.setp(plt.getp(cbar.ax.axes, 'yticklabels'), color='white')
         
-        # Draw coil representations
-        for objet in self.objects:
-            # Draw coil as a rectangle
-            rect = plt.Rectangle(
-                (objet.x - objet.radius, objet.y - objet.length/2),
-                2 * objet.radius,
-                objet.length,
-                fill=False,
-                edgecolor='#58a6ff',
-                linewidth=2,
-                linestyle='--',
-                label=f'Coil (r={objet.radius}, L={objet.length})'
-            )
-            ax.add_patch(rect)
-            
-            # Mark coil center
-            ax.plot(objet.x, objet.y, 'o', color='#f78166', markersize=8)
+        # Draw object outlines
+        draw_objects(ax, self.objects)
         
         # Styling
         ax.set_xlabel('x [m]', color='white', fontsize=12)
@@ -225,16 +1565,25 @@ class MagneticFieldSimulation:
         ax.grid(True, alpha=0.2, color='#30363d')
         
         plt.tight_layout()
-        plt.savefig('images/magnetic_field_arrows.png', dpi=150, facecolor='#0d1117', bbox_inches='tight')
-        plt.show()
+        if save_path is not None:
+            fig.savefig(save_path, dpi=150, facecolor='#0d1117', bbox_inches='tight')
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
 
 
-    def plot_lines(self, density=1.6):
+    @profiled('plot_lines')
+    def plot_lines(self, density=1.6, save_path='images/magnetic_field_lines.png', show=True):
         """
         Plot the magnetic field as continuous field lines (streamlines).
         
         density: controls the closeness of streamlines (default=2)
+        save_path: PNG file to write, or None
+        show: open the figure window (otherwise the figure is closed)
         """
+        import matplotlib.pyplot as plt
+        from renderer import draw_objects
         
         # Compute field magnitude for coloring
         B_mag = np.sqrt(self.Bx**2 + self.By**2)
@@ -263,23 +1612,8 @@ class MagneticFieldSimulation:
         cbar.ax.yaxis.set_tick_params(color='black')
         plt.setp(plt.getp(cbar.ax.axes, 'yticklabels'), color='black')
         
-        # Draw coil representations
-        for objet in self.objects:
-            # Draw coil as a rectangle
-            rect = plt.Rectangle(
-                (objet.x - objet.radius, objet.y - objet.length/2),
-                2 * objet.radius,
-                objet.length,
-                fill=False,
-                edgecolor='red',
-                linewidth=2,
-                linestyle='--',
-                label=f'Coil (r={objet.radius}, L={objet.length})'
-            )
-            ax.add_patch(rect)
-            
-            # Mark coil center
-            ax.plot(objet.x, objet.y, 'o', color='red', markersize=8)
+        # Draw object outlines
+        draw_objects(ax, self.objects, color='red', center_color='red')
         
         # Styling
         ax.set_xlabel('x [m]', color='black', fontsize=12)
@@ -294,45 +1628,74 @@ class MagneticFieldSimulation:
         ax.grid(True, alpha=0.3, color='gray', linestyle=':')
         
         plt.tight_layout()
-        plt.savefig('images/magnetic_field_lines.png', dpi=150, facecolor='white', bbox_inches='tight')
-        plt.show()
+        if save_path is not None:
+            fig.savefig(save_path, dpi=150, facecolor='white', bbox_inches='tight')
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
 
 
 
-if __name__ == "__main__":
-    
-    # Add coils at different positions
-    objects = [Coil(
-        x=-0.05, y=0.0,
-        radius=0.05,
-        length=0.20,
-        n_turns=100,
-        current=2.0
-    )]
-    
-    # objects.append(Coil(
-    #     x=0.1, y=0.20,
-    #     radius=0.05,
-    #     length=0.10,
-    #     n_turns=100,
-    #     current=1.0
-    # ))
-
-    objects.append(Magnet(
-        x = 0.1, y = 0.2,
-        moment = 0.1
-    ))
-    
-    sim = MagneticFieldSimulation(objects)
+# Dormand-Prince 5(4) tableau, stages 1 to 7 (the 7th is the first of the next step)
+_DOPRI_A = (
+    (),
+    (1/5,),
+    (3/40, 9/40),
+    (44/45, -56/15, 32/9),
+    (19372/6561, -25360/2187, 64448/6561, -212/729),
+    (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+    (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84),
+)
+_DOPRI_B5 = (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0)
+_DOPRI_B4 = (5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40)
 
-    sim.compute_field(
-        x_range=(-0.20, 0.20),
-        y_range=(-0.15, 0.35),
-        resolution=50
-    )
-    
-    # sim.plot_arrows()
-    sim.plot_lines()
-    
-    
 
+
+def _backend_field(backend, cls, objects, x, y, **kwargs):
+    """Field (Bx, By) of objects of class cls at points of any shape, through backend."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shape = np.broadcast_shapes(x.shape, y.shape)
+    Bx, By = backend.batch_field(cls, cls.pack(objects), np.broadcast_to(x, shape).ravel(),
+                                 np.broadcast_to(y, shape).ravel(), **kwargs)
+    return Bx.reshape(shape), By.reshape(shape)
+
+
+
+def _inplace_layout(x, y, dtype):
+    """Broadcast shape of the points, and the dtype of an in-place evaluation (default float64)."""
+    return np.broadcast_shapes(np.shape(x), np.shape(y)), np.dtype(float if dtype is None else dtype)
+
+
+
+def _split(n, parts):
+    """Split range(n) into at most `parts` contiguous slices of nearly equal size."""
+    bounds = np.linspace(0, n, min(parts, n) + 1).astype(int)
+    return [slice(b0, b1) for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+
+
+# Simulation of a process pool worker, set once per worker by _init_worker
+_worker_sim = None
+
+
+
+def _init_worker(objects, memory_budget, backend=None):
+    global _worker_sim
+    _worker_sim = MagneticFieldSimulation(objects, memory_budget, backend=backend)
+
+
+
+def _compute_tile(x, y):
+    return _worker_sim._compute_tile(x, y)
+
+
+
+if __name__ == "__main__":
+    # Scene defined in scenes/example.toml; see scene.py for the command line
+    import os
+    from scene import main
+
+    main([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenes', 'example.toml'),
+          '--plot', 'lines', '--show'])
@@ -0,0 +1,211 @@
+"""
+Parameter sweeps over scenes on a process pool, with a resumable store.
+
+A scene is a list of object dicts in the to_dict() format. Each computed
+scene is one field file (see fieldfile.py) in the store directory, named by
+the SHA-256 of the scene and grid. It holds Bx, By, the x, y coordinate
+vectors, the scene itself and scalar metrics in its header.
+
+Entries are written under a temporary name and renamed once complete, so
+an interrupted sweep never leaves a partial entry: running it again skips
+the scenes already in the store and computes the rest.
+
+Usage:
+    base = [Coil(...).to_dict(), Magnet(...).to_dict()]
+    scenes = parameter_grid(base, {(0, 'current'): [1, 2, 3], (1, 'x'): [0.05, 0.1]})
+    store = SweepStore('sweep')
+    sweep(scenes, store, (-0.2, 0.2), (-0.15, 0.35), 50, workers=8)
+    for key, meta in store.items():
+        print(meta['scene'], meta['metrics'])
+"""
+
+import copy
+import glob
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from fieldfile import FieldFile
+from simulation import MagneticFieldSimulation, object_from_dict
+
+
+
+def parameter_grid(base, parameters):
+    """
+    Scenes of the cartesian product of parameter values.
+
+    base: scene (list of object dicts) giving every other parameter
+    parameters: dict (object index, parameter name) -> list (or array) of values
+    """
+    names = list(parameters)
+    scenes = []
+    for values in itertools.product(*parameters.values()):
+        scene = copy.deepcopy(base)
+        for (index, name), value in zip(names, values):
+            scene[index][name] = value.item() if isinstance(value, np.generic) else value
+        scenes.append(scene)
+    return scenes
+
+
+
+def default_metrics(sim, Bx, By):
+    """Scalar summary of a field: max, mean and RMS of |B| over the finite points."""
+    B = np.hypot(Bx, By)
+    B = B[np.isfinite(B)]
+    if B.size == 0:
+        return {'B_max': float('nan'), 'B_mean': float('nan'), 'B_rms': float('nan')}
+    return {'B_max': float(B.max()), 'B_mean': float(B.mean()), 'B_rms': float(np.sqrt(np.mean(B**2)))}
+
+
+
+class SweepStore:
+    """
+    Directory of sweep results, one field file per scene.
+
+    Entries are only read through their header and memory maps, so listing
+    the metrics of a large sweep does not load any field.
+    """
+
+    suffix = '.field'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(scene, grid):
+        """SHA-256 of a scene and grid (x_range, y_range, resolution, dtype)."""
+        x_range, y_range, resolution, dtype = grid
+        description = {'scene': scene, 'x_range': list(map(float, x_range)),
+                       'y_range': list(map(float, y_range)), 'resolution': int(resolution),
+                       'dtype': np.dtype(dtype).str}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        return sorted(os.path.basename(path)[:-len(self.suffix)]
+                      for path in glob.glob(os.path.join(self.directory, '*' + self.suffix)))
+
+    def __len__(self):
+        return len(self.keys())
+
+    def load(self, key):
+        """Field file of an entry (Bx, By memory-mapped)."""
+        return FieldFile(self.path(key))
+
+    def items(self):
+        """(key, meta) of every entry, meta holding the scene, grid and metrics."""
+        for key in self.keys():
+            yield key, self.load(key).meta
+
+    def write(self, key, grid, scene, x, y, Bx, By, metrics):
+        """Write an entry atomically: to a temporary file, renamed once flushed."""
+        x_range, y_range, resolution, dtype = grid
+        shape = (len(y), len(x))
+        arrays = {'x': (x.shape, float), 'y': (y.shape, float), 'Bx': (shape, dtype), 'By': (shape, dtype)}
+        meta = {'x_range': list(map(float, x_range)), 'y_range': list(map(float, y_range)),
+                'resolution': int(resolution), 'dtype': np.dtype(dtype).str,
+                'scene_hash': MagneticFieldSimulation([object_from_dict(d) for d in scene]).scene_hash(),
+                'scene': scene, 'metrics': metrics}
+
+        tmp = f"{self.path(key)}.tmp-{os.getpid()}"
+        file = FieldFile.create(tmp, arrays, meta)
+        file['x'][:], file['y'][:] = x, y
+        file['Bx'][:], file['By'][:] = Bx, By
+        file.flush()
+        del file
+        os.replace(tmp, self.path(key))
+
+    def clean(self):
+        """Remove temporary files left by interrupted sweeps."""
+        for path in glob.glob(os.path.join(self.directory, '*' + self.suffix + '.tmp-*')):
+            os.remove(path)
+
+
+
+def _run_scene(directory, key, grid, scene, metrics):
+    """Compute one scene and write its entry (run in the pool workers)."""
+    x_range, y_range, resolution, dtype = grid
+    sim = MagneticFieldSimulation([object_from_dict(d) for d in scene])
+    sim.compute_field(x_range, y_range, resolution, dtype=dtype)
+    SweepStore(directory).write(key, grid, scene, sim.X[0], sim.Y[:, 0], sim.Bx, sim.By,
+                                metrics(sim, sim.Bx, sim.By))
+    return key
+
+
+
+def sweep(scenes, store, x_range, y_range, resolution=30, workers=None, dtype=float,
+          metrics=default_metrics, progress=None):
+    """
+    Compute the field of every scene on the grid into store.
+
+    scenes: iterable of scenes (lists of object dicts), e.g. parameter_grid()
+    store: SweepStore, or a directory
+    workers: number of worker processes (default: compute in this process).
+        At most 2 × workers scenes are in flight, so scenes can be a
+        generator of any length.
+    dtype: dtype of the stored Bx, By (e.g. np.float32 halves the store)
+    metrics: picklable function (sim, Bx, By) -> dict of floats, stored in
+        the entry header
+    progress: optional callback progress(done, skipped) after every scene
+
+    Scenes already in the store (or repeated in scenes) are skipped. Run one
+    sweep per store at a time: leftover temporary files are removed first.
+
+    Returns {'keys': key of every scene in order, 'computed': n, 'skipped': n}.
+    """
+    if not isinstance(store, SweepStore):
+        store = SweepStore(store)
+    store.clean()
+    grid = (tuple(x_range), tuple(y_range), int(resolution), np.dtype(dtype).str)
+
+    keys = []
+    pending = set()
+    computed = skipped = 0
+
+    def tasks():
+        nonlocal skipped
+        for scene in scenes:
+            key = store.key(scene, grid)
+            keys.append(key)
+            if key in pending or key in store:
+                skipped += 1
+                if progress is not None:
+                    progress(computed, skipped)
+                continue
+            pending.add(key)
+            yield key, scene
+
+    if not workers or workers <= 1:
+        for key, scene in tasks():
+            _run_scene(store.directory, key, grid, scene, metrics)
+            computed += 1
+            if progress is not None:
+                progress(computed, skipped)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = set()
+            for key, scene in tasks():
+                futures.add(pool.submit(_run_scene, store.directory, key, grid, scene, metrics))
+                if len(futures) >= 2 * workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        computed += 1
+                        if progress is not None:
+                            progress(computed, skipped)
+            for future in futures:
+                future.result()
+                computed += 1
+                if progress is not None:
+                    progress(computed, skipped)
+
+    return {'keys': keys, 'computed': computed, 'skipped': skipped}
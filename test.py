@@ -4,4 +4,1041 @@ import numpy as np
 phi = np.array([2.0])
 kp = np.array([0.5])  # kp**2 should be between 0 and 1 for elliptic integrals
     
-print(special.ellipkinc(phi, kp**2))
\ No newline at end of file
+print(special.ellipkinc(phi, kp**2))
+
+
+def test_coil_field_matches_get_Br_get_Bz():
+    from functions import coil_field, get_Br, get_Bz
+
+    a, mu, n, i, length = 0.05, 4*np.pi*1e-7, 500.0, 2.0, 0.2
+    x = np.linspace(0.0, 0.2, 101)
+    z = np.linspace(-0.25, 0.25, 103)
+    R, Z = np.meshgrid(x, z)
+    r = R.flatten()
+    ksi_low = Z.flatten() - length / 2
+    ksi_high = Z.flatten() + length / 2
+
+    Br, Bz = coil_field(a, mu, n, i, r, ksi_low, ksi_high)
+    Br_ref = get_Br(a, mu, n, i, r, ksi_low, ksi_high)
+    Bz_ref = get_Bz(a, mu, n, i, r, ksi_low, ksi_high)
+
+    np.testing.assert_allclose(Br, Br_ref, rtol=1e-12, atol=0)
+    np.testing.assert_allclose(Bz, Bz_ref, rtol=1e-12, atol=0)
+
+    Br0, Bz0 = coil_field(a, mu, n, i, 0.02, 0.01 - length / 2, 0.01 + length / 2)
+    assert np.isclose(Br0, get_Br(a, mu, n, i, 0.02, 0.01 - length / 2, 0.01 + length / 2), rtol=1e-12)
+    assert np.isclose(Bz0, get_Bz(a, mu, n, i, 0.02, 0.01 - length / 2, 0.01 + length / 2), rtol=1e-12)
+
+
+
+def test_cel_complete_integrals():
+    from functions import cel
+
+    kc = np.array([1e-6, 0.1, 0.5, 0.9, 1.0])
+    np.testing.assert_allclose(cel(kc, 1, 1, 1), special.ellipkm1(kc**2), rtol=1e-13)
+    np.testing.assert_allclose(cel(kc, 1, 1, kc**2), special.ellipe(1 - kc**2), rtol=1e-13)
+
+
+
+def test_coil_field_cel_matches_heuman_away_from_singular_points():
+    from functions import coil_field, coil_field_cel
+
+    a, mu, n, i, length = 0.05, 4*np.pi*1e-7, 500.0, 2.0, 0.2
+    rng = np.random.default_rng(0)
+    r = rng.uniform(0.005, 0.04, 500)
+    z = rng.uniform(-0.08, 0.08, 500)
+
+    Br, Bz = coil_field(a, mu, n, i, r, z - length / 2, z + length / 2)
+    Br_cel, Bz_cel = coil_field_cel(a, mu, n, i, r, z - length / 2, z + length / 2)
+
+    np.testing.assert_allclose(Br_cel, Br, rtol=1e-10, atol=1e-15)
+    np.testing.assert_allclose(Bz_cel, Bz, rtol=1e-10)
+
+    # On axis, cel gives the exact finite-solenoid value
+    _, Bz_axis = coil_field_cel(a, mu, n, i, 0.0, -length / 2, length / 2)
+    assert np.isclose(Bz_axis, mu * n * i * (length / 2) / np.hypot(length / 2, a), rtol=1e-13)
+
+
+
+def _random_scene(n_coils=6, n_magnets=4, seed=0):
+    from simulation import Coil, Magnet
+
+    rng = np.random.default_rng(seed)
+    objects = [Coil(rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2), rng.uniform(0.01, 0.05),
+                    rng.uniform(0.03, 0.2), 100, rng.uniform(-2, 2),
+                    formulation='cel' if j % 2 else 'heuman')
+               for j in range(n_coils)]
+    objects += [Magnet(rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2))
+                for _ in range(n_magnets)]
+    return objects
+
+
+
+def test_batched_compute_field_matches_per_object_sum():
+    from simulation import MagneticFieldSimulation
+
+    objects = _random_scene()
+    sim = MagneticFieldSimulation(objects)
+    sim.compute_field((-0.3, 0.3), (-0.3, 0.3), resolution=41)
+
+    Bx = np.zeros_like(sim.X)
+    By = np.zeros_like(sim.Y)
+    for obj in objects:
+        bx, by = obj.field(sim.X, sim.Y)
+        Bx += bx
+        By += by
+
+    np.testing.assert_allclose(sim.Bx, Bx, rtol=1e-9, atol=1e-12 * np.abs(Bx).max())
+    np.testing.assert_allclose(sim.By, By, rtol=1e-9, atol=1e-12 * np.abs(By).max())
+
+    # A tiny memory budget forces chunking over sources and points
+    small = MagneticFieldSimulation(objects, memory_budget=10**5)
+    small.compute_field((-0.3, 0.3), (-0.3, 0.3), resolution=41)
+    np.testing.assert_allclose(small.Bx, sim.Bx, rtol=0, atol=1e-13 * np.abs(Bx).max())
+    np.testing.assert_allclose(small.By, sim.By, rtol=0, atol=1e-13 * np.abs(By).max())
+
+
+
+def test_tiled_compute_field_is_bit_identical():
+    from simulation import MagneticFieldSimulation
+
+    sim = MagneticFieldSimulation(_random_scene(seed=1))
+    sim.compute_field((-0.3, 0.3), (-0.25, 0.35), resolution=37)
+    Bx, By = sim.Bx, sim.By
+
+    for tiles, workers, executor in [((3, 2), None, 'thread'), ((4, 3), 3, 'thread'), (None, 2, 'process')]:
+        sim.compute_field((-0.3, 0.3), (-0.25, 0.35), resolution=37, tiles=tiles, workers=workers, executor=executor)
+        np.testing.assert_array_equal(sim.Bx, Bx)
+        np.testing.assert_array_equal(sim.By, By)
+
+
+
+def test_compute_field_to_memory_mapped_file(tmp_path):
+    from simulation import MagneticFieldSimulation
+    from fieldfile import FieldFile
+
+    objects = _random_scene(seed=2)
+    domain = dict(x_range=(-0.3, 0.3), y_range=(-0.2, 0.4), resolution=45)
+
+    sim = MagneticFieldSimulation(objects)
+    sim.compute_field(**domain)
+
+    path = tmp_path / 'scene.emf'
+    disk = MagneticFieldSimulation(objects)
+    disk.compute_field(**domain, out=path, store_grid=True, tiles=(5, 2))
+    np.testing.assert_array_equal(disk.Bx, sim.Bx)
+    np.testing.assert_array_equal(disk.By, sim.By)
+    np.testing.assert_array_equal(disk.X, sim.X)
+
+    # Reopen without recomputing, slice a subregion
+    field = FieldFile(path)
+    assert field.meta['resolution'] == 45
+    assert field.meta['scene_hash'] == sim.scene_hash()
+    x, y, region = field.region((0.0, 0.1), (-0.2, 0.0))
+    cols = (sim.X[0] >= 0.0) & (sim.X[0] <= 0.1)
+    rows = (sim.Y[:, 0] >= -0.2) & (sim.Y[:, 0] <= 0.0)
+    np.testing.assert_array_equal(x, sim.X[0, cols])
+    np.testing.assert_array_equal(region['By'], sim.By[np.ix_(rows, cols)])
+
+    reopened = MagneticFieldSimulation(objects)
+    reopened.load_field(path)
+    np.testing.assert_array_equal(reopened.Bx, sim.Bx)
+
+    # Coordinate vectors only, single precision
+    light = MagneticFieldSimulation(objects)
+    light.compute_field(**domain, out=tmp_path / 'light.emf', dtype=np.float32)
+    assert 'X' not in light.file and light.Bx.dtype == np.float32
+    np.testing.assert_array_equal(light.X, sim.X)
+    np.testing.assert_array_equal(light.By, sim.By.astype(np.float32))
+
+
+
+def test_field_cache_recomputes_only_changed_objects():
+    from simulation import Coil, MagneticFieldSimulation
+    from cache import FieldCache
+
+    objects = _random_scene(n_coils=8, n_magnets=4, seed=3)
+    domain = dict(x_range=(-0.3, 0.3), y_range=(-0.3, 0.3), resolution=31)
+    sim = MagneticFieldSimulation(objects, cache=FieldCache())
+
+    sim.compute_field(**domain)
+    assert sim.cache.stats()['misses'] == len(objects)
+
+    objects[2].current *= -1.5
+    objects[9].x += 0.01
+    sim.compute_field(**domain)
+    assert sim.cache.stats()['misses'] == len(objects) + 2
+
+    reference = MagneticFieldSimulation(objects)
+    reference.compute_field(**domain)
+    scale = np.abs(reference.By).max()
+    np.testing.assert_allclose(sim.Bx, reference.Bx, rtol=0, atol=1e-12 * scale)
+    np.testing.assert_allclose(sim.By, reference.By, rtol=0, atol=1e-12 * scale)
+
+    # Undoing a change hits the cache
+    objects[2].current /= -1.5
+    sim.compute_field(**domain)
+    assert sim.cache.stats()['misses'] == len(objects) + 2
+
+    # A budget of two contributions evicts, the result stays correct
+    small = MagneticFieldSimulation(objects, cache=FieldCache(max_bytes=2 * 2 * 31 * 31 * 8))
+    small.compute_field(**domain)
+    objects[0].y += 0.02
+    small.compute_field(**domain)
+    reference.compute_field(**domain)
+    assert small.cache.stats()['evictions'] > 0 and len(small.cache) <= 2
+    np.testing.assert_allclose(small.By, reference.By, rtol=0, atol=1e-12 * scale)
+
+    # Moving a coil whose end faces lie on grid rows (NaN there) off them
+    # leaves no NaN behind in the total
+    coil = Coil(0.0, 0.0, 0.05, 0.2, 100, 1.0)
+    domain = dict(x_range=(-0.2, 0.2), y_range=(-0.1, 0.1), resolution=41)
+    cached = MagneticFieldSimulation([coil, objects[4]], cache=FieldCache())
+    cached.compute_field(**domain)
+    assert np.isnan(cached.By).sum() > 0
+    coil.y = 0.037
+    cached.compute_field(**domain)
+    reference = MagneticFieldSimulation([coil, objects[4]])
+    reference.compute_field(**domain)
+    assert np.isnan(reference.By).sum() == np.isnan(cached.By).sum() == 0
+    np.testing.assert_allclose(cached.Bx, reference.Bx, rtol=1e-12)
+    np.testing.assert_allclose(cached.By, reference.By, rtol=1e-12)
+
+
+
+def test_basis_frames_match_compute_field():
+    from simulation import MagneticFieldSimulation, Coil
+
+    objects = _random_scene(n_coils=5, n_magnets=2, seed=4)
+    domain = dict(x_range=(-0.3, 0.3), y_range=(-0.3, 0.3), resolution=25)
+    sim = MagneticFieldSimulation(objects)
+    sim.compute_basis(**domain)
+
+    t = np.linspace(0, 0.02, 7)[:, None]
+    currents = 2.0 * np.sin(2 * np.pi * 50 * t + np.arange(5)[None, :])
+    frames = list(sim.stream_frames(currents, frames_per_batch=3))
+    assert len(frames) == len(currents)
+
+    coils = [obj for obj in objects if isinstance(obj, Coil)]
+    reference = MagneticFieldSimulation(objects)
+    for frame, (Bx, By) in zip(currents, frames):
+        for coil, current in zip(coils, frame):
+            coil.current = current
+        reference.compute_field(**domain)
+        scale = np.abs(reference.By).max()
+        np.testing.assert_allclose(Bx, reference.Bx, rtol=0, atol=1e-12 * scale)
+        np.testing.assert_allclose(By, reference.By, rtol=0, atol=1e-12 * scale)
+
+
+
+def test_extended_magnet_tree_code_matches_direct_sum():
+    from simulation import ExtendedMagnet, Magnet
+    from functions import dipole_field
+
+    magnet = ExtendedMagnet(x=0.02, y=-0.01, n_x=16, n_y=32, angle=30, leaf_size=16)
+    rng = np.random.default_rng(5)
+    angle = rng.uniform(0, 2 * np.pi, 300)
+    distance = rng.uniform(0.05, 0.3, 300)
+    x = magnet.x + distance * np.cos(angle)
+    y = magnet.y + distance * np.sin(angle)
+
+    # Direct sum against an explicit loop over dipoles
+    Bx, By = magnet.direct_field(x, y)
+    Bx_ref, By_ref = np.zeros_like(x), np.zeros_like(y)
+    for px, py, mx, my in zip(*magnet.dipoles()):
+        bx, by = dipole_field(mx, my, magnet.mu, x - px, y - py)
+        Bx_ref += bx
+        By_ref += by
+    np.testing.assert_allclose(Bx, Bx_ref, rtol=1e-12, atol=1e-12 * np.abs(By_ref).max())
+    np.testing.assert_allclose(By, By_ref, rtol=1e-12, atol=1e-12 * np.abs(By_ref).max())
+
+    # A single dipole along y is the Python Magnet
+    single = ExtendedMagnet(x=0.1, y=0.2, n_x=1, n_y=1)
+    np.testing.assert_allclose(single.field(x, y), Magnet(x=0.1, y=0.2).field(x, y), rtol=1e-12)
+
+    # Tree code error decreases with the opening angle
+    B = np.hypot(Bx_ref, By_ref)
+    errors = []
+    for theta in (0.5, 0.2, 0.05):
+        magnet.theta = theta
+        Bx, By = magnet.field(x, y)
+        errors.append(np.max(np.hypot(Bx - Bx_ref, By - By_ref) / B))
+    assert errors[0] < 0.2 and errors[1] < 1e-2 and errors[2] < 1e-4
+    assert errors[0] > errors[1] > errors[2]
+
+    # Leaves are summed within the memory budget: one leaf of 512 dipoles
+    # against 40000 points stays far below the 160 MB of a single block
+    import tracemalloc
+    X, Y = np.meshgrid(np.linspace(0.1, 0.3, 200), np.linspace(0.1, 0.3, 200))
+    leaf = ExtendedMagnet(x=0.02, y=-0.01, n_x=16, n_y=32, angle=30, theta=0.01, leaf_size=1024)
+    expected = leaf.field(X, Y)
+    leaf.memory_budget = 2**20
+    tracemalloc.start()
+    result = leaf.field(X, Y)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 8 * 2**20
+    np.testing.assert_array_equal(result, expected)
+
+
+
+def test_rope_crank_nicolson_mode_and_large_steps():
+    from rope import Rope
+    from simulation import MagneticFieldSimulation, Magnet
+
+    # Undamped fundamental mode against the frequency of the discrete string
+    rope = Rope(y=0.0, length=0.3, density=100, damping=0.0)
+    sim = MagneticFieldSimulation([rope])
+    i = np.arange(rope.n)
+    mode = np.sin(np.pi * i / (rope.n - 1))
+    rope.displacement = 1e-3 * mode
+    c = np.sqrt(rope.tension / rope.line_mass_density)
+    omega = 2 * c / rope.dx * np.sin(np.pi / (2 * (rope.n - 1)))
+
+    t, u = rope.run(sim, duration=0.02, dt=2e-6, record_every=100, align=False)
+    np.testing.assert_allclose(u, 1e-3 * np.cos(omega * t)[:, None] * mode, rtol=0, atol=1e-6)
+
+    # 20 ms steps (~2800 explicit substeps each) with backward Euler:
+    # stable, and settles to the static deflection T u'' + f = 0 under a magnet
+    rope = Rope(y=0.0)
+    sim = MagneticFieldSimulation([rope, Magnet(x=0.0, y=0.03, moment=0.1)])
+    rope.update_alignment(sim)
+    rope.displacement[1:-1] = 1e-3
+    t, u = rope.run(sim, duration=10.0, dt=0.02, record_every=50, theta=1.0)
+    assert np.all(np.isfinite(u)) and np.abs(u).max() < 1e-2
+
+    force = rope.magnetic_force(sim)
+    u = rope.displacement
+    residual = rope.tension * (u[2:] - 2 * u[1:-1] + u[:-2]) / rope.dx**2 + force[1:-1]
+    assert np.abs(residual).max() < 1e-3 * np.abs(force).max()
+
+
+
+def test_field_gradient_matches_finite_differences():
+    from simulation import MagneticFieldSimulation, ExtendedMagnet
+
+    objects = _random_scene(n_coils=4, n_magnets=2, seed=6)
+    objects.append(ExtendedMagnet(x=0.05, y=-0.1, n_x=4, n_y=6, angle=30))
+    sim = MagneticFieldSimulation(objects)
+
+    rng = np.random.default_rng(7)
+    x = rng.uniform(-0.3, 0.3, 500)
+    y = rng.uniform(-0.3, 0.3, 500)
+    h = 1e-6
+
+    gradient = sim.gradient(x, y)
+    Bx_px, By_px = sim.field(x + h, y)
+    Bx_mx, By_mx = sim.field(x - h, y)
+    Bx_py, By_py = sim.field(x, y + h)
+    Bx_my, By_my = sim.field(x, y - h)
+    reference = ((Bx_px - Bx_mx) / (2 * h), (Bx_py - Bx_my) / (2 * h),
+                 (By_px - By_mx) / (2 * h), (By_py - By_my) / (2 * h))
+
+    scale = np.max(np.abs(gradient), axis=0)
+    for g, g_ref in zip(gradient, reference):
+        assert np.median(np.abs(g - g_ref) / scale) < 1e-8
+        assert np.percentile(np.abs(g - g_ref) / scale, 95) < 1e-6
+    np.testing.assert_allclose(gradient[1], gradient[2], rtol=1e-9, atol=1e-12 * scale.max())
+
+    sim.compute_gradient(x_range=(-0.2, 0.2), y_range=(-0.2, 0.2), resolution=11)
+    np.testing.assert_array_equal(sim.dBy_dy, sim.gradient(sim.X, sim.Y)[3])
+
+
+
+def test_coil_potential_matches_turn_sum_and_field():
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+    from functions import loop_potential
+
+    coil = Coil(x=0.02, y=-0.01, radius=0.05, length=0.2, n_turns=2000, current=1.5)
+    rng = np.random.default_rng(8)
+    x = np.concatenate([rng.uniform(-0.25, 0.25, 300), [0.02, 0.07, 0.0701]])
+    y = np.concatenate([rng.uniform(-0.25, 0.25, 300), [0.05, -0.01, 0.09]])
+
+    # Frontend model: sum of the potentials of every turn
+    r = np.abs(x - coil.x)
+    z = y - coil.y
+    dz = coil.length / coil.n_turns
+    A_phi = sum(loop_potential(coil.radius, coil.mu, coil.current, r, z - (-coil.length / 2 + (j + 0.5) * dz))
+                for j in range(coil.n_turns))
+    Az_turns = -np.where(x - coil.x >= 0, 1, -1) * A_phi
+
+    # The discrete turns and the continuous current sheet differ on the windings
+    away = np.hypot(r - coil.radius, np.maximum(np.abs(z) - coil.length / 2, 0)) > 1e-3
+    Az = coil.potential(x, y)
+    assert np.all(np.isfinite(Az))
+    np.testing.assert_allclose(Az[away], Az_turns[away], rtol=1e-4, atol=1e-6 * np.abs(Az).max())
+
+    # Bx = ∂Az/∂y for the coil
+    h = 1e-6
+    dAz_dy = (coil.potential(x, y + h) - coil.potential(x, y - h)) / (2 * h)
+    Bx, By = coil.field(x, y)
+    np.testing.assert_allclose(dAz_dy[away], Bx[away], rtol=0, atol=1e-7 * np.abs(By[away]).max())
+
+    sim = MagneticFieldSimulation([coil, Magnet(x=0.1, y=0.2)])
+    sim.compute_potential(x_range=(-0.2, 0.2), y_range=(-0.2, 0.3), resolution=21)
+    np.testing.assert_allclose(sim.Az, coil.potential(sim.X, sim.Y) + sim.objects[1].potential(sim.X, sim.Y))
+
+
+
+def test_trace_lines_follow_exact_field_lines():
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    # Point dipole along y: r / sin²θ is constant along a field line
+    magnet = Magnet(x=0.1, y=0.2)
+    sim = MagneticFieldSimulation([magnet])
+    domain = dict(x_range=(-0.2, 0.2), y_range=(-0.15, 0.35))
+    rng = np.random.default_rng(9)
+    seeds = np.column_stack([rng.uniform(-0.2, 0.2, 200), rng.uniform(-0.15, 0.35, 200)])
+    lines = sim.trace_lines(seeds, **domain, tol=1e-9)
+
+    assert len(lines) == len(seeds)
+    for seed, line in zip(seeds, lines):
+        assert np.any(np.all(line == seed, axis=1))
+        dx, dy = line[1:-1, 0] - magnet.x, line[1:-1, 1] - magnet.y
+        r_sq = dx**2 + dy**2
+        invariant = (r_sq**1.5 / dx**2)[dx**2 > 1e-2 * r_sq]
+        if invariant.size > 1:
+            assert np.ptp(invariant) < 1e-4 * invariant.mean()
+
+        # Both ends are on the domain boundary or at the dipole
+        for x, y in (line[0], line[-1]):
+            on_boundary = np.isclose(x, domain['x_range']).any() or np.isclose(y, domain['y_range']).any()
+            assert on_boundary or np.hypot(x - magnet.x, y - magnet.y) < 1e-3
+
+    # Lines through a solenoid close on themselves
+    sim = MagneticFieldSimulation([Coil(x=0.0, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0,
+                                        formulation='cel')])
+    for line in sim.trace_lines(np.array([[0.03, 0.0], [-0.02, 0.05]]), x_range=(-1, 1), y_range=(-1, 1)):
+        np.testing.assert_array_equal(line[0], line[-1])
+        assert np.abs(line[:, 1]).max() > 0.1
+
+
+
+def test_measurement_coil_flux_and_batched_time_series():
+    import pytest
+    from simulation import MagneticFieldSimulation, Coil, Magnet, MeasurementCoil
+    from functions import coil_potential
+
+    # Coaxial pickup: the flux is N 2πR A_φ(R) (Stokes)
+    source = Coil(x=0.0, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0, formulation='cel')
+    pickup = MeasurementCoil(x=0.0, y=0.15, radius=0.03, n_turns=10, n_radial=8, n_angular=16)
+    sim = MagneticFieldSimulation([source, pickup])
+    reference = pickup.n_turns * 2 * np.pi * pickup.radius * coil_potential(
+        source.radius, source.mu, source.n, source.current, pickup.radius, 0.15 - 0.1, 0.15 + 0.1)
+    np.testing.assert_allclose(pickup.flux(sim), reference, rtol=1e-9)
+
+    # Batched series against frame by frame flux
+    pickups = [MeasurementCoil(x=0.15, y=y, radius=0.02, n_axial=2) for y in (-0.1, 0.0, 0.12)]
+    coils = [source, Coil(x=-0.1, y=0.1, radius=0.03, length=0.05, n_turns=50, current=0.0)]
+    sim = MagneticFieldSimulation(coils + [Magnet(x=0.1, y=0.2)] + pickups)
+    times = np.linspace(0, 0.04, 81)
+    currents = np.column_stack([2 * np.sin(2 * np.pi * 50 * times), np.cos(2 * np.pi * 75 * times)])
+    result = sim.measure(times, currents)
+
+    flux = []
+    for frame in currents:
+        for coil, current in zip(coils, frame):
+            coil.current = current
+        flux.append(sim.flux())
+    np.testing.assert_allclose(result['flux'], flux, rtol=1e-10, atol=1e-12 * np.abs(flux).max())
+    np.testing.assert_allclose(result['emf'], -np.gradient(np.array(flux), times, axis=0),
+                               rtol=1e-8, atol=1e-8 * np.abs(result['emf']).max())
+    np.testing.assert_allclose(result['current'], result['emf'] / 10)
+
+    # Moving sources: per-step positions and moments, with the currents
+    steps = np.linspace(0, 0.04, 41)
+    states = {coils[1]: {'x': -0.1 + 0.5 * steps, 'y': 0.1 - steps},
+              2: {'y': 0.2 + 0.3 * steps, 'moment': 0.1 * np.cos(2 * np.pi * 25 * steps)}}
+    small = MagneticFieldSimulation(sim.objects, memory_budget=2**18)
+    result = small.measure(steps, currents[::2], states=states)
+    magnet = sim.objects[2]
+    flux = []
+    for k, frame in enumerate(currents[::2]):
+        for coil, current in zip(coils, frame):
+            coil.current = current
+        coils[1].x, coils[1].y = states[coils[1]]['x'][k], states[coils[1]]['y'][k]
+        magnet.y, magnet.moment = states[2]['y'][k], states[2]['moment'][k]
+        flux.append(sim.flux())
+    np.testing.assert_allclose(result['flux'], flux, rtol=1e-10, atol=1e-12 * np.abs(flux).max())
+
+    # State that would be ignored is refused
+    with pytest.raises(ValueError, match='radius'):
+        sim.measure(steps, states={coils[0]: {'radius': np.full(41, 0.02)}})
+    with pytest.raises(ValueError, match='MeasurementCoil'):
+        sim.measure(steps, states={pickups[0]: {'x': steps}})
+    with pytest.raises(ValueError, match='shape'):
+        sim.measure(steps, states={2: {'x': steps[:-1]}})
+
+
+
+def test_renderer_reuses_figure_and_writes_frames(tmp_path):
+    import sys
+    from matplotlib.image import imread
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+    from renderer import FieldRenderer, PNGSequence, EncoderPipe, render_frames
+    from rope import Rope
+
+    sim = MagneticFieldSimulation([Coil(x=0.0, y=0.0, radius=0.05, length=0.1, n_turns=100, current=1.0),
+                                   Magnet(x=0.1, y=0.05)])
+    sim.compute_basis((-0.15, 0.15), (-0.1, 0.1), 15)
+    currents = np.column_stack([np.linspace(-1, 1, 4)])
+
+    # One figure and one quiver for every frame, updated in place
+    renderer = FieldRenderer(sim.X, sim.Y, sim.objects, figsize=(4, 3), dpi=50)
+    quiver = renderer.quiver
+    frames = [renderer.render(Bx, By).copy() for Bx, By in sim.stream_frames(currents)]
+    assert renderer.quiver is quiver and len(renderer.figure.axes) == 2
+    width, height = renderer.size
+    assert frames[0].shape == (height, width, 4)
+    assert not np.array_equal(frames[0], frames[-1])       # the coil current reverses
+
+    # Ropes have no center: drawn as their dipole line by plot_arrows / plot_lines
+    with_rope = MagneticFieldSimulation(sim.objects + [Rope(y=-0.05, length=0.2, density=50)])
+    with_rope.compute_field((-0.15, 0.15), (-0.1, 0.1), 15)
+    with_rope.plot_arrows(save_path=tmp_path / 'rope_arrows.png', show=False)
+    with_rope.plot_lines(save_path=tmp_path / 'rope_lines.png', show=False)
+    assert imread(tmp_path / 'rope_arrows.png').shape[-1] == 4
+    assert (tmp_path / 'rope_lines.png').stat().st_size > 0
+
+    # PNG sequence, rendered in this process and by worker processes
+    serial = PNGSequence(tmp_path / 'serial')
+    parallel = PNGSequence(tmp_path / 'parallel')
+    options = dict(figsize=(4, 3), dpi=50)
+    assert render_frames(sim.stream_frames(currents), sim.X, sim.Y, serial, sim.objects, **options) == 4
+    assert render_frames(sim.stream_frames(currents), sim.X, sim.Y, parallel, sim.objects, workers=2, **options) == 4
+    for i in range(4):
+        assert np.array_equal(imread(serial.path(i)), imread(parallel.path(i)))
+
+    # Raw frames piped in order to an encoder process
+    out = tmp_path / 'raw.bin'
+    command = [sys.executable, '-c', f'import sys; open({str(out)!r}, "wb").write(sys.stdin.buffer.read())']
+    with EncoderPipe(command) as writer:
+        render_frames(sim.stream_frames(currents), sim.X, sim.Y, writer, sim.objects, workers=2, **options)
+    raw = np.frombuffer(out.read_bytes(), dtype=np.uint8).reshape(4, height, width, 4)
+    assert np.array_equal(raw, np.stack(frames))
+
+
+
+def test_sweep_store_skips_and_resumes(tmp_path):
+    import os
+    from simulation import MagneticFieldSimulation, Coil, Magnet, ExtendedMagnet, MeasurementCoil, object_from_dict
+    from rope import Rope
+    from sweep import SweepStore, parameter_grid, sweep
+
+    # Every object type round-trips through to_dict / object_from_dict
+    rope = Rope(y=0.1, length=0.02)
+    rope.displacement[3] = 1e-3
+    for obj in (Coil(x=0.0, y=0.0, radius=0.05, length=0.1, n_turns=100, current=1.0, formulation='cel'),
+                Magnet(x=0.1, y=0.2), ExtendedMagnet(x=0.0, y=0.1, theta=0.5), MeasurementCoil(x=0.1, y=0.0), rope):
+        assert object_from_dict(obj.to_dict()).to_dict() == obj.to_dict()
+
+    base = [Coil(x=0.0, y=0.0, radius=0.05, length=0.1, n_turns=100, current=1.0, formulation='cel').to_dict(),
+            Magnet(x=0.1, y=0.1).to_dict()]
+    scenes = parameter_grid(base, {(0, 'current'): np.array([1.0, 2.0]), (1, 'x'): [0.1, 0.15]})
+    grid = ((-0.1, 0.2), (-0.1, 0.15), 12)
+    store = SweepStore(tmp_path / 'store')
+
+    result = sweep(scenes + scenes[:1], store, *grid, workers=2)
+    assert (result['computed'], result['skipped'], len(store)) == (4, 1, 4)
+    assert result['keys'][4] == result['keys'][0]
+
+    for key, scene in zip(result['keys'], scenes):
+        sim = MagneticFieldSimulation([object_from_dict(d) for d in scene])
+        sim.compute_field(*grid)
+        entry = store.load(key)
+        assert entry.meta['scene'] == scene
+        np.testing.assert_array_equal(entry['Bx'], sim.Bx)
+        np.testing.assert_array_equal(entry['By'], sim.By)
+        assert entry.meta['metrics']['B_max'] == np.nanmax(np.hypot(sim.Bx, sim.By))
+
+    # Resume after an interruption: a missing entry and a partial temporary file
+    os.remove(store.path(result['keys'][2]))
+    (tmp_path / 'store' / (result['keys'][2] + '.field.tmp-1')).write_bytes(b'partial')
+    result = sweep(scenes, store, *grid)
+    assert (result['computed'], result['skipped'], len(store)) == (1, 3, 4)
+    assert sorted(os.listdir(tmp_path / 'store')) == [key + '.field' for key in store.keys()]
+
+
+
+def test_benchmark_suite_json_and_compare(tmp_path):
+    import copy
+    import json
+    from benchmark import bench_suite, compare
+
+    path = tmp_path / 'results.json'
+    results = bench_suite(resolutions=(20,), n_sources=(1, 4), n_points=3, n_timing=100, repeat=1,
+                          json_path=str(path))
+    saved = json.loads(path.read_text())
+    assert saved == json.loads(json.dumps(results))
+    assert {t['name'] for t in saved['timing']} >= {'get_Br/get_Bz', 'coil_field_cel', 'Coil.field',
+                                                     'Magnet.field', 'compute_field', 'field (sources)'}
+    cel = {a['region']: a for a in saved['accuracy'] if a['name'] == 'coil_field_cel'}
+    assert len(cel) == 6 and all(a['Br'] < 1e-6 and a['Bz'] < 1e-10 for a in cel.values())
+
+    assert compare(str(path), results) == []
+    slower = copy.deepcopy(saved)
+    slower['timing'][0]['seconds'] *= 2
+    slower['accuracy'][-1]['Bz'] = None
+    assert len(compare(saved, slower)) == 2
+
+
+
+def test_profile_records_phases_counters_and_memory(tmp_path):
+    import json
+    import profiling
+    from profiling import Profile
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    sim = MagneticFieldSimulation([Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0),
+                                   Coil(x=0.1, y=0.0, radius=0.03, length=0.1, n_turns=50, current=1.0,
+                                        formulation='cel'),
+                                   Magnet(x=0.1, y=0.2)], backend='numpy')
+    with Profile() as profile:
+        sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 40)
+    assert profiling._active is None
+
+    stats = profile.stats()
+    phases = stats['phases']
+    assert phases['compute_field']['calls'] == 1
+    assert phases['compute_field/field']['points'] == 1600
+    assert phases['compute_field/field/Coil']['calls'] == 2       # one batched group per formulation
+    assert phases['compute_field/field/Magnet']['points'] == 1600
+    assert phases['compute_field/field/Coil/coil_field/special']['calls'] == 8
+    assert phases['compute_field/field/Coil/coil_field']['peak_bytes'] > 1600 * 8
+    assert phases['compute_field/field']['seconds'] <= phases['compute_field']['seconds']
+
+    # Points off the heuman coil's axis: two end faces, one K, E, F, E(φ) each
+    off_axis = np.count_nonzero(np.abs(sim.X - (-0.05)) > 1e-10)
+    assert stats['counters']['ellipk'] == stats['counters']['ellipkinc'] == 2 * off_axis
+    assert stats['counters']['cel'] == 2 * 2 * 1600
+
+    profile.to_json(tmp_path / 'profile.json')
+    assert json.loads((tmp_path / 'profile.json').read_text()) == json.loads(json.dumps(stats))
+
+    # Nothing is recorded outside the context
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 40)
+    assert profile.stats() == stats
+
+
+
+def test_adaptive_sampling_refines_near_sources():
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0, formulation='cel'),
+               Magnet(x=0.1, y=0.2, moment=0.1)]
+    sim = MagneticFieldSimulation(objects)
+    adaptive = sim.compute_adaptive((-0.2, 0.2), (-0.15, 0.35), resolution=300)
+
+    # Far fewer evaluations than the uniform grid of the same finest spacing
+    assert adaptive.n_evaluations * 10 < (adaptive.n + 1)**2
+    assert sum(adaptive.levels.values()) == len(adaptive.cells())
+    np.testing.assert_allclose(np.prod(adaptive.cells()[:, 2:], axis=1).sum(), 0.4 * 0.5)
+
+    # Samples are exact; the interpolation reproduces them within tol (a
+    # sample on the edge of a coarser leaf is interpolated by that leaf)
+    x, y, Bx, By = adaptive.samples()
+    assert x.size == adaptive.n_evaluations
+    np.testing.assert_array_equal(np.column_stack([Bx, By]), np.column_stack(sim.field(x, y)))
+    Bx_i, By_i = adaptive(x, y)
+    assert np.max(np.hypot(Bx_i - Bx, By_i - By) / (np.hypot(Bx, By) + adaptive.atol)) < adaptive.tol
+
+    # Resampled grid against the exact field, away from the winding edges
+    Bx, By = sim.field(sim.X, sim.Y)
+    error = np.hypot(sim.Bx - Bx, sim.By - By) / (np.hypot(Bx, By) + adaptive.atol)
+    away = np.min([obj.distance(sim.X, sim.Y) for obj in objects], axis=0) > 0.01
+    assert np.percentile(error[away], 99) < 1e-2
+    assert np.median(error) < 1e-3
+
+
+
+
+def test_inplace_kernels_are_bit_identical_and_allocation_free():
+    import tracemalloc
+    from functions import Workspace, coil_field
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0),
+               Coil(x=0.1, y=0.1, radius=0.02, length=0.1, n_turns=50, current=1.0, formulation='cel'),
+               Magnet(x=0.1, y=0.2, moment=0.1)]
+    X, Y = np.meshgrid(np.linspace(-0.2, 0.2, 81), np.linspace(-0.15, 0.35, 81))
+
+    # Same operations in the same order: bit-identical, on-axis points included
+    for obj in objects:
+        Bx = np.empty(X.shape)
+        By = np.empty(X.shape)
+        result = obj.field(X, Y, out=(Bx, By), workspace=Workspace())
+        assert result[0] is Bx and result[1] is By
+        for a, b in zip(obj.field(X, Y, backend='numpy'), (Bx, By)):
+            np.testing.assert_array_equal(a, b)
+    r = np.abs(X.ravel() + 0.05)
+    for a, b in zip(coil_field(0.05, 1e-6, 500, 2.0, r, Y.ravel() - 0.1, Y.ravel() + 0.1),
+                    coil_field(0.05, 1e-6, 500, 2.0, r, Y.ravel() - 0.1, Y.ravel() + 0.1, workspace=Workspace())):
+        np.testing.assert_array_equal(a, b)
+
+    sim = MagneticFieldSimulation(objects[:1] + objects[2:], backend='numpy')
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 200)
+    expected = sim.Bx.copy(), sim.By.copy()
+
+    workspace = Workspace()
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 200, workspace=workspace)
+    np.testing.assert_allclose(sim.Bx, expected[0], rtol=1e-12, atol=1e-20)
+    np.testing.assert_allclose(sim.By, expected[1], rtol=1e-12, atol=1e-20)
+
+    # Repeated calls reuse every buffer: no array of the grid size is allocated
+    allocations = workspace.allocations
+    tracemalloc.start()
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 200, workspace=workspace)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert workspace.allocations == allocations
+    assert peak < 200 * 200 * 8 / 10
+
+    # Single precision halves the buffers
+    single = Workspace()
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 200, workspace=single, dtype=np.float32)
+    assert sim.Bx.dtype == sim.By.dtype == np.float32
+    assert single.nbytes < 0.6 * workspace.nbytes
+    B = np.hypot(*expected)
+    assert np.max(np.hypot(sim.Bx - expected[0], sim.By - expected[1])) < 1e-4 * np.max(B)
+
+
+
+def test_backends_match_the_numpy_reference():
+    import pytest
+    from backends import available_backends, get_backend, set_backend, parity
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0),
+               Coil(x=0.1, y=0.1, radius=0.02, length=0.1, n_turns=50, current=1.0, formulation='cel'),
+               Magnet(x=0.1, y=0.2, moment=0.1), Magnet(x=-0.1, y=-0.1, moment=-0.3)]
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-0.2, 0.2, 2000)
+    y = rng.uniform(-0.15, 0.35, 2000)
+    # On the axes, on the end faces and on the winding edges of the coils
+    special = np.array([(cx + dx, cy + dy) for cx, cy, a, half in ((-0.05, 0.0, 0.05, 0.1), (0.1, 0.1, 0.02, 0.05))
+                        for dx in (0.0, 0.5 * a, a, 2 * a) for dy in (-half, 0.0, half, 0.3 * half)])
+    x, y = np.concatenate([x, special[:, 0]]), np.concatenate([y, special[:, 1]])
+
+    assert 'numpy' in available_backends()
+    assert parity('numpy', objects, x, y) == 0.0
+    for name in available_backends():
+        assert parity(name, objects, x, y) < 1e-10
+        for obj in objects:
+            np.testing.assert_allclose(np.hypot(*obj.field(x, y, backend=name)), np.hypot(*obj.field(x, y, backend='numpy')),
+                                       rtol=1e-9)
+
+        # The default backend drives compute_field
+        sim = MagneticFieldSimulation(objects)
+        previous = set_backend(name)
+        try:
+            sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 40)
+        finally:
+            set_backend(previous)
+        Bx, By = MagneticFieldSimulation(objects, backend='numpy').field(sim.X, sim.Y)
+        assert np.max(np.hypot(sim.Bx - Bx, sim.By - By)) < 1e-10 * np.max(np.hypot(Bx, By))
+
+    with pytest.raises(ValueError):
+        get_backend('fortran')
+
+
+
+def test_numba_backend_matches_the_numpy_reference():
+    import pytest
+    pytest.importorskip('numba')
+    from backends import available_backends, parity
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0),
+               Coil(x=0.1, y=0.1, radius=0.02, length=0.1, n_turns=50, current=1.0, formulation='cel'),
+               Magnet(x=0.1, y=0.2, moment=0.1), Magnet(x=-0.1, y=-0.1, moment=-0.3)]
+    rng = np.random.default_rng(1)
+    x = rng.uniform(-0.2, 0.2, 2000)
+    y = rng.uniform(-0.15, 0.35, 2000)
+    # On the axes, on the end faces and on the winding edges of the coils
+    special = np.array([(cx + dx, cy + dy) for cx, cy, a, half in ((-0.05, 0.0, 0.05, 0.1), (0.1, 0.1, 0.02, 0.05))
+                        for dx in (0.0, 0.5 * a, a, 2 * a) for dy in (-half, 0.0, half, 0.3 * half)])
+    x, y = np.concatenate([x, special[:, 0]]), np.concatenate([y, special[:, 1]])
+
+    assert 'numba' in available_backends()
+    assert parity('numba', objects, x, y) < 1e-10
+    for obj in objects:
+        np.testing.assert_allclose(np.hypot(*obj.field(x, y, backend='numba')),
+                                   np.hypot(*obj.field(x, y, backend='numpy')), rtol=1e-9)
+
+    sim = MagneticFieldSimulation(objects, backend='numba')
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 40)
+    Bx, By = MagneticFieldSimulation(objects, backend='numpy').field(sim.X, sim.Y)
+    assert np.max(np.hypot(sim.Bx - Bx, sim.By - By)) < 1e-10 * np.max(np.hypot(Bx, By))
+
+
+
+def test_far_field_multipole_within_error_bound():
+    from functions import coil_multipoles, far_field_radius, far_field_radius_scalar
+    from simulation import MagneticFieldSimulation, Coil
+    from profiling import Profile
+
+    # c_1 is the dipole N I π a² / (4π) per n I, c_3 the octupole
+    a, length = 0.02, 0.1
+    c = coil_multipoles(a, length)
+    np.testing.assert_allclose(c[:2], [a**2 * 0.05 / 2, a**2 * 0.05 * (2 * 0.05**2 - 1.5 * a**2) / 4])
+
+    # The bound holds at any angle beyond the switch radius, for flat, square and long coils
+    rng = np.random.default_rng(0)
+    for tol in (1e-2, 1e-4, 1e-6):
+        for a, length in ((0.02, 0.1), (0.05, 0.01), (0.03, 0.03), (0.01, 0.3)):
+            coil = Coil(x=0.0, y=0.0, radius=a, length=length, n_turns=100, current=2.0, formulation='cel',
+                        far_field_tol=tol)
+            R = coil.far_field_radius * (1 + rng.exponential(0.5, 5000))
+            theta = rng.uniform(0, 2 * np.pi, R.size)
+            x, y = R * np.sin(theta), R * np.cos(theta)
+            Bx, By = coil.field(x, y, backend='numpy')
+            coil.far_field_tol = None
+            Bx_exact, By_exact = coil.field(x, y, backend='numpy')
+            error = np.hypot(Bx - Bx_exact, By - By_exact) / np.hypot(Bx_exact, By_exact)
+            assert np.max(error) <= tol
+            assert np.max(error) > tol / 100
+    assert far_field_radius(a, length, None) == np.inf
+
+    # A scene of small coils: most points are far field, the error of the
+    # total is bounded by tol times the sum of the coils' fields
+    objects = [Coil(x=x, y=y, radius=0.02, length=0.06, n_turns=100, current=1.0, far_field_tol=1e-4)
+               for x, y in rng.uniform(-1, 1, (10, 2))]
+    sim = MagneticFieldSimulation(objects, backend='numpy')
+    with Profile(memory=False) as profile:
+        sim.compute_field((-1, 1), (-1, 1), 100)
+    counters = profile.stats()['counters']
+    assert counters['multipole'] > 0.9 * 10 * 100 * 100
+    assert counters['ellipk'] < 0.1 * 2 * 10 * 100 * 100
+
+    exact = [Coil.from_dict({**obj.to_dict(), 'far_field_tol': None}) for obj in objects]
+    fields = np.array([obj.field(sim.X, sim.Y) for obj in exact])
+    Bx, By = fields.sum(axis=0)
+    total = np.hypot(fields[:, 0], fields[:, 1]).sum(axis=0)
+    finite = np.isfinite(total)
+    assert np.all(np.hypot(sim.Bx - Bx, sim.By - By)[finite] <= 1e-4 * total[finite])
+    assert Coil.from_dict(objects[0].to_dict()).far_field_tol == 1e-4
+
+    # The switch radius is solved once per geometry and tol, not per call or chunk
+    far_field_radius_scalar.cache_clear()
+    small = MagneticFieldSimulation(objects, memory_budget=2**16, backend='numpy')
+    for _ in range(20):
+        objects[0].field(0.5, 0.5, backend='numpy')
+        small.field(sim.X[::10, ::10], sim.Y[::10, ::10])
+    assert far_field_radius_scalar.cache_info().misses == 1
+
+
+
+def test_field_server_streams_binary_frames_and_coalesces_scenes():
+    import asyncio
+    import http.client
+    import json
+    import threading
+    from server import FieldServer, serve, decode_frame, frame_size
+    from simulation import MagneticFieldSimulation, Coil, Magnet
+
+    started = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+
+        def ready(field_server, port):
+            state.update(loop=loop, port=port)
+            started.set()
+
+        state['task'] = loop.create_task(serve(port=0, workers=4, executor='thread', ready=ready))
+        try:
+            loop.run_until_complete(state['task'])
+        except asyncio.CancelledError:
+            pass
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(10)
+
+    def request(method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', state['port'], timeout=60)
+        connection.request(method, path, None if body is None else json.dumps(body))
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    try:
+        objects = [Coil(x=-0.05, y=0.0, radius=0.05, length=0.2, n_turns=100, current=2.0), Magnet(x=0.1, y=0.2)]
+        scene = {'objects': [obj.to_dict() for obj in objects], 'x_range': [-0.2, 0.2], 'y_range': [-0.15, 0.35],
+                 'resolution': 60, 'fields': ['Bx', 'By', 'Az']}
+
+        # One frame back, float32 grids of compute_field / compute_potential
+        status, data = request('POST', '/compute', scene)
+        assert status == 200
+        version, x_range, y_range, fields = decode_frame(data)
+        assert version == 1 and x_range == (-0.2, 0.2) and y_range == (-0.15, 0.35)
+        assert len(data) == frame_size(data) == 52 + 3 * 4 + 3 * 60 * 60 * 4
+        sim = MagneticFieldSimulation(objects)
+        sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 60)
+        sim.compute_potential((-0.2, 0.2), (-0.15, 0.35), 60)
+        for name, expected in (('Bx', sim.Bx), ('By', sim.By), ('Az', sim.Az)):
+            assert fields[name].dtype == np.float32
+            np.testing.assert_array_equal(fields[name], expected.astype(np.float32))
+
+        # Scenes posted while an older one is computing replace it: the
+        # stream only gets the frame of the last one
+        stream = http.client.HTTPConnection('127.0.0.1', state['port'], timeout=60)
+        stream.request('GET', '/stream')
+        response = stream.getresponse()
+        assert response.status == 200
+        big = dict(scene, fields=['Bx', 'By'], resolution=400,
+                   objects=[Coil(x=x, y=0.0, radius=0.02, length=0.1, n_turns=100, current=1.0).to_dict()
+                            for x in np.linspace(-0.15, 0.15, 8)])
+        for k in range(3):
+            assert json.loads(request('POST', '/scene', dict(big, resolution=400 + k))[1]) == {'version': 2 + k}
+        received = []
+        while not received or received[-1] != 4:
+            header = response.read(52)
+            version, _, _, fields = decode_frame(header + response.read(frame_size(header) - 52))
+            assert fields['Bx'].shape == (398 + version,) * 2
+            received.append(version)
+        assert received == sorted(set(received)) and received[-1] == 4
+        stream.close()
+
+        stats = json.loads(request('GET', '/stats')[1])
+        assert stats['scenes'] == stats['version'] == 4 and stats['frames'] >= 2
+
+        # Two /compute sent back to back: the first is superseded (409),
+        # even if it is cancelled before it starts, the second computed
+        first = http.client.HTTPConnection('127.0.0.1', state['port'], timeout=60)
+        second = http.client.HTTPConnection('127.0.0.1', state['port'], timeout=60)
+        first.request('POST', '/compute', json.dumps(big))
+        second.request('POST', '/compute', json.dumps(dict(big, resolution=50)))
+        response = first.getresponse()
+        assert response.status == 409 and json.loads(response.read())['error'] == 'superseded'
+        response = second.getresponse()
+        assert response.status == 200 and decode_frame(response.read())[0] == 6
+
+        status, data = request('POST', '/compute', dict(scene, fields=['Ez']))
+        assert status == 400 and 'fields' in json.loads(data)['error']
+
+        # Malformed or negative Content-Length: 400, not a dead connection
+        for length in ('abc', '-5'):
+            connection = http.client.HTTPConnection('127.0.0.1', state['port'], timeout=60)
+            connection.putrequest('POST', '/scene')
+            connection.putheader('Content-Length', length)
+            connection.endheaders()
+            response = connection.getresponse()
+            assert response.status == 400 and 'Content-Length' in json.loads(response.read())['error']
+    finally:
+        state['loop'].call_soon_threadsafe(state['task'].cancel)
+        thread.join(10)
+    assert not thread.is_alive()
+
+    # Deterministic version of the race: the second handler runs before the
+    # first scene's task has started, which is cancelled outright
+    class Writer:
+        def __init__(self):
+            self.data = b''
+
+        def write(self, data):
+            self.data += data
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            pass
+
+    async def back_to_back():
+        server = FieldServer(workers=2, executor='thread')
+        writers = [Writer(), Writer()]
+        handlers = []
+        for writer, resolution in zip(writers, (60, 20)):
+            body = json.dumps(dict(scene, resolution=resolution)).encode()
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'POST /compute HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            reader.feed_eof()
+            handlers.append(asyncio.get_running_loop().create_task(server.handle(reader, writer)))
+        await asyncio.gather(*handlers)
+        await server.close()
+        return [writer.data for writer in writers]
+
+    first, second = asyncio.run(back_to_back())
+    assert first.startswith(b'HTTP/1.1 409') and b'superseded' in first
+    assert second.startswith(b'HTTP/1.1 200')
+
+
+
+def test_line_profiles_and_snapshot_round_trip(tmp_path):
+    import numpy as np
+    from fieldfile import FieldFile
+    from simulation import Coil, ExtendedMagnet, MagneticFieldSimulation
+
+    sim = MagneticFieldSimulation([Coil(0.0, 0.0, 0.03, 0.05, 100, 2.0),
+                                   ExtendedMagnet(0.08, 0.02, n_x=5, n_y=10)], backend='numpy')
+
+    # Several cuts in one call, equal to the field along each line
+    x, y, Bx, By = sim.line_profile([[-0.1, 0.0], [0.001, -0.1]], [[0.1, 0.0], [0.001, 0.1]], n=50)
+    assert x.shape == Bx.shape == (2, 50)
+    np.testing.assert_allclose(x[1], 0.001)
+    np.testing.assert_allclose(y[1], np.linspace(-0.1, 0.1, 50))
+    Bx_ref, By_ref = sim.field(np.linspace(-0.1, 0.1, 50), 0.0)
+    np.testing.assert_allclose(Bx[0], Bx_ref, rtol=1e-12)
+    np.testing.assert_allclose(By[0], By_ref, rtol=1e-12)
+    single = sim.line_profile((-0.1, 0.0), (0.1, 0.0), n=50)
+    assert single[2].shape == (50,)
+    np.testing.assert_allclose(single[3], By[0], rtol=1e-12)
+
+    # Grids and profiles reopen memory-mapped, bit for bit
+    sim.compute_field((-0.1, 0.1), (-0.1, 0.1), 40)
+    profiles = {'axis': ((0.0, -0.1), (0.0, 0.1))}
+    sim.save_snapshot(tmp_path / 'scene.emf', profiles, n=30, meta={'note': 'test'})
+    snapshot = FieldFile(tmp_path / 'scene.emf')
+    assert isinstance(snapshot['Bx'], np.memmap) and isinstance(snapshot['axis/By'], np.memmap)
+    np.testing.assert_array_equal(snapshot['Bx'], sim.Bx)
+    np.testing.assert_array_equal(snapshot['x'], sim.X[0])
+    np.testing.assert_allclose(snapshot['axis/By'], sim.line_profile(*profiles['axis'], n=30)[3], rtol=1e-12)
+    assert 'Az' not in snapshot
+    assert snapshot.meta['scene_hash'] == sim.scene_hash() and snapshot.meta['note'] == 'test'
+    assert snapshot.meta['profiles'] == {'axis': [[0.0, -0.1], [0.0, 0.1]]}
+
+
+
+def test_scene_files_and_headless_cli(tmp_path):
+    import os
+    import subprocess
+    import sys
+    import pytest
+    import numpy as np
+    from fieldfile import FieldFile
+    from scene import load_scene, main, save_scene
+    from simulation import Coil, Magnet, MagneticFieldSimulation
+
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    # Computing fields does not import matplotlib
+    code = "import sys, simulation, scene; print('matplotlib' in sys.modules)"
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                          cwd=root).stdout.strip() == 'False'
+
+    # TOML and JSON scene files describe the same scene
+    path = os.path.join(root, 'scenes', 'example.toml')
+    example = load_scene(path)
+    assert example['resolution'] == 50 and [obj['type'] for obj in example['objects']] == ['coil', 'magnet']
+    objects = [Coil(-0.05, 0.0, 0.05, 0.2, 100, 2.0), Magnet(0.1, 0.2, moment=0.1)]
+    save_scene(tmp_path / 'scene.json', objects, (-0.2, 0.2), (-0.15, 0.35), 50)
+    assert load_scene(tmp_path / 'scene.json') == dict(example, objects=[obj.to_dict() for obj in objects])
+
+    sim = MagneticFieldSimulation(objects, backend='numpy')
+    sim.compute_field((-0.2, 0.2), (-0.15, 0.35), 50)
+    main([path, '--out', str(tmp_path / 'field.npz'), '--backend', 'numpy'])
+    with np.load(tmp_path / 'field.npz') as arrays:
+        np.testing.assert_array_equal(arrays['By'], sim.By)
+        np.testing.assert_array_equal(arrays['x'], sim.X[0])
+
+    # Field file output and an image rendered without a display
+    main([path, '--resolution', '20', '--out', str(tmp_path / 'field.emf'),
+          '--plot', 'arrows', '--image', str(tmp_path / 'arrows.png')])
+    assert FieldFile(tmp_path / 'field.emf')['Bx'].shape == (20, 20)
+    assert (tmp_path / 'arrows.png').stat().st_size > 0
+
+    (tmp_path / 'bad.json').write_text('{"objects": [{"type": "coil"}], "x_range": [0, 1], "y_range": [0, 1]}')
+    with pytest.raises(ValueError, match='Invalid scene'):
+        load_scene(tmp_path / 'bad.json')
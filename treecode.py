@@ -0,0 +1,169 @@
+"""
+Barnes-Hut tree code for the field of many in-plane point dipoles.
+
+Dipoles are grouped in a quadtree. Seen from far enough, a cell is replaced
+by the moments of its dipoles m_i about the cell center, d_i being the
+offset of dipole i from the center:
+
+    M_j = Σ m_ij                 aggregate dipole
+    Q_jk = Σ m_ij d_ik           quadrupole
+    O_jkl = Σ m_ij d_ik d_il     next order (octupole)
+
+and the field is the Taylor expansion of the dipole field about the center,
+
+    B_a(R) ≈ μ/(4π) [M_j T_aj - Q_jk T_ajk + ½ O_jkl T_ajkl],   R = r - center
+
+with T the derivatives of 1/|R| (T_aj = ∂_a∂_j 1/|R|, ...). For a uniformly
+magnetised cell Q vanishes about the centroid, so the octupole term is the
+leading correction.
+
+A cell is accepted when extent / |R| < theta (the opening angle). The
+truncation error is of order (extent / |R|)³, so theta trades accuracy for
+speed; theta = 0 gives the direct sum.
+"""
+
+import numpy as np
+from functions import dipole_sum
+
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'center', 'extent', 'M', 'Q', 'O', 'children')
+
+
+
+class DipoleTree:
+    """
+    Quadtree over dipoles at positions (px, py) with moments (mx, my).
+
+    leaf_size: maximum number of dipoles of a leaf, evaluated directly
+    memory_budget: bytes of the leaf dipoles × points blocks (see dipole_sum)
+    """
+
+    def __init__(self, px, py, mx, my, mu, leaf_size=64, memory_budget=64 * 2**20):
+        self.mu = mu
+        self.leaf_size = leaf_size
+        self.memory_budget = memory_budget
+
+        px, py, mx, my = (np.asarray(v, dtype=float).ravel() for v in (px, py, mx, my))
+        self._order = []
+        self._n_ordered = 0
+        self.root = self._build(np.arange(px.size), px, py, mx, my)
+
+        # Dipoles permuted so that every node covers a contiguous range
+        order = np.concatenate(self._order)
+        self.px, self.py, self.mx, self.my = px[order], py[order], mx[order], my[order]
+        del self._order, self._n_ordered
+
+        self.n_nodes = self._count(self.root)
+
+
+    def _build(self, idx, px, py, mx, my):
+        node = _Node()
+        x, y = px[idx], py[idx]
+
+        node.center = np.array([x.mean(), y.mean()])
+        dx = x - node.center[0]
+        dy = y - node.center[1]
+        node.extent = np.sqrt(np.max(dx**2 + dy**2))
+        m = np.stack([mx[idx], my[idx]], axis=1)
+        d = np.stack([dx, dy], axis=1)
+        node.M = m.sum(axis=0)
+        node.Q = np.einsum('ij,ik->jk', m, d)
+        node.O = np.einsum('ij,ik,il->jkl', m, d, d)
+        node.children = []
+
+        start = self._n_ordered
+        if idx.size <= self.leaf_size or node.extent == 0:
+            self._order.append(idx)
+            self._n_ordered += idx.size
+        else:
+            # Split in quadrants around the bounding box center
+            xc = 0.5 * (x.min() + x.max())
+            yc = 0.5 * (y.min() + y.max())
+            for quadrant in ((x < xc) & (y < yc), (x >= xc) & (y < yc),
+                             (x < xc) & (y >= yc), (x >= xc) & (y >= yc)):
+                if np.any(quadrant):
+                    node.children.append(self._build(idx[quadrant], px, py, mx, my))
+        node.start = start
+        node.end = start + idx.size
+        return node
+
+
+    def _count(self, node):
+        return 1 + sum(self._count(child) for child in node.children)
+
+
+    def field(self, x, y, theta=0.5):
+        """
+        Field (Bx, By) at points (x, y) with opening angle theta.
+
+        Each node is visited once with the whole set of points that still
+        need it, so every step is a vectorized operation over points.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        x = np.broadcast_to(x, shape).ravel()
+        y = np.broadcast_to(y, shape).ravel()
+
+        Bx = np.zeros(x.size)
+        By = np.zeros(x.size)
+        stack = [(self.root, np.arange(x.size))]
+
+        while stack:
+            node, idx = stack.pop()
+            Rx = x[idx] - node.center[0]
+            Ry = y[idx] - node.center[1]
+            accept = node.extent < theta * np.sqrt(Rx**2 + Ry**2)
+
+            if np.any(accept):
+                bx, by = self._multipole(node, Rx[accept], Ry[accept])
+                Bx[idx[accept]] += bx
+                By[idx[accept]] += by
+
+            rest = idx[~accept]
+            if rest.size == 0:
+                continue
+            if node.children:
+                stack.extend((child, rest) for child in node.children)
+            else:
+                d = slice(node.start, node.end)
+                bx, by = dipole_sum(self.px[d], self.py[d], self.mx[d], self.my[d], self.mu, x[rest], y[rest],
+                                    self.memory_budget)
+                Bx[rest] += bx
+                By[rest] += by
+
+        return Bx.reshape(shape), By.reshape(shape)
+
+
+    def _multipole(self, node, Rx, Ry):
+        """Multipole field of a cell at offsets R from its center."""
+        R = np.stack([Rx, Ry], axis=1)
+        R2 = (Rx**2 + Ry**2)[:, None]
+        inv5 = 1 / (R2**2 * np.sqrt(R2))
+        inv7 = inv5 / R2
+        inv9 = inv7 / R2
+        M, Q, O = node.M, node.Q, node.O
+
+        # M_j T_aj
+        B = 3 * R * (R @ M)[:, None] * inv5 - M * (R2 * inv5)
+
+        # - Q_jk T_ajk
+        QtR = R @ Q                        # Σ_j Q_ja R_j
+        QR = R @ Q.T                       # Σ_k Q_ak R_k
+        RQR = np.einsum('pa,pa->p', QR, R)[:, None]
+        B -= -15 * R * RQR * inv7 + 3 * (R * np.trace(Q) + QtR + QR) * inv5
+
+        # ½ O_jkl T_ajkl, O being symmetric in k, l
+        u = np.einsum('jkk->j', O)         # Σ_k O_akk
+        v = np.einsum('jkj->k', O)         # Σ_j O_jaj = Σ_j O_jja
+        A = np.einsum('jka,pj,pk->pa', O, R, R)
+        C = np.einsum('akl,pk,pl->pa', O, R, R)
+        ORRR = np.einsum('pa,pa->p', C, R)[:, None]
+        B += 0.5 * (105 * R * ORRR * inv9
+                    - 15 * (R * (R @ (u + 2 * v))[:, None] + 2 * A + C) * inv7
+                    + 3 * (u + 2 * v) * inv5)
+
+        B *= self.mu / (4 * np.pi)
+        return B[:, 0], B[:, 1]